@@ -2,15 +2,30 @@ from flask import Flask
 from flask_bootstrap import Bootstrap
 from flask_mail import Mail
 from flask_moment import Moment
-from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
 from config import config
-import flask_whooshalchemyplus
+from .engine import SQLAlchemy
+from .search import Search
+from .dbstats import DBStats
+from .metrics import Metrics
+from .profiler import Profiler
+from .shards import LoanShards
+from .snapshot import Catalog
+from .modelcache import ModelCache
+from .fragments import TemplateCache
 
 bootstrap = Bootstrap()
 mail = Mail()
 moment = Moment()
 db = SQLAlchemy()
+search = Search()
+db_stats = DBStats()
+metrics = Metrics()
+profiler = Profiler()
+loan_shards = LoanShards()
+catalog = Catalog()
+model_cache = ModelCache()
+template_cache = TemplateCache()
 
 login_manager = LoginManager()
 login_manager.session_protection = 'strong'
@@ -25,8 +40,13 @@ def create_app(config_name):
     bootstrap.init_app(app)
     mail.init_app(app)
     moment.init_app(app)
+    loan_shards.init_app(app)
     db.init_app(app)
-    flask_whooshalchemyplus.init_app(app)
+    model_cache.init_app(app)
+    template_cache.init_app(app)
+    db_stats.init_app(app)
+    metrics.init_app(app)
+    profiler.init_app(app)
     login_manager.init_app(app)
 
     from .main import main as main_blueprint
@@ -39,4 +59,11 @@ def create_app(config_name):
     from .api_1_0 import api as api_1_0_blueprint
     app.register_blueprint(api_1_0_blueprint, url_prefix='/api/v1')
 
+    # 模型随蓝本导入, 注册后才能按配置建立索引
+    search.init_app(app)
+    catalog.init_app(app)
+
+    from .email import mail_pool
+    mail_pool.init_app(app)
+
     return app
@@ -1,12 +1,81 @@
-from flask import g, jsonify
+import hmac
+import json
+import time
+import hashlib
+from flask import g, jsonify, current_app
 from flask_httpauth import HTTPBasicAuth
-from ..models import User, AnonymousUser
+from itsdangerous import base64_decode
+from ..cache import LRUCache
+from ..models import User, AnonymousUser, load_identity
 from . import api
 from .errors import unauthorized, forbidden
 
 auth = HTTPBasicAuth()
 
 
+class CredentialCache(object):
+    """
+    ..  note:: 已验证凭据缓存
+
+        邮箱+密码的验证需要一次 ``PBKDF2`` 计算, 令牌的验证需要构造 ``Serializer``
+        并校验签名, 两者都还要查询一次用户。对重复请求的客户端,
+        这里缓存验证通过的凭据对应的用户 ``id``。
+
+        缓存键是以 ``SECRET_KEY`` 为密钥的 ``HMAC-SHA256``, 进程内不保存明文凭据。
+        条目受容量和 ``API_AUTH_CACHE_TTL`` 限制, 令牌条目的有效期不超过令牌本身。
+
+        条目中还保存验证时读到的用户版本号 (``User.version``)。
+        修改密码、邮箱或验证状态都会递增版本号, 命中时与身份快照
+        (各进程共享失效, 见 ``load_identity``) 中的版本号比较, 不同则重新验证,
+        其他进程中的旧凭据也不再有效。
+
+    """
+
+    def __init__(self, secret_key, maxsize, ttl):
+        self.secret_key = secret_key.encode('utf-8')
+        self.ttl = ttl
+        self.entries = LRUCache(maxsize, ttl)
+
+    def key(self, *parts):
+        return hmac.new(self.secret_key, u'\0'.join(parts).encode('utf-8'),
+                        hashlib.sha256).hexdigest()
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def set(self, key, user, token_used, expires=None):
+        ttl = self.ttl
+        if expires is not None:
+            ttl = min(ttl, expires - time.time())
+            if ttl <= 0:
+                return
+        self.entries.set(key, (user.id, user.version, token_used), ttl)
+
+
+def credential_cache():
+    """
+    当前程序的凭据缓存, 首次使用时按配置创建
+    """
+    cache = current_app.extensions.get('credential_cache')
+    if cache is None:
+        cache = current_app.extensions['credential_cache'] = CredentialCache(
+            current_app.config['SECRET_KEY'],
+            current_app.config['API_AUTH_CACHE_SIZE'],
+            current_app.config['API_AUTH_CACHE_TTL'])
+    return cache
+
+
+def token_expiration(token):
+    """
+    读取已验证令牌头部中的过期时间
+    """
+    try:
+        header = json.loads(base64_decode(token.split('.')[0]).decode('utf-8'))
+        return header.get('exp')
+    except Exception:
+        return None
+
+
 @auth.verify_password
 def verify_password(email_or_token, password):
     """
@@ -24,20 +93,38 @@ def verify_password(email_or_token, password):
 
         为了让视图函数能区分这两种认证方法, 添加了 g.token_used 变量。
 
+        验证通过的凭据会写入 ``CredentialCache``, 重复的请求只需一次字典查找。
+
     """
     if email_or_token == '':
         g.current_user = AnonymousUser()
         return True
+    cache = credential_cache()
+    key = cache.key(email_or_token, password)
+    cached = cache.get(key)
+    if cached is not None:
+        user_id, version, token_used = cached
+        identity = load_identity(user_id)
+        if identity is not None and identity.version == version:
+            g.current_user = identity
+            g.token_used = token_used
+            return True
     if password == '':
-        g.current_user = User.verify_auth_token(email_or_token) #???
+        g.current_user = User.verify_auth_token(email_or_token)
         g.token_used = True
-        return g.current_user is not None
+        if g.current_user is None:
+            return False
+        cache.set(key, g.current_user, True, token_expiration(email_or_token))
+        return True
     user = User.query.filter_by(email=email_or_token).first()
     if not user:
         return False
     g.current_user = user
     g.token_used = False
-    return user.verify_password(password)
+    if not user.verify_password(password):
+        return False
+    cache.set(key, user, False)
+    return True
 
 
 @auth.error_handler
@@ -67,4 +154,4 @@ def get_token():
     if g.current_user.is_anonymous or g.token_used:
         return unauthorized('Invalid credentials')
     return jsonify({'token': g.current_user.generate_auth_token(
-        expiration=3600), 'expiration': 3600})
+        expiration=3600).decode('ascii'), 'expiration': 3600})
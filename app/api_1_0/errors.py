@@ -30,6 +30,24 @@ def forbidden(message):
     return response
 
 
+def conflict(message):
+    """
+    与现有数据冲突
+    """
+    response = jsonify({'error': 'conflict', 'message': message})
+    response.status_code = 409
+    return response
+
+
+def precondition_required(message):
+    """
+    缺少条件请求头
+    """
+    response = jsonify({'error': 'precondition required', 'message': message})
+    response.status_code = 428
+    return response
+
+
 @api.errorhandler(ValidationError)
 def validation_error(e):
     """
@@ -1,9 +1,21 @@
 from flask import jsonify, request, g, abort, url_for, current_app
-from .. import db
-from ..models import Movie, Permission
+import json
+from sqlalchemy.exc import IntegrityError
+from .. import catalog, db, model_cache
+from ..decorators import write_transaction
+from ..exceptions import ValidationError
+from ..models import Movie, Permission, TOTAL_MOVIES
+from ..counts import total as catalog_total
+from ..rows import MovieItem
+from ..similar import update_movie
 from . import api
 from .decorators import permission_required
-from .errors import forbidden
+from .errors import conflict, forbidden, precondition_required
+
+# JSON 字段与列的对应, 列表字段以 ' / ' 连接
+TEXT_FIELDS = {'title': 'title', 'original_title': 'original_title',
+               'images': 'images', 'douban_alt': 'alt'}
+LIST_FIELDS = ('directors', 'casts', 'genres')
 
 
 @api.route('/movies/')
@@ -15,12 +27,21 @@ def get_movies():
         2. 分页
         3. 响应格式为 json
 
+        发布了目录快照并且之后没有修改时从快照分页, 直接拼接预先生成的 JSON。
+
     """
     count = current_app.config['FLASKY_JSONS_PER_PAGE']
     page = request.args.get('page', 1, type=int)
-    pagination = Movie.query.paginate(
-        page, per_page=count,
-        error_out=False)
+    snapshot = catalog.current()
+    pagination = None
+    if snapshot is not None:
+        pagination = snapshot.paginate('id', page, count)
+    from_snapshot = pagination is not None
+    if not from_snapshot:
+        pagination = model_cache.paginate('api_movies', Movie, Movie.query,
+                                          page, count,
+                                          catalog_total(TOTAL_MOVIES),
+                                          factory=MovieItem)
     movies = pagination.items
     prev = None
     if pagination.has_prev:
@@ -28,19 +49,135 @@ def get_movies():
     next = None
     if pagination.has_next:
         next = url_for('api.get_movies', page=page+1, _external=True)
-    return jsonify({
+    envelope = {
         'count': count,
         'start': (page - 1) * int(count),
         'total': pagination.total,
         'prev': prev,
         'next': next,
-        'movies': [movie.to_json() for movie in movies]
-    })
+    }
+    if from_snapshot:
+        return _json_response('{%s, "movies": [%s]}' % (
+            json.dumps(envelope)[1:-1],
+            ', '.join(movie.json_fragment() for movie in movies)))
+    envelope['movies'] = [movie.to_json() for movie in movies]
+    return jsonify(envelope)
 
 @api.route('/movies/<int:id>')
 def get_movie(id):
     """
     ..  note:: 获取指定的 movie 资源, 响应格式为 json
+
+        快照中有该影片且生成之后没有修改过时直接返回预先生成的 JSON, 否则查询数据库。
+        ``ETag`` 为响应内容对应的版本号, 修改时作为 ``If-Match`` 发送;
+        请求带有相同的 ``If-None-Match`` 时返回 304。
+    """
+    snapshot = catalog.current()
+    row = snapshot.get(id) if snapshot is not None else None
+    if row is not None:
+        response = _json_response(row.json_fragment())
+        if row.version is not None:
+            response.set_etag(_etag(row.version))
+        return response.make_conditional(request)
+    movie = model_cache.get_or_404(Movie, id)
+    return _movie_response(movie).make_conditional(request)
+
+@api.route('/movies/<int:id>', methods=['PUT'])
+@permission_required(Permission.MODERATE_MOVIE)
+@write_transaction
+def edit_movie(id):
+    """
+    ..  note:: 修改指定的 movie, 请求与响应格式为 json
+
+        1. 请求头 ``If-Match`` 为读取时的 ``ETag``, 缺少时返回 428;
+        2. 与当前版本不符 (期间被修改过) 时返回 412, 响应为当前的 movie 和 ``ETag``,
+           客户端合并后重新提交;
+        3. 请求体可以包含 ``to_json`` 中的字段, 以及库存增量 ``amount_delta``;
+           先校验所有字段, 任一字段不合法或库存会小于 0 时返回 400, 不做任何修改;
+        4. ``title`` 或 ``original_title`` 与其他影片重复时返回 409, 不做任何修改;
+        5. 成功时返回修改后的 movie 和新的 ``ETag``。
+
+        库存按增量修改, 不影响版本号, 同时发生的借阅不会被覆盖。
+    """
+    movie = model_cache.get_or_404(Movie, id)
+    if not request.if_match:
+        return precondition_required('请求头中缺少 If-Match')
+    if not request.if_match.contains(_etag(movie.version)):
+        response = _movie_response(movie)
+        response.status_code = 412
+        return response
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        raise ValidationError('请求体必须是 JSON 对象')
+    changes = _changes(data)
+    amount_delta = _number(data, 'amount_delta', int) \
+        if 'amount_delta' in data else 0
+    try:
+        for name, value in changes.items():
+            setattr(movie, name, value)
+        if amount_delta:
+            movie.adjust_stock(amount=amount_delta)
+            if movie.amount < 0:
+                db.session.rollback()
+                raise ValidationError('库存不足, 不能减少 %d' % -amount_delta)
+        update_movie(movie)
+        db.session.flush()
+    except IntegrityError:
+        db.session.rollback()
+        return conflict('影片名称已被其他影片使用')
+    return _movie_response(movie)
+
+def _changes(data):
     """
-    movie = Movie.query.get_or_404(id)
-    return jsonify(movie.to_json())
+    校验请求体中的所有字段, 返回 ``{列名: 值}``; 任一字段不合法时不做任何修改
+    """
+    changes = {}
+    for key, name in TEXT_FIELDS.items():
+        if key in data:
+            changes[name] = _text(data, key)
+    for name in LIST_FIELDS:
+        if name in data:
+            value = data[name]
+            if isinstance(value, list):
+                value = u' / '.join(_text({name: item}, name) for item in value)
+            changes[name] = _text({name: value}, name)
+    if 'year' in data:
+        changes['year'] = _number(data, 'year', int)
+    if 'rating' in data:
+        changes['rating'] = _number(data, 'rating', float)
+    return changes
+
+def _text(data, key):
+    value = data[key]
+    if not isinstance(value, type(u'')) and not isinstance(value, str):
+        raise ValidationError('%s 必须是字符串' % key)
+    return value
+
+def _number(data, key, kind):
+    value = data[key]
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise ValidationError('%s 必须是数字' % key)
+    if kind is int and value != int(value):
+        raise ValidationError('%s 必须是整数' % key)
+    return kind(value)
+
+def _etag(version):
+    return str(version)
+
+def _movie_response(movie):
+    response = jsonify(movie.to_json())
+    response.set_etag(_etag(movie.version))
+    return response
+
+def _json_response(body):
+    return current_app.response_class(body, mimetype='application/json')
+
+@api.route('/movies/<int:id>/similar')
+def get_similar_movies(id):
+    """
+    ..  note:: 获取与指定 movie 内容相似的 movies, 按相似度降序, 响应格式为 json
+    """
+    movie = model_cache.get_or_404(Movie, id)
+    return jsonify({
+        'movies': [m.to_json() for m in movie.similar_movies]
+    })
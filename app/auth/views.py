@@ -88,6 +88,7 @@ def register():
         # 提交数据库之后才能赋予新用户 id 值,而确认令牌需要用到 id ,所以不能延后提交
         db.session.commit()
         token = user.generate_confirmation_token()
+        # 邮件在请求结束时提交
         send_email(user.email, "验证您的账户", 'auth/email/confirm',
                     user=user, token=token)
         flash('一封验证邮件已发送到您的邮箱，请登录邮箱进行验证！')
@@ -142,7 +143,7 @@ def change_password():
     if form.validate_on_submit():
         if current_user.verify_password(form.old_password.data):
             current_user.password = form.password.data
-            db.session.add(current_user)
+            db.session.add(current_user.user)
             flash('您的密码已被修改！')
             return redirect(url_for('main.index'))
         else:
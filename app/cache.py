@@ -0,0 +1,300 @@
+# -*- coding:utf-8 -*-
+import os
+import mmap
+import time
+import zlib
+import pickle
+import struct
+import sqlite3
+import threading
+from collections import OrderedDict
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class LRUCache(object):
+    """
+    ..  note:: 进程内 LRU 缓存
+
+        按最近使用顺序淘汰, 容量由 ``maxsize`` 限定;
+        设置了 ``ttl`` (秒) 时, 过期的条目在读取时丢弃。
+
+    """
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        读取缓存, 未命中或已过期时返回 ``None``
+        """
+        with self._lock:
+            item = self._data.pop(key, None)
+            if item is None:
+                return None
+            value, expires = item
+            if expires is not None and expires < time.time():
+                return None
+            self._data[key] = item
+            return value
+
+    def set(self, key, value, ttl=None):
+        """
+        写入缓存, ``ttl`` 为空时使用默认过期时间
+        """
+        ttl = ttl or self.ttl
+        expires = time.time() + ttl if ttl else None
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, expires)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __contains__(self, key):
+        item = self._data.get(key)
+        return item is not None and (item[1] is None or item[1] >= time.time())
+
+    def __len__(self):
+        return len(self._data)
+
+
+class SQLiteCache(object):
+    """
+    ..  note:: 多进程共享的缓存
+
+        使用本地 SQLite 文件保存缓存条目, 同一台机器上的多个 worker 共享。
+        每个线程使用自己的连接, 值通过 ``pickle`` 序列化。
+
+    """
+
+    def __init__(self, path, maxsize=10000, ttl=None):
+        self.path = path
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._local = threading.local()
+        self._writes = 0
+
+    @property
+    def connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS cache ('
+                         'key TEXT PRIMARY KEY, value BLOB, '
+                         'expires REAL, accessed REAL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS ix_cache_accessed '
+                         'ON cache (accessed)')
+            self._local.conn = conn
+        return conn
+
+    def get(self, key):
+        """
+        读取缓存, 未命中或已过期时返回 ``None``
+        """
+        now = time.time()
+        row = self.connection.execute(
+            'SELECT value, expires FROM cache WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        if row[1] is not None and row[1] < now:
+            self.delete(key)
+            return None
+        self.connection.execute('UPDATE cache SET accessed = ? WHERE key = ?',
+                                (now, key))
+        return pickle.loads(bytes(row[0]))
+
+    def set(self, key, value, ttl=None):
+        """
+        写入缓存, 每写入一定次数就清理过期和超出容量的条目
+        """
+        now = time.time()
+        ttl = ttl or self.ttl
+        expires = now + ttl if ttl else None
+        self.connection.execute(
+            'INSERT OR REPLACE INTO cache (key, value, expires, accessed) '
+            'VALUES (?, ?, ?, ?)',
+            (key, sqlite3.Binary(pickle.dumps(value, 2)), expires, now))
+        self._writes += 1
+        if self._writes % 100 == 0:
+            self.prune()
+
+    def delete(self, key):
+        self.connection.execute('DELETE FROM cache WHERE key = ?', (key,))
+
+    def prune(self):
+        """
+        删除过期条目, 并按最近访问时间淘汰超出 ``maxsize`` 的条目
+        """
+        conn = self.connection
+        conn.execute('DELETE FROM cache WHERE expires < ?', (time.time(),))
+        conn.execute('DELETE FROM cache WHERE key IN (SELECT key FROM cache '
+                     'ORDER BY accessed DESC LIMIT -1 OFFSET ?)',
+                     (self.maxsize,))
+
+    def clear(self):
+        self.connection.execute('DELETE FROM cache')
+
+
+class TableVersions(object):
+    """
+    ..  note:: 按表名计数的版本号
+
+        版本号保存在 ``slots`` 个 8 字节的槽中, 表名按 CRC32 映射到槽,
+        冲突只会多失效一些条目。给定 ``path`` 时映射该文件,
+        同一台机器上的进程读取同一份计数, 递增时加文件锁;
+        否则使用进程内的匿名映射, 只适用于单个进程。
+
+        新建时以随机数初始化, 重建文件后旧版本号的缓存条目不会再被命中。
+
+    """
+
+    def __init__(self, path=None, slots=256):
+        self.path = path
+        self.slots = slots
+        self._lock = threading.Lock()
+        self._file = None
+        size = slots * 8
+        if path is None:
+            self._map = mmap.mmap(-1, size)
+            self._map[:] = os.urandom(size)
+            return
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self._file = open(path, 'a+b')
+        self._flock(True)
+        try:
+            if os.fstat(self._file.fileno()).st_size < size:
+                self._file.truncate(0)
+                self._file.write(os.urandom(size))
+                self._file.flush()
+        finally:
+            self._flock(False)
+        self._map = mmap.mmap(self._file.fileno(), size)
+
+    def _flock(self, lock):
+        if fcntl is not None and self._file is not None:
+            fcntl.flock(self._file.fileno(),
+                        fcntl.LOCK_EX if lock else fcntl.LOCK_UN)
+
+    def _offset(self, name):
+        return (zlib.crc32(name.encode('utf-8')) & 0xffffffff) % self.slots * 8
+
+    def get(self, name):
+        """
+        表的当前版本号
+
+        :rtype: int
+        """
+        return struct.unpack_from('<Q', self._map, self._offset(name))[0]
+
+    def bump(self, *names):
+        """
+        递增表的版本号
+        """
+        with self._lock:
+            self._flock(True)
+            try:
+                for offset in set(self._offset(name) for name in names):
+                    value = struct.unpack_from('<Q', self._map, offset)[0]
+                    struct.pack_into('<Q', self._map, offset,
+                                     (value + 1) & 0xffffffffffffffff)
+            finally:
+                self._flock(False)
+
+
+class CacheRegion(object):
+    """
+    ..  note:: 缓存区域
+
+        由进程内的 ``LRUCache`` 和可选的共享层 (如 ``SQLiteCache``) 组成。
+        读取时先查本地, 再查共享层并回填本地; 写入时两层同时写。
+
+        ``hits`` 与 ``misses`` 记录命中情况, 供统计使用。
+
+    """
+
+    def __init__(self, name, local, shared=None):
+        self.name = name
+        self.local = local
+        self.shared = shared
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        value = self.local.get(key)
+        if value is None and self.shared is not None:
+            value = self.shared.get(key)
+            if value is not None:
+                self.local.set(key, value)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, key, value, ttl=None):
+        self.local.set(key, value, ttl)
+        if self.shared is not None:
+            self.shared.set(key, value, ttl)
+
+    def delete(self, key):
+        self.local.delete(key)
+        if self.shared is not None:
+            self.shared.delete(key)
+
+    def clear(self):
+        self.local.clear()
+        if self.shared is not None:
+            self.shared.clear()
+
+    def stats(self):
+        """
+        命中统计
+
+        :rtype: dict
+        """
+        return {'name': self.name, 'hits': self.hits,
+                'misses': self.misses, 'size': len(self.local)}
+
+
+def make_region(app, name, maxsize, ttl=None):
+    """
+    按配置创建缓存区域, 配置了 ``CACHE_SHARED_DIR`` 时启用共享层
+    """
+    shared = None
+    directory = app.config.get('CACHE_SHARED_DIR')
+    if directory:
+        shared = SQLiteCache(os.path.join(directory, name + '.sqlite'),
+                             ttl=ttl)
+    region = CacheRegion(name, LRUCache(maxsize, ttl), shared)
+    app.extensions.setdefault('cache_regions', {})[name] = region
+    return region
+
+
+def get_region(app, name, maxsize, ttl=None):
+    """
+    获取已创建的缓存区域, 不存在时按配置创建
+    """
+    region = app.extensions.get('cache_regions', {}).get(name)
+    if region is None:
+        region = make_region(app, name, maxsize, ttl)
+    return region
@@ -0,0 +1,109 @@
+# -*- coding:utf-8 -*-
+from collections import defaultdict
+
+from flask import current_app
+from flask_sqlalchemy import Pagination
+from sqlalchemy import func, select
+from . import db, model_cache
+from .engine import run_in_write_transaction
+from .models import CatalogCount, Movie, catalog_facets
+
+
+def totals():
+    """
+    ..  note:: 所有计数
+
+        随 ``movies`` 与 ``catalog_counts`` 表的版本号缓存, 命中时不查询数据库;
+        借阅与归还改变有库存的状态时由 ``Movie.adjust_stock`` 使之失效。
+        还没有校正过时为空。
+
+    :rtype: dict
+    """
+    table = CatalogCount.__table__
+
+    def load():
+        return dict((row.name, row.value) for row in
+                    db.session.execute(select([table.c.name, table.c.value])))
+    return model_cache.list('catalog_counts', [Movie, CatalogCount], load)
+
+
+def total(name):
+    """
+    计数的值, 还没有校正过时为 ``None``
+    """
+    counts = totals()
+    if not counts:
+        return None
+    return counts.get(name, 0)
+
+
+def paginate(query, page, per_page, total):
+    """
+    ..  note:: 使用已知的总数分页
+
+        与 ``error_out=False`` 的 ``paginate`` 相同, 但不执行 ``COUNT``。
+
+    :rtype: flask_sqlalchemy.Pagination
+    """
+    page = max(page, 1)
+    items = query.limit(per_page).offset((page - 1) * per_page).all()
+    return Pagination(query, page, per_page, total, items)
+
+
+def count_catalog():
+    """
+    ..  note:: 从 ``movies`` 表重新统计所有计数
+
+        按 ``(amount > 0, genres)`` 分组, 每组拆分类型后累加。
+
+    :rtype: dict
+    """
+    table = Movie.__table__
+    in_stock = table.c.amount > 0
+    counts = defaultdict(int)
+    rows = db.session.execute(
+        select([in_stock.label('in_stock'), table.c.genres,
+                func.count().label('n')])
+        .group_by(in_stock, table.c.genres))
+    for row in rows:
+        for name in catalog_facets(1 if row.in_stock else 0, row.genres):
+            counts[name] += row.n
+    return dict(counts)
+
+
+def reconcile():
+    """
+    ..  note:: 校正计数表
+
+        批量导入等绕过 ORM 的写入不会更新计数, 由定时任务
+        (``manage.py reconcile_counts``) 调用本函数校正。
+        在一个写事务中重新统计并写入差异, 删除已经不存在的计数名。
+
+    :return: 修正过的计数, ``{计数名: (原值, 新值)}``
+    :rtype: dict
+    """
+    table = CatalogCount.__table__
+
+    def apply():
+        actual = count_catalog()
+        stored = dict((row.name, row.value) for row in
+                      db.session.execute(select([table.c.name, table.c.value])))
+        changes = {}
+        for name, value in actual.items():
+            if name not in stored:
+                db.session.execute(table.insert().values(name=name, value=value))
+            elif stored[name] != value:
+                db.session.execute(table.update().where(table.c.name == name)
+                                   .values(value=value))
+            else:
+                continue
+            changes[name] = (stored.get(name), value)
+        for name in set(stored) - set(actual):
+            db.session.execute(table.delete().where(table.c.name == name))
+            changes[name] = (stored[name], None)
+        return changes
+    changes = run_in_write_transaction(
+        db.session, apply, current_app.config['SQLITE_BUSY_RETRIES'],
+        current_app.config['SQLITE_BUSY_BACKOFF'])
+    model_cache.bump(CatalogCount.__tablename__)
+    return changes
@@ -0,0 +1,137 @@
+# -*- coding:utf-8 -*-
+import os
+import json
+import time
+import threading
+
+
+class DBStats(object):
+    """
+    ..  note:: 按端点统计数据库查询
+
+        每个请求结束时记录查询次数、数据库总耗时以及最慢的语句,
+        按分钟分桶, 只保留最近 ``DB_STATS_WINDOW`` 分钟。
+
+        每隔 ``DB_STATS_FLUSH_INTERVAL`` 秒, 当前进程的统计写入
+        ``DB_STATS_DIR/<pid>.json``, ``merged()`` 合并所有进程的文件,
+        供管理页面和 ``manage.py db_stats`` 使用。
+
+    """
+
+    def __init__(self, app=None):
+        self.buckets = {}
+        self.window = 15
+        self.directory = None
+        self.flush_interval = 30
+        self._flushed = time.time()
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('DB_STATS_WINDOW', 15)
+        app.config.setdefault('DB_STATS_DIR', None)
+        app.config.setdefault('DB_STATS_FLUSH_INTERVAL', 30)
+        self.window = app.config['DB_STATS_WINDOW']
+        self.directory = app.config['DB_STATS_DIR']
+        self.flush_interval = app.config['DB_STATS_FLUSH_INTERVAL']
+        app.extensions['db_stats'] = self
+
+    def record(self, endpoint, queries):
+        """
+        记录一次请求的查询
+        """
+        count = len(queries)
+        total = sum(query.duration for query in queries)
+        slowest = max(queries, key=lambda query: query.duration) \
+            if queries else None
+        minute = int(time.time() // 60)
+        with self._lock:
+            bucket = self.buckets.setdefault(minute, {})
+            stats = bucket.get(endpoint)
+            if stats is None:
+                stats = bucket[endpoint] = [0, 0, 0.0, 0.0, None]
+            stats[0] += 1
+            stats[1] += count
+            stats[2] += total
+            if slowest is not None and slowest.duration > stats[3]:
+                stats[3] = slowest.duration
+                stats[4] = slowest.statement
+            for old in [m for m in self.buckets if m <= minute - self.window]:
+                del self.buckets[old]
+        if self.directory and time.time() - self._flushed > self.flush_interval:
+            self.flush()
+
+    def snapshot(self):
+        """
+        当前进程统计窗口内各端点的汇总
+
+        :rtype: dict
+        """
+        with self._lock:
+            buckets = dict((minute, dict((endpoint, list(stats))
+                                         for endpoint, stats in bucket.items()))
+                           for minute, bucket in self.buckets.items())
+        return _merge([buckets], self.window)
+
+    def flush(self):
+        """
+        把当前进程的统计写入 ``DB_STATS_DIR``
+        """
+        self._flushed = time.time()
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        with self._lock:
+            data = dict((str(minute), bucket)
+                        for minute, bucket in self.buckets.items())
+        path = os.path.join(self.directory, '%d.json' % os.getpid())
+        with open(path + '.tmp', 'w') as f:
+            json.dump(data, f)
+        os.rename(path + '.tmp', path)
+
+    def merged(self):
+        """
+        合并所有进程写入的统计; 未配置 ``DB_STATS_DIR`` 时只返回当前进程的统计
+
+        :rtype: dict
+        """
+        if not self.directory or not os.path.isdir(self.directory):
+            return self.snapshot()
+        if self.buckets:
+            self.flush()
+        sources = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if not name.endswith('.json'):
+                continue
+            if os.path.getmtime(path) < time.time() - self.window * 60:
+                os.remove(path)
+                continue
+            try:
+                with open(path) as f:
+                    sources.append(dict((int(minute), bucket) for minute, bucket
+                                        in json.load(f).items()))
+            except (IOError, ValueError):
+                continue
+        return _merge(sources, self.window)
+
+
+def _merge(sources, window):
+    oldest = int(time.time() // 60) - window
+    result = {}
+    for buckets in sources:
+        for minute, bucket in buckets.items():
+            if minute <= oldest:
+                continue
+            for endpoint, stats in bucket.items():
+                merged = result.setdefault(endpoint, {
+                    'requests': 0, 'queries': 0, 'total_time': 0.0,
+                    'slowest_time': 0.0, 'slowest_statement': None})
+                merged['requests'] += stats[0]
+                merged['queries'] += stats[1]
+                merged['total_time'] += stats[2]
+                if stats[3] > merged['slowest_time']:
+                    merged['slowest_time'] = stats[3]
+                    merged['slowest_statement'] = stats[4]
+    return result
+
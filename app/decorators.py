@@ -1,6 +1,8 @@
 from functools import wraps
-from flask import abort
+from flask import abort, current_app, session
 from flask_login import current_user
+from . import db
+from .engine import run_in_write_transaction
 from .models import Permission
 
 def permission_required(permission):
@@ -24,3 +26,25 @@ def permission_required(permission):
 
 def admin_required(f):
     return permission_required(Permission.ADMINISTER)(f)
+
+
+def write_transaction(f):
+    """
+
+    在短写事务中执行视图并立即提交, 遇到 ``SQLITE_BUSY`` 时重试,
+    次数和退避时间由 ``SQLITE_BUSY_RETRIES`` 与 ``SQLITE_BUSY_BACKOFF`` 决定。
+
+    重试前恢复 flash 消息, 避免同一条消息出现多次。
+
+    """
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        flashes = list(session.get('_flashes', []))
+
+        def restore_flashes():
+            session['_flashes'] = list(flashes)
+        return run_in_write_transaction(
+            db.session, lambda: f(*args, **kwargs),
+            current_app.config['SQLITE_BUSY_RETRIES'],
+            current_app.config['SQLITE_BUSY_BACKOFF'], restore_flashes)
+    return decorated_function
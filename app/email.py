@@ -1,26 +1,259 @@
-from threading import Thread
+import time
+import socket
+import smtplib
+import logging
+import threading
+from datetime import datetime, timedelta
 from flask import current_app, render_template
 from flask_mail import Message
-from . import mail
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from . import mail, db
+from .models import Outbox
 
 
-def send_async_email(app, msg):
+def send_email(to, subject, template, **kwargs):
     """
-    异步发送电子邮件
+    ..  note:: 发送电子邮件
+
+        在渲染 ``.txt`` 和 ``.html`` 模板之后写入 ``outbox`` 表,
+        与当前请求的其他修改一起提交, 提交后唤醒本进程的 ``MailPool`` (如果已启动);
+        否则由 ``manage.py mail_worker`` 在 ``MAIL_POLL_INTERVAL`` 秒内发送。
+
+        进程重启不会丢失邮件, 未发送的邮件会在下次启动后继续发送。
+
+        调用者负责提交: 视图中由 ``SQLALCHEMY_COMMIT_ON_TEARDOWN`` 在请求结束时提交
+        (``auth`` 的注册、重新发送确认、重置密码和修改邮箱), 请求出错时邮件随之丢弃;
+        请求之外 (例如 ``app.reminders``) 需要显式调用 ``db.session.commit()``。
+
+    :rtype: Outbox
     """
-    with app.app_context():
-        mail.send(msg)
+    app = current_app._get_current_object()
+    message = Outbox(recipient=to,
+                     sender=app.config['FLASKY_MAIL_SENDER'],
+                     subject=app.config['FLASKY_MAIL_SUBJECT_PREFIX'] + ' ' + subject,
+                     body=render_template(template + '.txt', **kwargs),
+                     html=render_template(template + '.html', **kwargs))
+    db.session.add(message)
+    db.session.info['outbox_pending'] = True
+    return message
 
 
-def send_email(to, subject, template, **kwargs):
+class MailPool(object):
     """
-    发送电子邮件
+    ..  note:: 发送 ``outbox`` 中邮件的线程池
+
+        线程数量由 ``MAIL_POOL_SIZE`` 限定。每个线程持有一个 SMTP 连接,
+        连续发送多封邮件, 空闲超过 ``MAIL_IDLE_TIMEOUT`` 秒才断开。
+
+        每个线程每次认领 ``MAIL_BATCH_SIZE`` 封到期的邮件。认领时把
+        ``next_attempt_at`` 推迟 ``MAIL_LEASE`` 秒, 其他线程或进程不会重复发送,
+        进程崩溃后租约到期的邮件会被重新认领。
+
+        发送失败按 ``MAIL_RETRY_BACKOFF`` 指数退避重试,
+        超过 ``MAIL_MAX_ATTEMPTS`` 次标记为 ``failed``;
+        SMTP 与网络以外的错误 (例如无法构造的邮件) 不会重试, 直接标记为 ``failed``,
+        同一批中的其他邮件照常发送和提交。
+
+        默认不随 ``create_app`` 启动 (``MAIL_POOL_AUTOSTART`` 为 ``False``),
+        否则 ``manage.py`` 的各个命令、shell 和预先 fork 的主进程都会启动发送线程。
+        由独立的进程发送::
+
+            python manage.py mail_worker
+
+        只处理一次到期的邮件后退出, 可由 cron 调用::
+
+            python manage.py mail_worker --once
+
+        本地测试可以启动调试 SMTP 服务器::
+
+            python -m smtpd -n -c DebuggingServer localhost:1025
+
     """
-    app = current_app._get_current_object()
-    msg = Message(app.config['FLASKY_MAIL_SUBJECT_PREFIX'] + ' ' + subject,
-                  sender=app.config['FLASKY_MAIL_SENDER'], recipients=[to])
-    msg.body = render_template(template + '.txt', **kwargs)
-    msg.html = render_template(template + '.html', **kwargs)
-    thr = Thread(target=send_async_email, args=[app, msg])
-    thr.start()
-    return thr
+
+    def __init__(self, app=None):
+        self.threads = []
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('MAIL_POOL_SIZE', 2)
+        app.config.setdefault('MAIL_POOL_AUTOSTART', False)
+        app.config.setdefault('MAIL_BATCH_SIZE', 20)
+        app.config.setdefault('MAIL_LEASE', 300)
+        app.config.setdefault('MAIL_MAX_ATTEMPTS', 5)
+        app.config.setdefault('MAIL_RETRY_BACKOFF', 30)
+        app.config.setdefault('MAIL_RETRY_BACKOFF_MAX', 3600)
+        app.config.setdefault('MAIL_POLL_INTERVAL', 5)
+        app.config.setdefault('MAIL_IDLE_TIMEOUT', 30)
+        if app.config['MAIL_POOL_AUTOSTART']:
+            self.start(app)
+
+    def start(self, app, size=None):
+        """
+        启动发送线程
+        """
+        self._stopping.clear()
+        for _ in range(size or app.config['MAIL_POOL_SIZE']):
+            thread = threading.Thread(target=self._run, args=[app])
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self, timeout=None):
+        """
+        通知发送线程退出并等待其结束
+        """
+        self._stopping.set()
+        self._wakeup.set()
+        for thread in self.threads:
+            thread.join(timeout)
+        self.threads = []
+
+    def wake(self):
+        self._wakeup.set()
+
+    def drain(self, app):
+        """
+        在当前线程中发送所有到期的邮件, 返回发送成功的数量
+        """
+        sent = 0
+        with app.app_context():
+            connection = None
+            try:
+                while True:
+                    messages = self.claim(app)
+                    if not messages:
+                        break
+                    connection, count = self.deliver(app, connection, messages)
+                    sent += count
+            finally:
+                self._close(connection)
+                db.session.remove()
+        return sent
+
+    def claim(self, app):
+        """
+        认领一批到期的邮件
+
+        :rtype: list
+        """
+        now = datetime.now()
+        lease = now + timedelta(seconds=app.config['MAIL_LEASE'])
+        candidates = [row.id for row in db.session.query(Outbox.id).filter(
+            Outbox.status.in_(['pending', 'sending']),
+            Outbox.next_attempt_at <= now).order_by(
+            Outbox.next_attempt_at).limit(app.config['MAIL_BATCH_SIZE'])]
+        claimed = []
+        for id in candidates:
+            updated = Outbox.query.filter(
+                Outbox.id == id,
+                Outbox.status.in_(['pending', 'sending']),
+                Outbox.next_attempt_at <= now).update(
+                {'status': 'sending', 'next_attempt_at': lease},
+                synchronize_session=False)
+            if updated:
+                claimed.append(id)
+        db.session.commit()
+        if not claimed:
+            return []
+        return Outbox.query.filter(Outbox.id.in_(claimed)).all()
+
+    def deliver(self, app, connection, messages):
+        """
+        使用 ``connection`` 依次发送 ``messages``, 连接断开时重新连接
+
+        :rtype: tuple
+        """
+        sent = 0
+        for message in messages:
+            try:
+                if connection is None:
+                    connection = mail.connect().__enter__()
+                connection.send(Message(message.subject,
+                                        sender=message.sender,
+                                        recipients=[message.recipient],
+                                        body=message.body,
+                                        html=message.html))
+            except (smtplib.SMTPException, socket.error) as ex:
+                if isinstance(ex, (smtplib.SMTPServerDisconnected, socket.error)):
+                    self._close(connection)
+                    connection = None
+                self._retry(app, message, ex)
+            except Exception as ex:
+                logging.exception('FAIL sending mail %s to %s'
+                                  % (message.id, message.recipient))
+                self._close(connection)
+                connection = None
+                message.status = 'failed'
+                message.last_error = repr(ex)
+            else:
+                message.status = 'sent'
+                message.sent_at = datetime.now()
+                message.last_error = None
+                sent += 1
+            message.attempts += 1
+            db.session.add(message)
+        db.session.commit()
+        return connection, sent
+
+    def _retry(self, app, message, error):
+        logging.warning('FAIL sending mail %s to %s: %s'
+                        % (message.id, message.recipient, error))
+        message.last_error = str(error)
+        if message.attempts + 1 >= app.config['MAIL_MAX_ATTEMPTS']:
+            message.status = 'failed'
+            return
+        delay = min(app.config['MAIL_RETRY_BACKOFF'] * 2 ** message.attempts,
+                    app.config['MAIL_RETRY_BACKOFF_MAX'])
+        message.status = 'pending'
+        message.next_attempt_at = datetime.now() + timedelta(seconds=delay)
+
+    @staticmethod
+    def _close(connection):
+        if connection is None or connection.host is None:
+            return
+        try:
+            connection.__exit__(None, None, None)
+        except (smtplib.SMTPException, socket.error):
+            pass
+
+    def _run(self, app):
+        with app.app_context():
+            connection = None
+            idle_since = time.time()
+            while not self._stopping.is_set():
+                try:
+                    messages = self.claim(app)
+                    if messages:
+                        connection, _ = self.deliver(app, connection, messages)
+                        idle_since = time.time()
+                        continue
+                except Exception:
+                    logging.exception('FAIL draining outbox')
+                    db.session.rollback()
+                finally:
+                    db.session.remove()
+                if connection is not None and \
+                        time.time() - idle_since > app.config['MAIL_IDLE_TIMEOUT']:
+                    self._close(connection)
+                    connection = None
+                self._wakeup.wait(app.config['MAIL_POLL_INTERVAL'])
+                self._wakeup.clear()
+            self._close(connection)
+
+
+mail_pool = MailPool()
+
+
+@event.listens_for(Session, 'after_commit')
+def _wake_mail_pool(session):
+    if session.info.pop('outbox_pending', False):
+        mail_pool.wake()
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_outbox(session):
+    session.info.pop('outbox_pending', None)
@@ -0,0 +1,214 @@
+# -*- coding:utf-8 -*-
+import time
+import random
+import sqlite3
+import threading
+
+import flask_sqlalchemy
+from flask import current_app, request, session as cookie_session
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql.dml import UpdateBase
+
+REPLICA = 'replica'
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+SQLITE_PRAGMAS = [
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('foreign_keys', 'ON'),
+    ('busy_timeout', 5000),
+    ('cache_size', -64000),
+    ('mmap_size', 268435456),
+    ('temp_store', 'MEMORY'),
+]
+
+_local = threading.local()
+
+
+class _EngineConnector(flask_sqlalchemy._EngineConnector):
+
+    def __init__(self, sa, app, bind=None):
+        flask_sqlalchemy._EngineConnector.__init__(self, sa, app, bind)
+        self._configured = None
+        self._configure_lock = threading.Lock()
+
+    def get_engine(self):
+        engine = flask_sqlalchemy._EngineConnector.get_engine(self)
+        if engine is not self._configured:
+            with self._configure_lock:
+                if engine is not self._configured:
+                    configure_engine(self._app, engine, self._bind)
+                    self._configured = engine
+        return engine
+
+
+class RoutingSession(flask_sqlalchemy.SignallingSession):
+    """
+    ..  note:: 读写分离的会话
+
+        ``info['db_replica']`` 为真时, 查询使用只读副本; flush 以及
+        ``INSERT``/``UPDATE``/``DELETE`` 语句把会话固定到主库,
+        之后同一会话的所有语句都在主库执行。
+
+    """
+
+    def get_bind(self, mapper=None, clause=None):
+        if self.info.get('db_replica') and not self.info.get('db_primary'):
+            if not self._flushing and not isinstance(clause, UpdateBase):
+                state = flask_sqlalchemy.get_state(self.app)
+                return state.db.get_engine(self.app, bind=REPLICA)
+            self.info['db_primary'] = True
+            self.info['db_wrote'] = True
+        return flask_sqlalchemy.SignallingSession.get_bind(self, mapper, clause)
+
+
+class SQLAlchemy(flask_sqlalchemy.SQLAlchemy):
+    """
+    ..  note:: 针对 SQLite 调整的 ``SQLAlchemy``
+
+        * 设置了 ``SQLALCHEMY_POOL_SIZE`` 时使用 ``QueuePool`` 复用连接,
+          否则与 Flask-SQLAlchemy 一样使用 ``NullPool``;
+        * 每个新连接执行 ``SQLITE_PRAGMAS``: WAL 日志模式下读不会被写阻塞,
+          ``busy_timeout`` 让写入者等待锁而不是立即失败;
+        * 普通事务保留 ``sqlite3`` 模块的延迟 ``BEGIN``: 第一条写语句之前才开始事务,
+          之前的查询不持有读快照, 读取后其他连接提交了修改, 再写入时也只是等待写锁,
+          不会出现无法等待的 ``SQLITE_BUSY``;
+        * ``write_transaction`` 中的事务由 SQLAlchemy 发出 ``BEGIN IMMEDIATE``,
+          开始时就取得写锁, 事务中的读取和写入基于同一个快照。
+
+        其他数据库不受影响。
+
+        设置 ``DATABASE_READ_URL`` 后, 它作为 ``replica`` 绑定注册。
+        ``GET``/``HEAD``/``OPTIONS`` 请求的查询使用副本, 以下情况使用主库:
+
+        * 请求方法会修改数据, 或端点在 ``DATABASE_PRIMARY_ENDPOINTS`` 中;
+        * 会话已经写入 (``RoutingSession``) 或处于 ``write_transaction`` 中;
+        * 当前用户在 ``DATABASE_READ_PIN`` 秒内写入过数据,
+          保证用户立即看到自己的修改, 例如借阅后打开个人页面;
+        * 请求之外的代码, 例如命令行和发送邮件的线程。
+
+        副本是 SQLite 时连接设置 ``query_only``, 误写会直接报错。
+
+    """
+
+    def init_app(self, app):
+        app.config.setdefault('SQLITE_PRAGMAS', SQLITE_PRAGMAS)
+        app.config.setdefault('SQLITE_BUSY_RETRIES', 5)
+        app.config.setdefault('SQLITE_BUSY_BACKOFF', 0.05)
+        app.config.setdefault('DATABASE_READ_URL', None)
+        app.config.setdefault('DATABASE_READ_PIN', 10)
+        app.config.setdefault('DATABASE_PRIMARY_ENDPOINTS', [])
+        if app.config['DATABASE_READ_URL']:
+            binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+            binds[REPLICA] = app.config['DATABASE_READ_URL']
+            app.config['SQLALCHEMY_BINDS'] = binds
+            app.before_request(self._route_reads)
+            app.after_request(self._pin_primary)
+        flask_sqlalchemy.SQLAlchemy.init_app(self, app)
+
+    def create_session(self, options):
+        return RoutingSession(self, **options)
+
+    def _route_reads(self):
+        config = current_app.config
+        if request.method in SAFE_METHODS and \
+                request.endpoint not in config['DATABASE_PRIMARY_ENDPOINTS'] and \
+                cookie_session.get('_db_primary_until', 0) < time.time():
+            self.session.info['db_replica'] = True
+
+    def _pin_primary(self, response):
+        wrote = self.session.registry.has() and \
+            self.session.info.get('db_wrote')
+        if wrote or request.method not in SAFE_METHODS:
+            cookie_session['_db_primary_until'] = \
+                time.time() + current_app.config['DATABASE_READ_PIN']
+        return response
+
+    def make_connector(self, app, bind=None):
+        return _EngineConnector(self, app, bind)
+
+    def apply_driver_hacks(self, app, info, options):
+        flask_sqlalchemy.SQLAlchemy.apply_driver_hacks(self, app, info, options)
+        if info.drivername != 'sqlite' or \
+                info.database in (None, '', ':memory:'):
+            return
+        if options.get('pool_size'):
+            options['poolclass'] = QueuePool
+            options.setdefault('connect_args', {})['check_same_thread'] = False
+
+
+def configure_engine(app, engine, bind=None):
+    """
+    为 SQLite 引擎注册连接与事务事件
+    """
+    if engine.dialect.name != 'sqlite':
+        return
+    pragmas = list(app.config['SQLITE_PRAGMAS'])
+    if bind == REPLICA:
+        pragmas.append(('query_only', 'ON'))
+
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas:
+            cursor.execute('PRAGMA %s = %s' % (name, value))
+        cursor.close()
+
+    @event.listens_for(engine, 'begin')
+    def begin(connection):
+        dbapi_connection = connection.connection.connection
+        if getattr(_local, 'immediate', False):
+            # 关闭 sqlite3 模块自己的事务管理, 开始时就取得写锁
+            dbapi_connection.isolation_level = None
+            connection.execute('BEGIN IMMEDIATE')
+        else:
+            # 由 sqlite3 模块在第一条写语句之前发出 BEGIN
+            dbapi_connection.isolation_level = ''
+
+
+def is_busy(error):
+    """
+    判断是否为 SQLite 的锁冲突
+
+    :rtype: bool
+    """
+    if not isinstance(error, OperationalError):
+        return False
+    if not isinstance(error.orig, sqlite3.OperationalError):
+        return False
+    message = str(error.orig)
+    return 'locked' in message or 'busy' in message
+
+
+def run_in_write_transaction(session, f, retries, backoff, before_retry=None):
+    """
+    ..  note:: 在短写事务中执行 ``f`` 并提交
+
+        先结束会话中已开始的读事务, 再以 ``BEGIN IMMEDIATE`` 开始写事务,
+        会话固定到主库。
+        遇到 ``SQLITE_BUSY`` 时回滚, 按 ``backoff`` 指数退避加随机抖动后重试,
+        最多 ``retries`` 次; 重试前调用 ``before_retry``。
+
+    """
+    session.commit()
+    session.info['db_primary'] = True
+    session.info['db_wrote'] = True
+    attempt = 0
+    while True:
+        _local.immediate = True
+        try:
+            result = f()
+            session.commit()
+            return result
+        except OperationalError as ex:
+            session.rollback()
+            if not is_busy(ex) or attempt >= retries:
+                raise
+            attempt += 1
+            if before_retry is not None:
+                before_retry()
+            time.sleep(backoff * 2 ** attempt * random.random())
+        finally:
+            _local.immediate = False
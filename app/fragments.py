@@ -0,0 +1,161 @@
+# -*- coding:utf-8 -*-
+import hashlib
+from functools import wraps
+
+from flask import current_app, g, request, session
+from flask_login import current_user
+from jinja2 import Markup
+from .cache import make_region
+from .snapshot import CATALOG_COLUMNS
+
+FRAGMENTS = 'fragments'
+PAGES = 'pages'
+
+
+def movie_version(movie):
+    """
+    ..  note:: 影片目录字段的摘要
+
+        ``Movie`` 与快照中的 ``MovieRow`` 字段相同时摘要相同,
+        修改了任一字段后摘要改变, 旧的片段不会再被命中。
+
+    :rtype: str
+    """
+    values = tuple(getattr(movie, name, None) for name in CATALOG_COLUMNS)
+    return hashlib.sha1(repr(values).encode('utf-8')).hexdigest()[:16]
+
+
+class TemplateCache(object):
+    """
+    ..  note:: 模板片段与整页缓存
+
+        * 片段: 模板中的 ``movie_fragment(模板名, movie)`` 渲染一部影片的卡片,
+          键为影片 id 与 ``movie_version``, 影片修改后自动失效;
+          片段只能使用 ``movie`` 和 ``url_for``, 与当前用户无关的部分才放在片段中。
+        * 整页: ``cached_page`` 装饰的视图对匿名用户的 ``GET`` 请求缓存整个页面,
+          键为完整路径与目录的版本: 发布了快照并且之后没有修改时为快照的一代,
+          否则为 ``movies`` 表的版本号 (``ModelCache``)。
+          有待显示的闪现消息时不使用缓存。
+
+        两个区域按 ``CACHE_SHARED_DIR`` 在进程之间共享。模板修改后部署时调用
+        ``invalidate`` (``manage.py clear_template_cache``) 使全部条目失效,
+        计数保存在 ``ModelCache`` 的版本号文件中, 所有进程同时生效。
+
+        响应头 ``PAGE_CACHE_HEADER`` 为整页缓存的结果 (``HIT``/``MISS``/``BYPASS``),
+        ``FRAGMENT_CACHE_HEADER`` 为本次请求片段的命中与未命中次数。
+
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('FRAGMENT_CACHE_SIZE', 10000)
+        app.config.setdefault('FRAGMENT_CACHE_TTL', 3600)
+        app.config.setdefault('PAGE_CACHE_SIZE', 1000)
+        app.config.setdefault('PAGE_CACHE_TTL', 300)
+        app.config.setdefault('PAGE_CACHE_HEADER', 'X-Page-Cache')
+        app.config.setdefault('FRAGMENT_CACHE_HEADER', 'X-Fragment-Cache')
+        app.extensions['template_cache'] = (
+            make_region(app, FRAGMENTS, app.config['FRAGMENT_CACHE_SIZE'],
+                        app.config['FRAGMENT_CACHE_TTL']),
+            make_region(app, PAGES, app.config['PAGE_CACHE_SIZE'],
+                        app.config['PAGE_CACHE_TTL']))
+        app.jinja_env.globals['movie_fragment'] = self.movie_fragment
+        app.after_request(self._set_headers)
+
+    @property
+    def fragments(self):
+        return current_app.extensions['template_cache'][0]
+
+    @property
+    def pages(self):
+        return current_app.extensions['template_cache'][1]
+
+    def _versions(self):
+        return current_app.extensions['model_cache'][1]
+
+    def invalidate(self, fragments=True, pages=True):
+        """
+        使片段或整页的所有条目失效
+        """
+        names = [name for name, flag in ((FRAGMENTS, fragments), (PAGES, pages))
+                 if flag]
+        if names:
+            self._versions().bump(*names)
+
+    def movie_fragment(self, template, movie):
+        """
+        ..  note:: 渲染影片片段
+
+            未命中时用 ``template`` 渲染, 模板中只有 ``movie`` 一个变量。
+
+        :rtype: jinja2.Markup
+        """
+        key = '%s:%d:%s@%d' % (template, movie.id, movie_version(movie),
+                               self._versions().get(FRAGMENTS))
+        region = self.fragments
+        html = region.get(key)
+        counts = g.setdefault('fragment_cache', [0, 0])
+        if html is None:
+            counts[1] += 1
+            html = current_app.jinja_env.get_template(template).render(movie=movie)
+            region.set(key, html)
+        else:
+            counts[0] += 1
+        return Markup(html)
+
+    def catalog_generation(self):
+        """
+        目录当前的版本
+        """
+        from . import catalog
+        snapshot = catalog.current()
+        if snapshot is not None and not snapshot.outdated():
+            return snapshot.generation
+        return 'db%d' % self._versions().get('movies')
+
+    def _cacheable(self):
+        return request.method == 'GET' and \
+            not current_user.is_authenticated and \
+            not session.get('_flashes')
+
+    def cached_page(self, name):
+        """
+        ..  note:: 缓存匿名用户看到的整个页面
+
+            只缓存状态码为 200 的响应。
+
+        """
+        def decorator(f):
+            @wraps(f)
+            def decorated(*args, **kwargs):
+                if not self._cacheable():
+                    g.page_cache = 'BYPASS'
+                    return f(*args, **kwargs)
+                key = '%s:%s@%s.%d' % (name, request.full_path,
+                                       self.catalog_generation(),
+                                       self._versions().get(PAGES))
+                region = self.pages
+                body = region.get(key)
+                if body is not None:
+                    g.page_cache = 'HIT'
+                    return current_app.response_class(body, mimetype='text/html')
+                response = current_app.make_response(f(*args, **kwargs))
+                if response.status_code == 200:
+                    region.set(key, response.get_data(as_text=True))
+                g.page_cache = 'MISS'
+                return response
+            return decorated
+        return decorator
+
+    def _set_headers(self, response):
+        status = g.get('page_cache')
+        if status is not None:
+            response.headers[current_app.config['PAGE_CACHE_HEADER']] = status
+        counts = g.get('fragment_cache')
+        if counts is not None:
+            response.headers[current_app.config['FRAGMENT_CACHE_HEADER']] = \
+                'hits=%d; misses=%d' % tuple(counts)
+        return response
@@ -1,4 +1,5 @@
-from flask import render_template, request, jsonify
+from flask import render_template, request, jsonify, flash, redirect, url_for
+from sqlalchemy.orm.exc import StaleDataError
 from . import main
 
 @main.app_errorhandler(403)
@@ -38,3 +39,17 @@ def internal_server_error(e):
         response.status_code = 500
         return response
     return render_template('500.html'), 500
+
+
+@main.app_errorhandler(StaleDataError)
+def stale_data(e):
+    """
+    处理乐观并发控制的冲突: 保存时记录已被其他请求修改
+    """
+    if request.accept_mimetypes.accept_json and \
+            not request.accept_mimetypes.accept_html:
+        response = jsonify({'error': 'conflict'})
+        response.status_code = 409
+        return response
+    flash('保存失败: 记录已被其他人修改, 请刷新后重试。')
+    return redirect(url_for('main.index'))
@@ -2,6 +2,7 @@
 
 from flask_wtf import FlaskForm
 from wtforms import StringField, SubmitField, IntegerField, FloatField, validators
+from wtforms.widgets import HiddenInput
 from wtforms.validators import Required, Length
 
 
@@ -20,6 +21,10 @@ class EditMovieForm(FlaskForm):
     alt = StringField('豆瓣链接', validators=[Length(0,64)])
     amount = IntegerField('库存')
     counts = IntegerField('借阅次数')
+    # 打开表单时的版本号与库存, 保存时检查冲突并按增量修改库存
+    version = IntegerField(widget=HiddenInput())
+    base_amount = IntegerField(widget=HiddenInput())
+    base_counts = IntegerField(widget=HiddenInput())
     submit = SubmitField('提交')
 
 
@@ -1,22 +1,77 @@
 # -*- coding:utf-8 -*-
-from flask import abort,request, render_template, session,flash, redirect, url_for, current_app
-from .. import db
-from ..models import User, Movie, Record,Permission
-from ..email import send_email
+from flask import abort,request, render_template, flash, redirect, url_for, current_app
+from flask_sqlalchemy import get_debug_queries
+from .. import catalog, db, db_stats, metrics, model_cache, template_cache
+from .. import search as search_index
+from ..models import User, Movie, Permission, TOTAL_MOVIES
+from ..counts import total as catalog_total
+from ..rows import MovieItem
+from ..similar import update_movie
 from . import main
 from flask_login import login_required, current_user
-from ..decorators import admin_required, permission_required
+from ..decorators import admin_required, permission_required, write_transaction
 from .forms import EditMovieForm, AddMovieForm, SearchForm
 
+@main.after_app_request
+def after_request(response):
+    """
+    ..  note:: 记录数据库查询
+
+        耗时超过 ``FLASKY_SLOW_DB_QUERY_TIME`` 的语句连同端点、参数一起写入日志,
+        单个请求的数据库总耗时超过 ``FLASKY_DB_QUERY_TIMEOUT`` 时同样记录。
+
+        所有请求的查询次数、总耗时和最慢语句按端点汇总到 ``db_stats``。
+
+    """
+    queries = get_debug_queries()
+    endpoint = request.endpoint or 'unknown'
+    for query in queries:
+        if query.duration >= current_app.config['FLASKY_SLOW_DB_QUERY_TIME']:
+            current_app.logger.warning(
+                'Slow query: %s\nParameters: %s\nDuration: %fs\nEndpoint: %s\nContext: %s\n'
+                % (query.statement, query.parameters, query.duration,
+                   endpoint, query.context))
+    total = sum(query.duration for query in queries)
+    if total >= current_app.config['FLASKY_DB_QUERY_TIMEOUT']:
+        current_app.logger.warning(
+            'Slow request: %s spent %fs in %d queries'
+            % (endpoint, total, len(queries)))
+    db_stats.record(endpoint, queries)
+    return response
+
+@main.route('/db-stats')
+@login_required
+@admin_required
+def db_statistics():
+    """
+    各端点的数据库查询统计
+    """
+    stats = sorted(db_stats.merged().items(),
+                   key=lambda item: item[1]['total_time'], reverse=True)
+    return render_template('db-stats.html', stats=stats,
+                           window=current_app.config['DB_STATS_WINDOW'])
+
 @main.route('/', methods=['GET', 'POST'])
+@template_cache.cached_page('index')
 def index():
     """
     根地址
+
+    发布了目录快照并且之后没有修改时从快照分页, 能修改影片的用户总是查询数据库。
+    匿名用户的页面整页缓存。
     """
     page = request.args.get('page',1,type=int)
-    pagination = Movie.query.order_by(Movie.rating.desc()).paginate(
-            page,per_page=current_app.config['FLASKY_POSTS_PER_PAGE'],
-            error_out=False)
+    pagination = None
+    if not current_user.can(Permission.MODERATE_MOVIE):
+        snapshot = catalog.current()
+        if snapshot is not None:
+            pagination = snapshot.paginate(
+                'rating', page, current_app.config['FLASKY_POSTS_PER_PAGE'])
+    if pagination is None:
+        pagination = model_cache.paginate(
+            'index', Movie, Movie.query.order_by(Movie.rating.desc()),
+            page, current_app.config['FLASKY_POSTS_PER_PAGE'],
+            catalog_total(TOTAL_MOVIES), factory=MovieItem)
     movies = pagination.items
     return render_template('index.html', movies=movies, pagination=pagination)
 
@@ -41,25 +96,31 @@ def movie(id):
     """
     电影主页
     """
-    movie = Movie.query.filter_by(id=id).first()
+    movie = model_cache.get(Movie, id)
     if movie is None:
         abort(404)
-    return render_template('movie.html', movie=movie)
+    return render_template('movie.html', movie=movie,
+                           similar_movies=movie.similar_movies)
 
 @main.route('/borrow/<id>')
 @login_required
 @permission_required(Permission.BORROW)
+@write_transaction
 def borrow(id):
     """
     借阅电影
     """
-    movie = Movie.query.filter_by(id=id).first()
+    movie = model_cache.get(Movie, id)
     if movie is None:
+        metrics.loan('borrow', 'not_found')
         flash('该影片不存在！')
         return redirect(url_for('.index'))
     if current_user.is_borrowing(movie):
+        metrics.loan('borrow', 'already_borrowed')
         flash('您已经借阅《%s》！' % movie.title)
         return redirect(url_for('.movie', id=movie.id))
+    metrics.loan('borrow', 'ok' if movie.can() and current_user.can_borrow()
+                 else 'unavailable')
     current_user.borrow(movie, current_user)
     flash('恭喜你！成功借阅《%s》！' % movie.title)
     return redirect(url_for('.movie', id=movie.id))
@@ -67,17 +128,21 @@ def borrow(id):
 @main.route('/return/<id>')
 @login_required
 @permission_required(Permission.RETURN)
+@write_transaction
 def return_movie(id):
     """
     归还电影
     """
-    movie = Movie.query.filter_by(id=id).first()
+    movie = model_cache.get(Movie, id)
     if movie is None:
+        metrics.loan('return', 'not_found')
         flash('该影片不存在！')
         return redirect(url_for('.movie'))
     if not current_user.is_borrowing(movie):
+        metrics.loan('return', 'not_borrowed')
         flash('您还没有借阅过该影片！')
         return redirect(url_for('.movie', id=id))
+    metrics.loan('return', 'ok')
     current_user.return_movie(movie)
     flash('您已经归还《%s》！' % movie.title)
     return redirect(url_for('.movie', id=id))
@@ -85,13 +150,32 @@ def return_movie(id):
 @main.route('/edit-movie/<id>', methods=['GET', 'POST'])
 @login_required
 @admin_required
+@write_transaction
 def edit_movie(id):
     """
     修改电影信息
+
+    表单带有打开时的版本号, 期间影片信息被其他管理员修改过时不保存,
+    保留填写的内容并列出当前信息, 由管理员核对后重新提交。
+    库存和借阅次数按表单中的增量修改, 编辑期间的借阅与归还不会被覆盖。
     """
-    movie = Movie.query.get_or_404(id)
+    movie = model_cache.get_or_404(Movie, id)
     form = EditMovieForm(movie=movie)
     if form.validate_on_submit():
+        amount = form.amount.data - form.base_amount.data
+        counts = form.counts.data - form.base_counts.data
+        if form.version.data != movie.version:
+            flash('其他管理员在您编辑期间修改了该影片, 请对照下方的当前信息核对后重新提交。')
+            for field, value in ((form.version, movie.version),
+                                 (form.base_amount, movie.amount),
+                                 (form.base_counts, movie.counts),
+                                 (form.amount, movie.amount + amount),
+                                 (form.counts, movie.counts + counts)):
+                # 数字字段优先显示提交的原值, 清除后才显示当前的值
+                field.data = value
+                field.raw_data = None
+            return render_template('edit-movie.html', form=form, movie=movie,
+                                   conflict=True)
         movie.title = form.title.data
         movie.original_title = form.original_title.data
         movie.directors = form.directors.data
@@ -101,9 +185,9 @@ def edit_movie(id):
         movie.rating = form.rating.data
         movie.images = form.images.data
         movie.alt = form.alt.data
-        movie.amount = form.amount.data
-        movie.counts = form.counts.data
+        movie.adjust_stock(amount=amount, counts=counts)
         db.session.add(movie)
+        update_movie(movie)
         return redirect(url_for('.movie',id=movie.id))
     form.title.data = movie.title
     form.original_title.data = movie.original_title
@@ -116,6 +200,9 @@ def edit_movie(id):
     form.alt.data = movie.alt
     form.amount.data = movie.amount
     form.counts.data = movie.counts
+    form.version.data = movie.version
+    form.base_amount.data = movie.amount
+    form.base_counts.data = movie.counts
     return render_template('edit-movie.html', form=form, movie=movie)
 
 @main.route('/search', methods=['GET', 'POST'])
@@ -126,17 +213,22 @@ def search():
     """
     form = SearchForm()
     if form.validate_on_submit():
+        return redirect(url_for('.search', q=form.search.data))
+    q = request.args.get('q')
+    if q:
         page = request.args.get('page',1,type=int)
-        pagination = Movie.query.whoosh_search(form.search.data).paginate(
-                page,per_page=current_app.config['FLASKY_POSTS_PER_PAGE'],
-                error_out=False)
+        pagination = search_index.search_page(Movie, q, page,
+                per_page=current_app.config['FLASKY_POSTS_PER_PAGE'],
+                load=lambda ids: model_cache.rows(Movie, ids, MovieItem))
         movies = pagination.items
-        return render_template('search-result.html', movies=movies, pagination=pagination)
+        return render_template('search-result.html', movies=movies,
+                               pagination=pagination, q=q)
     return render_template('search.html', form=form)
 
 @main.route('/add-movie', methods=['GET', 'POST'])
 @login_required
 @admin_required
+@write_transaction
 def add_movie():
     """
     增加电影
@@ -156,17 +248,19 @@ def add_movie():
                  )
         db.session.add(movie)
         db.session.commit()
+        update_movie(movie)
         return redirect(url_for('.movie',id=movie.id))
     return render_template('add-movie.html', form=form)
 
 @main.route('/delete-movie/<id>', methods=['GET', 'POST'])
 @login_required
 @admin_required
+@write_transaction
 def delete_movie(id):
     """
     删除电影
     """
-    movie = Movie.query.filter_by(id=id).first()
+    movie = model_cache.get(Movie, id)
     if movie is None:
         flash('该影片不存在！')
         return redirect(url_for('.index'))
@@ -0,0 +1,176 @@
+# -*- coding:utf-8 -*-
+import os
+from timeit import default_timer
+from flask import Response, current_app, g, request
+from flask_login import current_user
+from flask_sqlalchemy import get_debug_queries
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+
+class Metrics(object):
+    """
+    ..  note:: Prometheus 指标
+
+        以文本格式在 ``/metrics`` 输出:
+
+        * ``flask_request_duration_seconds``: 按端点 (``main.*``, ``auth.*``,
+          ``api.*``) 统计的请求耗时直方图;
+        * ``flask_requests_total``: 按端点和状态码统计的请求数;
+        * ``flask_requests_in_progress``: 正在处理的请求数;
+        * ``flask_request_db_seconds``: 每个请求的数据库耗时;
+        * ``search_duration_seconds``: 搜索耗时, 按后端和是否命中缓存区分;
+        * ``loans_total``: 借阅、归还的结果, 在会话提交后才计数,
+          ``write_transaction`` 重试时不会重复计数。
+
+        端点标签取自 ``request.endpoint``, 未匹配路由的请求记为 ``unknown``,
+        不会因为 URL 不同而产生大量时间序列。
+
+        设置 ``METRICS_DIR`` 后使用 ``prometheus_client`` 的多进程模式,
+        每个进程把计数写入该目录下的 mmap 文件, ``/metrics`` 汇总所有进程。
+        该目录需要在启动前清空, 进程退出时调用 ``process_dead``,
+        例如 gunicorn 的 ``child_exit`` 钩子::
+
+            def child_exit(server, worker):
+                from app import metrics
+                metrics.process_dead(worker.pid)
+
+        记录一次请求只是几次带锁的计数器加法, 开销在微秒级。
+
+        ``/metrics`` 只允许管理员, 或者直接来自 ``METRICS_ALLOWED_ADDRS``
+        (默认只有本机) 的请求访问; 经过反向代理 (带有 ``X-Forwarded-For``)
+        的匿名请求一律拒绝。
+
+    """
+
+    def __init__(self, app=None):
+        self.registry = None
+        self.multiprocess = False
+        self.latency = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('METRICS_DIR', None)
+        app.config.setdefault('METRICS_BUCKETS', LATENCY_BUCKETS)
+        app.config.setdefault('METRICS_ALLOWED_ADDRS', ['127.0.0.1', '::1'])
+        if self.latency is None:
+            self._create(app)
+            event.listen(Session, 'after_commit', self._after_commit)
+            event.listen(Session, 'after_rollback', self._after_rollback)
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        app.teardown_request(self._teardown_request)
+        app.add_url_rule('/metrics', 'metrics', self.expose)
+        app.extensions['metrics'] = self
+
+    def _create(self, app):
+        directory = app.config['METRICS_DIR']
+        if directory:
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+            # 必须在导入 prometheus_client 之前设置, 决定计数器是否写入 mmap 文件
+            os.environ['prometheus_multiproc_dir'] = directory
+            self.multiprocess = True
+        from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram
+        registry = None if self.multiprocess else CollectorRegistry()
+        buckets = app.config['METRICS_BUCKETS']
+        self.registry = registry
+        self.latency = Histogram(
+            'flask_request_duration_seconds', 'Request latency in seconds',
+            ['method', 'endpoint'], buckets=buckets, registry=registry)
+        self.requests = Counter(
+            'flask_requests_total', 'Requests by status code',
+            ['method', 'endpoint', 'status'], registry=registry)
+        self.in_progress = Gauge(
+            'flask_requests_in_progress', 'Requests being handled',
+            multiprocess_mode='livesum', registry=registry)
+        self.db_time = Histogram(
+            'flask_request_db_seconds', 'Database time per request in seconds',
+            ['endpoint'], buckets=buckets, registry=registry)
+        self.search_time = Histogram(
+            'search_duration_seconds', 'Search time in seconds',
+            ['backend', 'cached'], buckets=buckets, registry=registry)
+        self.loans = Counter(
+            'loans_total', 'Borrow and return outcomes',
+            ['action', 'outcome'], registry=registry)
+
+    def _before_request(self):
+        g._metrics_start = default_timer()
+        self.in_progress.inc()
+
+    def _after_request(self, response):
+        self._observe(response.status_code)
+        return response
+
+    def _teardown_request(self, exception):
+        # 未处理的异常不会经过 after_request
+        self._observe(500)
+
+    def _observe(self, status):
+        start = g.pop('_metrics_start', None)
+        if start is None:
+            return
+        self.in_progress.dec()
+        endpoint = request.endpoint or 'unknown'
+        self.latency.labels(request.method, endpoint) \
+            .observe(default_timer() - start)
+        self.requests.labels(request.method, endpoint, str(status)).inc()
+        queries = get_debug_queries()
+        if queries:
+            self.db_time.labels(endpoint) \
+                .observe(sum(query.duration for query in queries))
+
+    def observe_search(self, backend, seconds, cached):
+        """
+        记录一次搜索的耗时
+        """
+        self.search_time.labels(backend, 'yes' if cached else 'no') \
+            .observe(seconds)
+
+    def loan(self, action, outcome):
+        """
+        记录一次借阅或归还, ``action`` 为 ``borrow`` 或 ``return``,
+        当前会话提交后计数, 回滚时丢弃
+        """
+        from . import db
+        db.session.info.setdefault('metrics_loans', []).append((action, outcome))
+
+    def _after_commit(self, session):
+        for action, outcome in session.info.pop('metrics_loans', ()):
+            self.loans.labels(action, outcome).inc()
+
+    def _after_rollback(self, session):
+        session.info.pop('metrics_loans', None)
+
+    def _allowed(self):
+        if current_user.is_authenticated and current_user.is_administrator():
+            return True
+        return 'X-Forwarded-For' not in request.headers and \
+            request.remote_addr in current_app.config['METRICS_ALLOWED_ADDRS']
+
+    def process_dead(self, pid):
+        """
+        多进程模式下清理已退出进程的 ``livesum`` 计数
+        """
+        if self.multiprocess:
+            from prometheus_client import multiprocess
+            multiprocess.mark_process_dead(pid)
+
+    def expose(self):
+        """
+        以文本格式输出所有指标
+        """
+        if not self._allowed():
+            return Response('forbidden\n', status=403, mimetype='text/plain')
+        from prometheus_client import (CONTENT_TYPE_LATEST, CollectorRegistry,
+                                       generate_latest)
+        registry = self.registry
+        if self.multiprocess:
+            from prometheus_client import multiprocess
+            registry = CollectorRegistry()
+            multiprocess.MultiProcessCollector(registry)
+        return Response(generate_latest(registry),
+                        content_type=CONTENT_TYPE_LATEST)
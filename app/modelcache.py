@@ -0,0 +1,416 @@
+# -*- coding:utf-8 -*-
+import os
+from flask import abort, current_app, has_app_context
+from flask_sqlalchemy import Pagination
+from sqlalchemy import event, inspect, select
+from sqlalchemy.orm import Session, make_transient_to_detached
+from sqlalchemy.orm.util import identity_key
+from .cache import TableVersions, make_region
+
+
+def _table_name(obj):
+    return inspect(obj).mapper.local_table.name
+
+
+class ModelCache(object):
+    """
+    ..  note:: 按主键与命名列表缓存模型
+
+        条目保存在 ``models`` 缓存区域 (本地 LRU, 配置了 ``CACHE_SHARED_DIR``
+        时加上共享层), 键中带有相关表的版本号。会话 flush 时 (``after_flush``)
+        和提交后递增被修改的表的版本号, 旧条目不会再被命中。
+        版本号总是保存在映射文件 ``CACHE_VERSIONS_PATH`` 中 (默认在
+        ``CACHE_SHARED_DIR`` 或 ``tmp/cache`` 下), 即使条目只缓存在进程内,
+        一个进程提交后同一台机器上的其他进程也立即失效。
+        同一个数据库的所有进程必须使用同一个文件。
+
+        与单个对象相关的缓存 (例如某个用户的身份快照) 使用按名称计数的版本号
+        (``key_version``/``mark_keys``), 保存在同一目录的 ``keys.bin`` 中,
+        槽数为 ``CACHE_KEY_VERSION_SLOTS``, 同样在 flush 时和提交后递增。
+        缓存的每一行的键中还带有这一行 (``row_key``) 的版本号,
+        只修改单行的写入 (例如 ``app.models.increment`` 调整库存) 用 ``mark_rows``
+        使这一行失效, 不影响同一表的其他行和命名列表。
+
+        * ``get``/``get_many``: 主键查询, 缓存行的列值, 命中时构造对象并加入会话,
+          不执行 SQL;
+        * ``list``: 命名列表, 例如首页排行的 id, 由调用者指定依赖的表。
+
+        以下情况不使用缓存, 直接查询:
+
+        * 会话已固定到主库, 例如 ``write_transaction`` 中先读后写的视图,
+          保证读到的值与写入在同一个事务中;
+        * 会话中已 flush 但还未提交对相关表的修改。
+
+        未命中时从主库读取, 不受只读副本延迟的影响。
+        ``session.execute`` 直接执行的 ``UPDATE``/``DELETE`` 不会触发事件,
+        需要在执行之前调用 ``mark_tables`` 或 ``mark_rows``, 或者提交后调用 ``bump``。
+
+    """
+
+    def __init__(self, app=None):
+        self._listening = False
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('MODEL_CACHE_SIZE', 10000)
+        app.config.setdefault('MODEL_CACHE_TTL', 300)
+        directory = app.config.get('CACHE_SHARED_DIR')
+        app.config.setdefault(
+            'CACHE_VERSIONS_PATH',
+            os.path.join(directory or os.path.join(app.instance_path, 'cache'),
+                         'versions.bin'))
+        app.config.setdefault(
+            'CACHE_KEY_VERSIONS_PATH',
+            os.path.join(os.path.dirname(app.config['CACHE_VERSIONS_PATH']),
+                         'keys.bin'))
+        app.config.setdefault('CACHE_KEY_VERSION_SLOTS', 65536)
+        app.extensions['model_cache'] = (
+            make_region(app, 'models', app.config['MODEL_CACHE_SIZE'],
+                        app.config['MODEL_CACHE_TTL']),
+            TableVersions(app.config['CACHE_VERSIONS_PATH']),
+            TableVersions(app.config['CACHE_KEY_VERSIONS_PATH'],
+                          app.config['CACHE_KEY_VERSION_SLOTS']))
+        if not self._listening:
+            self._listening = True
+            event.listen(Session, 'after_flush', self._after_flush)
+            event.listen(Session, 'after_bulk_update', self._after_bulk)
+            event.listen(Session, 'after_bulk_delete', self._after_bulk)
+            event.listen(Session, 'after_commit', self._after_commit)
+            event.listen(Session, 'after_rollback', self._after_rollback)
+
+    @property
+    def region(self):
+        return current_app.extensions['model_cache'][0]
+
+    @property
+    def versions(self):
+        return current_app.extensions['model_cache'][1]
+
+    @property
+    def key_versions(self):
+        return current_app.extensions['model_cache'][2]
+
+    def bump(self, *tables):
+        """
+        使这些表的缓存条目失效
+        """
+        if tables:
+            self.versions.bump(*tables)
+
+    def key_version(self, name):
+        """
+        按名称计数的版本号, 例如 ``identity:42``
+
+        :rtype: int
+        """
+        return self.key_versions.get(name)
+
+    def key_usable(self, session, name):
+        """
+        会话中没有未提交的 ``name`` 的修改时才可以使用缓存
+        """
+        return name not in session.info.get('cache_dirty_keys', ())
+
+    def mark_keys(self, session, *names):
+        """
+        ..  note:: 使这些名称的缓存条目失效
+
+            立即递增版本号, 会话提交或回滚后再递增一次: 提交之前读到旧值,
+            或者同一会话读到未提交的值并写入缓存的条目, 使用的是中间的版本号,
+            之后不会再被命中。应在写入数据之前 (例如 flush 时) 调用。
+
+        """
+        if not names or not has_app_context() or \
+                'model_cache' not in current_app.extensions:
+            return
+        session.info.setdefault('cache_dirty_keys', set()).update(names)
+        self.key_versions.bump(*names)
+
+    def row_key(self, table, id):
+        """
+        单行的版本号名称, 例如 ``row:movies:42``
+        """
+        return 'row:%s:%d' % (table, id)
+
+    def mark_tables(self, session, *tables):
+        """
+        ..  note:: 使这些表的缓存条目与命名列表失效
+
+            与 flush 时相同: 立即递增版本号, 提交后再递增一次,
+            提交之前会话中不使用这些表的缓存。
+
+        """
+        if not tables or not has_app_context() or \
+                'model_cache' not in current_app.extensions:
+            return
+        session.info.setdefault('cache_dirty_tables', set()).update(tables)
+        self.bump(*tables)
+
+    def mark_rows(self, session, model, *ids):
+        """
+        使这些行的缓存条目失效, 应在写入之前调用, 见 ``mark_keys``
+        """
+        table = inspect(model).local_table.name
+        self.mark_keys(session, *[self.row_key(table, id) for id in ids])
+
+    def _usable(self, session, tables):
+        if session.info.get('db_primary'):
+            return False
+        dirty = session.info.get('cache_dirty_tables')
+        return not dirty or not dirty.intersection(tables)
+
+    def _rows_usable(self, session, table, keys):
+        dirty = session.info.get('cache_dirty_keys')
+        return not dirty or \
+            not any(self.row_key(table, key) in dirty for key in keys)
+
+    def _key(self, name, tables):
+        versions = self.versions
+        return '%s@%s' % (name, '.'.join(str(versions.get(table))
+                                         for table in tables))
+
+    def get(self, model, id):
+        """
+        按主键取出对象, 不存在时为 ``None``
+        """
+        result = self.get_many(model, [id])
+        return result[0] if result else None
+
+    def get_or_404(self, model, id):
+        obj = self.get(model, id)
+        if obj is None:
+            abort(404)
+        return obj
+
+    def get_many(self, model, ids):
+        """
+        ..  note:: 按主键批量取出对象
+
+            按 ``ids`` 的顺序返回, 不存在的跳过。已在会话中的对象直接使用,
+            其余先查缓存, 未命中的用一条 ``IN`` 查询从主库取出。
+
+        :rtype: list
+        """
+        from . import db
+        session = db.session()
+        mapper = inspect(model)
+        table = mapper.local_table
+        pk = mapper.primary_key[0]
+        keys = []
+        for id in ids:
+            try:
+                keys.append(int(id))
+            except (TypeError, ValueError):
+                continue
+        if not self._usable(session, [table.name]) or \
+                not self._rows_usable(session, table.name, keys):
+            found = dict((getattr(obj, pk.key), obj) for obj in
+                         model.query.filter(pk.in_(keys)).all()) if keys else {}
+            return [found[key] for key in keys if key in found]
+
+        names = [prop.key for prop in mapper.column_attrs]
+        objects = {}
+        missing = []
+        for key in keys:
+            obj = session.identity_map.get(identity_key(model, key))
+            if obj is None:
+                missing.append(key)
+            else:
+                objects[key] = obj
+        for key, values in self._values(mapper, missing).items():
+            objects[key] = self._attach(session, model, names, values, key)
+        return [objects[key] for key in keys if key in objects]
+
+    def rows(self, model, ids, factory):
+        """
+        ..  note:: 按主键批量取出只读的行
+
+            与 ``get_many`` 相同, 但不构造 ORM 对象, 也不加入会话:
+            每行的 ``(列名, 值)`` 传给 ``factory``, 例如 ``app.rows.MovieItem``。
+            会话中有未提交的修改时在会话中查询, 读到 flush 后的值。
+
+        :rtype: list
+        """
+        from . import db
+        session = db.session()
+        mapper = inspect(model)
+        table = mapper.local_table
+        keys = []
+        for id in ids:
+            try:
+                keys.append(int(id))
+            except (TypeError, ValueError):
+                continue
+        if self._usable(session, [table.name]) and \
+                self._rows_usable(session, table.name, keys):
+            found = self._values(mapper, keys)
+        else:
+            columns, position = self._columns(mapper)
+            found = dict((row[position], tuple(row)) for row in session.execute(
+                select(columns).where(mapper.primary_key[0].in_(keys)))) \
+                if keys else {}
+        names = [prop.key for prop in mapper.column_attrs]
+        return [factory(zip(names, found[key])) for key in keys if key in found]
+
+    def _columns(self, mapper):
+        columns = [prop.columns[0] for prop in mapper.column_attrs]
+        return columns, columns.index(mapper.primary_key[0])
+
+    def _values(self, mapper, keys):
+        """
+        ..  note:: 主键对应的列值
+
+            先查缓存, 未命中的用一条 ``IN`` 查询从主库取出。
+            键中的表和行的版本号都在查询之前取得,
+            期间提交的修改只会使写入的条目不再被命中。
+
+        :rtype: dict
+        """
+        from . import db
+        if not keys:
+            return {}
+        table = mapper.local_table
+        columns, position = self._columns(mapper)
+        region = self.region
+        prefix = self._key(table.name, [table.name])
+        key_versions = self.key_versions
+        names = {}
+        found = {}
+        for key in keys:
+            names[key] = '%s:%d@%d' % (prefix, key, key_versions.get(
+                self.row_key(table.name, key)))
+            values = region.get(names[key])
+            if values is not None:
+                found[key] = values
+        missing = [key for key in keys if key not in found]
+        if missing:
+            rows = db.get_engine(current_app).execute(
+                select(columns).where(mapper.primary_key[0].in_(missing)))
+            for row in rows:
+                values = tuple(row)
+                key = values[position]
+                region.set(names[key], values)
+                found[key] = values
+        return found
+
+    def _attach(self, session, model, names, values, key):
+        obj = session.identity_map.get(identity_key(model, key))
+        if obj is not None:
+            return obj
+        obj = inspect(model).class_manager.new_instance()
+        for name, value in zip(names, values):
+            setattr(obj, name, value)
+        make_transient_to_detached(obj)
+        session.add(obj)
+        return obj
+
+    def list(self, name, models, loader):
+        """
+        ..  note:: 缓存命名列表
+
+            ``models`` 为列表依赖的模型, 其中任一表修改后失效。
+            ``loader`` 返回可以序列化的值, 例如 id 列表;
+            未命中时 ``loader`` 中的查询使用主库。
+
+        """
+        from . import db
+        session = db.session()
+        tables = [inspect(model).local_table.name for model in models]
+        if not self._usable(session, tables):
+            return loader()
+        key = self._key(name, tables)
+        value = self.region.get(key)
+        if value is None:
+            replica = session.info.pop('db_replica', None)
+            try:
+                value = loader()
+            finally:
+                if replica:
+                    session.info['db_replica'] = replica
+            self.region.set(key, value)
+        return value
+
+    def paginate(self, name, model, query, page, per_page, total=None,
+                 factory=None):
+        """
+        ..  note:: 缓存分页
+
+            缓存这一页的 id 和总数, 对象由 ``get_many`` 取出。
+            与 ``error_out=False`` 的 ``paginate`` 相同。
+            给出 ``total`` 时直接使用, 不执行 ``COUNT``。
+
+            给出 ``factory`` 时这一页是 ``rows`` 返回的只读行,
+            未命中时只查询这一页的主键。
+
+        :rtype: flask_sqlalchemy.Pagination
+        """
+        from .counts import paginate
+        pk = inspect(model).primary_key[0]
+        page = max(page, 1)
+        # 未命中时查询出的对象留在会话中, get_many 不必再查询
+        loaded = []
+        known = total
+
+        def load():
+            if factory is not None:
+                count = known
+                if count is None:
+                    count = query.order_by(None).count()
+                return self._page_ids(model, query, page, per_page), count
+            if known is None:
+                pagination = query.paginate(page, per_page=per_page,
+                                            error_out=False)
+            else:
+                pagination = paginate(query, page, per_page, known)
+            loaded.extend(pagination.items)
+            return ([getattr(obj, pk.key) for obj in pagination.items],
+                    pagination.total)
+        ids, total = self.list('%s:%d:%d' % (name, page, per_page),
+                               [model], load)
+        if factory is not None:
+            items = self.rows(model, ids, factory)
+        else:
+            items = self.get_many(model, ids)
+        return Pagination(query, page, per_page, total, items)
+
+    def _page_ids(self, model, query, page, per_page):
+        """
+        ..  note:: 一页的主键
+
+            只查询主键, 各行由 ``rows`` 取出: 行的版本号要在读取之前取得,
+            查询这一页之前还不知道是哪些行。
+
+        :rtype: list
+        """
+        mapper = inspect(model)
+        page_query = query.limit(per_page).offset((page - 1) * per_page)
+        return [row[0] for row in
+                page_query.with_entities(mapper.primary_key[0])]
+
+    def _after_flush(self, session, flush_context):
+        tables = set(_table_name(obj) for obj in
+                     list(session.new) + list(session.dirty) +
+                     list(session.deleted))
+        self.mark_tables(session, *tables)
+
+    def _after_bulk(self, update_context):
+        self.mark_tables(update_context.session,
+                         update_context.mapper.local_table.name)
+
+    def _after_commit(self, session):
+        tables = session.info.pop('cache_dirty_tables', None)
+        keys = session.info.pop('cache_dirty_keys', None)
+        if not has_app_context() or 'model_cache' not in current_app.extensions:
+            return
+        if tables:
+            self.bump(*tables)
+        if keys:
+            self.key_versions.bump(*keys)
+
+    def _after_rollback(self, session):
+        session.info.pop('cache_dirty_tables', None)
+        keys = session.info.pop('cache_dirty_keys', None)
+        if keys and has_app_context() and \
+                'model_cache' in current_app.extensions:
+            self.key_versions.bump(*keys)
@@ -2,9 +2,13 @@
 from itsdangerous import TimedJSONWebSignatureSerializer as Serializer
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import UserMixin, AnonymousUserMixin,current_user
-from flask import current_app, request, url_for
+from flask import current_app, request, url_for, has_app_context, g
+from sqlalchemy import event, inspect
+from sqlalchemy.orm.attributes import set_committed_value
 from . import login_manager
 from . import db
+from . import loan_shards, model_cache
+from .cache import get_region
 from datetime import datetime
 from jieba.analyse import ChineseAnalyzer
 
@@ -100,9 +104,132 @@ class Record(db.Model):
 
     """
     __tablename__ = 'records'
+    __table_args__ = (db.Index('ix_records_timestamp_customer_id_movie_id',
+                               'timestamp', 'customer_id', 'movie_id'),)
     customer_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
     movie_id = db.Column(db.Integer, db.ForeignKey('movies.id'), primary_key=True)
-    timestamp = db.Column(db.DateTime, index=True, default=datetime.now)
+    timestamp = db.Column(db.DateTime, default=datetime.now)
+
+class Checkpoint(db.Model):
+    """
+
+    定时任务的断点, 任务中断后从断点继续。
+
+    =================     ===============
+    列名                   说明
+    =================     ===============
+    name                  任务名
+    value                 断点数据 (JSON)
+    updated_at            更新时间
+    =================     ===============
+
+    """
+    __tablename__ = 'checkpoints'
+    name = db.Column(db.String(64), primary_key=True)
+    value = db.Column(db.Text)
+    updated_at = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now)
+
+class Outbox(db.Model):
+    """
+
+    待发送的电子邮件, 由 ``app.email.MailPool`` 发送。
+
+    =================     ===============
+    列名                   说明
+    =================     ===============
+    id                    序号
+    recipient             收件人
+    sender                发件人
+    subject               主题
+    body                  纯文本正文
+    html                  HTML 正文
+    status                状态: pending / sending / sent / failed
+    attempts              已尝试次数
+    next_attempt_at       下次尝试时间
+    last_error            最近一次错误
+    created_at            创建时间
+    sent_at               发送时间
+    =================     ===============
+
+    """
+    __tablename__ = 'outbox'
+    __table_args__ = (db.Index('ix_outbox_status_next_attempt_at',
+                               'status', 'next_attempt_at'),)
+    id = db.Column(db.Integer, primary_key=True)
+    recipient = db.Column(db.String(64))
+    sender = db.Column(db.String(64))
+    subject = db.Column(db.String(128))
+    body = db.Column(db.Text)
+    html = db.Column(db.Text)
+    status = db.Column(db.String(16), default='pending')
+    attempts = db.Column(db.Integer, default=0)
+    next_attempt_at = db.Column(db.DateTime, default=datetime.now)
+    last_error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.now)
+    sent_at = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return '<Outbox %r %r>' % (self.recipient, self.status)
+
+class Similarity(db.Model):
+    """
+
+    基于内容的相似影片, 由 ``app.similar`` 计算。
+
+    =================     ===============
+    列名                   说明
+    =================     ===============
+    movie_id              电影序号
+    similar_ids           相似影片序号, 按相似度降序, 以逗号分隔
+    =================     ===============
+
+    """
+    __tablename__ = 'similarities'
+    movie_id = db.Column(db.Integer, db.ForeignKey('movies.id'), primary_key=True)
+    similar_ids = db.Column(db.Text, default='')
+
+    @property
+    def ids(self):
+        """
+        相似影片序号列表
+
+        :rtype: list
+        """
+        return [int(i) for i in self.similar_ids.split(',') if i]
+
+class CatalogCount(db.Model):
+    """
+
+    目录的计数, 分页直接读取总数而不是执行 ``COUNT``。
+
+    =================     ===============
+    列名                   说明
+    =================     ===============
+    name                  计数名, 见 ``catalog_facets``
+    value                 数量
+    =================     ===============
+
+    """
+    __tablename__ = 'catalog_counts'
+    name = db.Column(db.String(128), primary_key=True)
+    value = db.Column(db.Integer, default=0)
+
+class SearchGeneration(db.Model):
+    """
+
+    搜索索引的版本号, ``fts5`` 搜索后端每次写入索引时递增, 用于结果缓存失效。
+
+    =================     ===============
+    列名                   说明
+    =================     ===============
+    name                  索引表名
+    generation            版本号
+    =================     ===============
+
+    """
+    __tablename__ = 'search_generations'
+    name = db.Column(db.String(64), primary_key=True)
+    generation = db.Column(db.Integer, nullable=False, default=0)
 
 class Movie(db.Model):
     """
@@ -129,8 +256,16 @@ class Movie(db.Model):
     alt                      豆瓣链接
     amount                   库存
     counts                   借阅次数
+    version                  版本号
     ====================     =================
 
+    ..  note:: 乐观并发控制
+
+        ``version`` 是 ``version_id_col``, 每次通过会话修改时递增,
+        ``UPDATE`` 带有 ``WHERE version = 加载时的版本``, 期间被其他事务修改过时
+        抛出 ``StaleDataError``。库存 ``amount`` 与借阅次数 ``counts``
+        由 ``adjust_stock`` 按增量更新, 不改变版本号, 借阅与编辑影片信息互不冲突。
+
     """
     __tablename__ = 'movies'
     __searchable__ = ['title', 'original_title']
@@ -140,16 +275,22 @@ class Movie(db.Model):
     original_title = db.Column(db.String(64), unique=True, index=True)
     directors = db.Column(db.String(64))
     casts = db.Column(db.String(64))
-    genres = db.Column(db.String(64))
+    # 修改前的值用于调整目录计数, 对象过期后赋值时也先加载旧值
+    genres = db.column_property(db.Column(db.String(64)), active_history=True)
     year = db.Column(db.Integer)
     rating = db.Column(db.Float, default='0.0')
     images = db.Column(db.String(64))
     alt = db.Column(db.String(64))
-    amount = db.Column(db.Integer,default=200)
+    amount = db.column_property(db.Column(db.Integer, default=200),
+                                active_history=True)
     counts = db.Column(db.Integer,default=0)
+    version = db.Column(db.Integer, nullable=False, server_default='1')
+    __mapper_args__ = {'version_id_col': version}
     movie = db.relationship('Record', foreign_keys=[Record.movie_id],
                             backref=db.backref('movie',lazy='joined'),
                             lazy='dynamic',cascade='all, delete-orphan')
+    similarity = db.relationship('Similarity', uselist=False,
+                                 cascade='all, delete-orphan')
 
     def to_json(self):
         """
@@ -157,21 +298,7 @@ class Movie(db.Model):
 
         :rtype: dict
         """
-
-        json_movie = {
-            'title': self.title,
-            'original_title': self.original_title,
-            'directors': self.directors.split(' / '),
-            'casts': self.casts.split(' / '),
-            'genres': self.genres.split(' / '),
-            'year': self.year,
-            'rating': self.rating,
-            'images': self.images,
-            'api': url_for('api.get_movie', id=self.id, _external=True),
-            'douban_alt': self.alt,
-            'alt': url_for('main.movie', id=self.id, _external=True),
-        }
-        return json_movie
+        return movie_json(self)
 
     def __repr__(self):
         return '<Movie %r>' % self.title
@@ -179,6 +306,194 @@ class Movie(db.Model):
     def can(self):
         return self.amount > 0
 
+    def adjust_stock(self, amount=0, counts=0):
+        """
+        ..  note:: 按增量调整库存与借阅次数
+
+            执行 ``amount = amount + 增量``, 不检查也不递增版本号,
+            同时发生的借阅和编辑都不会被覆盖。有库存的状态变化时调整目录计数。
+            只有这部影片的缓存失效, 其他影片和列表不受借阅与归还的影响。
+
+        """
+        deltas = dict((name, delta) for name, delta in
+                      (('amount', amount), ('counts', counts)) if delta)
+        changes = increment(self, deltas)
+        if 'amount' in changes:
+            before, after = changes['amount']
+            if (before > 0) != (after > 0):
+                model_cache.mark_tables(db.session, CatalogCount.__tablename__)
+            _count(db.session.connection(),
+                   set([MOVIES_IN_STOCK]) if after > 0 else set(),
+                   set([MOVIES_IN_STOCK]) if before > 0 else set())
+
+    @property
+    def is_borrowed(self):
+        """
+        是否有用户正在借阅该影片
+
+        :rtype: bool
+        """
+        if loan_shards.enabled:
+            return loan_shards.movie_borrowed(self.id)
+        return self.movie.first() is not None
+
+    @property
+    def similar_movies(self):
+        """
+        相似影片列表, 按相似度降序
+
+        :rtype: list
+        """
+        if self.similarity is None:
+            return []
+        ids = self.similarity.ids
+        if not ids:
+            return []
+        return model_cache.get_many(Movie, ids)
+
+
+TOTAL_MOVIES = 'movies'
+MOVIES_IN_STOCK = 'movies:in_stock'
+
+
+def movie_json(movie, links=True):
+    """
+    ..  note:: 影片的 ``json`` 格式
+
+        ``Movie``、列表使用的 ``MovieItem`` 和生成目录快照时查询的行共用,
+        ``movie`` 只需要有同名的属性。``links`` 为 ``False`` 时不包含
+        ``api`` 和 ``alt`` 两个链接, 快照在响应时再拼接。
+
+    :rtype: dict
+    """
+    json_movie = {
+        'title': movie.title,
+        'original_title': movie.original_title,
+        'directors': (movie.directors or u'').split(' / '),
+        'casts': (movie.casts or u'').split(' / '),
+        'genres': (movie.genres or u'').split(' / '),
+        'year': movie.year,
+        'rating': movie.rating,
+        'images': movie.images,
+        'douban_alt': movie.alt,
+    }
+    if links:
+        json_movie['api'] = url_for('api.get_movie', id=movie.id, _external=True)
+        json_movie['alt'] = url_for('main.movie', id=movie.id, _external=True)
+    return json_movie
+
+
+def catalog_facets(amount, genres):
+    """
+    ..  note:: 一部影片计入的计数
+
+        ``movies`` 为影片总数, ``movies:in_stock`` 为有库存的影片数,
+        ``genre:<类型>`` 为各类型的影片数。
+
+    :rtype: set
+    """
+    names = set([TOTAL_MOVIES])
+    if amount is not None and amount > 0:
+        names.add(MOVIES_IN_STOCK)
+    for genre in (genres or u'').split(' / '):
+        genre = genre.strip()
+        if genre:
+            names.add(u'genre:' + genre)
+    return names
+
+
+def _old_value(state, name):
+    history = state.attrs[name].history
+    if history.deleted:
+        return history.deleted[0]
+    return getattr(state.obj(), name)
+
+
+def _count(connection, added, removed):
+    """
+    ..  note:: 在触发修改的事务中调整计数
+
+        计数表由 ``app.counts.reconcile`` 建立; 还没有 ``movies`` 计数时不调整,
+        等待第一次校正。之后新出现的计数名直接插入。
+
+    """
+    table = CatalogCount.__table__
+    deltas = dict((name, 1) for name in added - removed)
+    deltas.update((name, -1) for name in removed - added)
+    if not deltas:
+        return
+    ready = None
+    for name, delta in sorted(deltas.items()):
+        result = connection.execute(
+            table.update().where(table.c.name == name)
+            .values(value=table.c.value + delta))
+        if result.rowcount:
+            continue
+        if ready is None:
+            ready = connection.execute(
+                db.select([table.c.name]).where(table.c.name == TOTAL_MOVIES)
+            ).first() is not None
+        if ready:
+            connection.execute(table.insert().values(name=name,
+                                                     value=max(delta, 0)))
+
+
+@event.listens_for(Movie, 'after_insert')
+def _movie_counted(mapper, connection, target):
+    _count(connection, catalog_facets(target.amount, target.genres), set())
+
+
+@event.listens_for(Movie, 'after_update')
+def _movie_recounted(mapper, connection, target):
+    state = inspect(target)
+    if not (state.attrs.amount.history.has_changes() or
+            state.attrs.genres.history.has_changes()):
+        return
+    _count(connection, catalog_facets(target.amount, target.genres),
+           catalog_facets(_old_value(state, 'amount'),
+                          _old_value(state, 'genres')))
+
+
+@event.listens_for(Movie, 'after_delete')
+def _movie_uncounted(mapper, connection, target):
+    state = inspect(target)
+    _count(connection, set(),
+           catalog_facets(_old_value(state, 'amount'),
+                          _old_value(state, 'genres')))
+
+
+def increment(obj, deltas):
+    """
+    ..  note:: 按增量更新对象的计数列
+
+        ``deltas`` 为 ``{列名: 增量}``, 执行一条
+        ``UPDATE ... SET 列 = 列 + 增量``, 不经过 flush, 不检查也不递增版本号。
+        更新后在同一事务中读回新值, 作为已提交的值写入对象。
+        绕过了映射事件, 依赖这些列的缓存由调用者处理; ``ModelCache``
+        只使这一行的条目失效 (``mark_rows``), 同一表的其他行和命名列表仍然有效,
+        依赖这些列的命名列表需要调用者用 ``mark_tables`` 使之失效。
+
+    :return: ``{列名: (更新前, 更新后)}``
+    :rtype: dict
+    """
+    if not deltas:
+        return {}
+    model = type(obj)
+    pk = inspect(model).primary_key[0]
+    ident = getattr(obj, pk.key)
+    names = sorted(deltas)
+    table = inspect(model).local_table
+    model_cache.mark_rows(db.session, model, ident)
+    db.session.execute(table.update().where(table.c[pk.name] == ident).values(
+        dict((table.c[name], table.c[name] + deltas[name]) for name in names)))
+    row = db.session.query(*[getattr(model, name) for name in names]) \
+        .filter(pk == ident).one()
+    changes = {}
+    for name, value in zip(names, row):
+        set_committed_value(obj, name, value)
+        changes[name] = (value - deltas[name], value)
+    return changes
+
 
 class User(UserMixin, db.Model):
     """
@@ -197,6 +512,7 @@ class User(UserMixin, db.Model):
     confirmed                是否验证
     amount                   最大借阅数量
     avatar_url               头像地址
+    version                  版本号
     ====================     ===================
 
     ..  note:: 使用 ``UserMixin``
@@ -212,6 +528,11 @@ class User(UserMixin, db.Model):
 
         ``get_id()`` 必须返回用户的唯一标识符, 使用 ``Unicode`` 编码字符串。
 
+    ..  note:: 乐观并发控制
+
+        与 ``Movie`` 相同, ``version`` 是 ``version_id_col``;
+        剩余借阅数量 ``amount`` 由 ``adjust_amount`` 按增量更新。
+
     """
 
     __tablename__ = 'users'
@@ -223,6 +544,8 @@ class User(UserMixin, db.Model):
     confirmed = db.Column(db.Boolean, default=False)
     amount = db.Column(db.Integer, default=7)
     avatar_url = db.Column(db.String(64), default=DEFAULT_AVATAR_URL)
+    version = db.Column(db.Integer, nullable=False, server_default='1')
+    __mapper_args__ = {'version_id_col': version}
     customer = db.relationship('Record', foreign_keys=[Record.customer_id],
                             backref=db.backref('customer',lazy='joined'),
                             lazy='dynamic',cascade='all, delete-orphan')
@@ -234,9 +557,12 @@ class User(UserMixin, db.Model):
         """
         if not self.is_borrowing(movie):
             if movie.can() and self.can_borrow():
-                movie.amount -= 1
-                movie.counts += 1
-                self.amount -= 1
+                movie.adjust_stock(amount=-1, counts=1)
+                self.adjust_amount(-1)
+            loan_state_changed(db.session, user.id)
+            if loan_shards.enabled:
+                loan_shards.add(db.session, user.id, movie.id)
+                return
             r = Record(customer_id=user.id, movie_id=movie.id)
             db.session.add(r)
 
@@ -244,18 +570,38 @@ class User(UserMixin, db.Model):
         """
         归还
         """
+        if loan_shards.enabled:
+            if loan_shards.is_borrowing(self.id, movie.id):
+                movie.adjust_stock(amount=1)
+                self.adjust_amount(1)
+                loan_state_changed(db.session, self.id)
+                loan_shards.remove(db.session, self.id, movie.id)
+            return
         r = self.customer.filter_by(movie_id=movie.id).first()
         if r:
-            movie.amount += 1
-            self.amount += 1
+            movie.adjust_stock(amount=1)
+            self.adjust_amount(1)
+            loan_state_changed(db.session, self.id)
             db.session.delete(r)
 
     def is_borrowing(self, movie):
         """
         判断当前影片是否正在被用户借阅
+
+        总是查询数据库, 借阅和归还前的检查使用它; 只用于显示时使用 ``loan_state``。
         """
+        if loan_shards.enabled:
+            return loan_shards.is_borrowing(self.id, movie.id)
         return self.customer.filter_by(movie_id=movie.id).first() is not None
 
+    def loan_state(self):
+        """
+        借阅中的影片 id 集合
+
+        :rtype: frozenset
+        """
+        return loan_state(self.id)
+
     @property
     def borrowed_movies(self):
         """
@@ -263,6 +609,13 @@ class User(UserMixin, db.Model):
 
         :rtype: list
         """
+        if loan_shards.enabled:
+            ids = loan_shards.movie_ids(self.id)
+            if not ids:
+                return None
+            movies = dict((m.id, m) for m in
+                          Movie.query.filter(Movie.id.in_(ids)).all())
+            return [movies[i] for i in ids if i in movies]
         r = self.customer.filter_by(customer_id=current_user.id).all()
         if r:
             movies = [Movie.query.filter_by(id=i.movie_id).first() for i in r]
@@ -270,6 +623,13 @@ class User(UserMixin, db.Model):
         else:
             return None
 
+    def adjust_amount(self, delta):
+        """
+        按增量调整剩余借阅数量, 不改变版本号
+        """
+        model_cache.mark_keys(db.session, identity_key(self.id))
+        increment(self, {'amount': delta})
+
     def can_borrow(self):
         """
         判断用户是否可以借阅
@@ -282,14 +642,14 @@ class User(UserMixin, db.Model):
         return '<User %r>' % self.username
 
 
-    def generate_auth_token(self, expriation):
+    def generate_auth_token(self, expiration):
         """
         使用编码后的用户 ``id`` 字段值生成一个签名令牌, 还指定了以秒为单位的过期时间。
 
         :rtype: json
         """
         s = Serializer(current_app.config['SECRET_KEY'],
-                        expires_in=expriation)
+                        expires_in=expiration)
         return s.dumps({'id': self.id})
 
     @staticmethod
@@ -459,6 +819,182 @@ class User(UserMixin, db.Model):
         """
         return self.can(Permission.ADMINISTER)
 
+    def identity_snapshot(self):
+        """
+        ``Identity`` 使用的身份快照
+
+        :rtype: tuple
+        """
+        return (self.id, self.username, self.confirmed,
+                self.role.permissions if self.role is not None else 0,
+                self.amount, self.version)
+
+
+class Identity(UserMixin):
+    """
+    ..  note:: 已登录用户的身份快照
+
+        保存 ``id``、用户名、验证状态、权限位、剩余借阅数量和版本号,
+        ``can()``、``is_administrator()``、``can_borrow()`` 直接读取快照,
+        无需加载用户和角色。
+
+        访问快照以外的属性或方法时, 才按主键加载 ``User`` 并转发。
+
+    """
+
+    fields = ('id', 'username', 'confirmed', 'permissions', 'amount', 'version')
+
+    def __init__(self, snapshot, user=None):
+        self.__dict__.update(zip(self.fields, snapshot))
+        self.__dict__['_user'] = user
+
+    @property
+    def user(self):
+        """
+        对应的 ``User`` 对象, 首次访问时加载
+        """
+        if self._user is None:
+            self.__dict__['_user'] = User.query.get(self.id)
+        return self._user
+
+    def __getattr__(self, name):
+        return getattr(self.user, name)
+
+    def __setattr__(self, name, value):
+        setattr(self.user, name, value)
+
+    def __eq__(self, other):
+        return isinstance(other, (User, Identity)) and other.id == self.id
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def can(self, permissions):
+        return (self.permissions & permissions) == permissions
+
+    def is_administrator(self):
+        return self.can(Permission.ADMINISTER)
+
+    def can_borrow(self):
+        return self.amount > 0
+
+    def loan_state(self):
+        return loan_state(self.id)
+
+    def __repr__(self):
+        return '<Identity %r>' % self.username
+
+
+def identity_cache():
+    """
+    身份快照缓存区域
+    """
+    return get_region(current_app, 'identity',
+                      current_app.config['IDENTITY_CACHE_SIZE'],
+                      current_app.config['IDENTITY_CACHE_TTL'])
+
+
+def load_identity(user_id):
+    """
+    ..  note:: 加载身份快照
+
+        命中缓存时不查询数据库; 未命中时加载用户一次并写入缓存。
+        键中带有 ``roles`` 表和该用户 (``identity:<id>``) 的版本号,
+        保存在 ``ModelCache`` 的版本号文件中, 用户或角色修改并提交后
+        所有进程的旧快照都不会再被命中。
+
+    """
+    cache = identity_cache()
+    key = '%d@%d.%d' % (user_id, model_cache.versions.get(Role.__tablename__),
+                        model_cache.key_version(identity_key(user_id)))
+    snapshot = cache.get(key)
+    if snapshot is not None:
+        return Identity(snapshot)
+    user = User.query.get(user_id)
+    if user is None:
+        return None
+    snapshot = user.identity_snapshot()
+    cache.set(key, snapshot)
+    return Identity(snapshot, user)
+
+
+def identity_key(user_id):
+    """
+    用户身份快照的版本号名称
+    """
+    return 'identity:%d' % user_id
+
+
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def _identity_changed(mapper, connection, target):
+    # 通过会话修改用户总会递增 version, 快照随之变化
+    model_cache.mark_keys(inspect(target).session, identity_key(target.id))
+
+
+def loan_state_cache():
+    """
+    借阅状态缓存区域
+    """
+    return get_region(current_app, 'loan_state',
+                      current_app.config['LOAN_STATE_CACHE_SIZE'],
+                      current_app.config['LOAN_STATE_CACHE_TTL'])
+
+
+def loan_state(user_id):
+    """
+    ..  note:: 用户借阅中的影片 id 集合
+
+        列表页面和影片页面按集合判断每部影片的借阅状态, 不再逐部查询。
+        集合缓存在 ``loan_state`` 区域中, 未命中时一次查询 (借阅分片时为用户所在的分片)
+        取出; 同一请求中只取一次。键中带有该用户 (``loans:<id>``) 的版本号,
+        借阅或归还时递增, 提交后所有进程的旧集合都不会再被命中。
+        会话中有该用户未提交的借阅变化时直接查询, 不读写缓存。
+
+    :rtype: frozenset
+    """
+    name = loan_state_key(user_id)
+    if not model_cache.key_usable(db.session(), name):
+        return frozenset(_loaned_ids(user_id))
+    states = g.setdefault('loan_states', {})
+    state = states.get(user_id)
+    if state is not None:
+        return state
+    cache = loan_state_cache()
+    key = '%d@%d' % (user_id, model_cache.key_version(name))
+    ids = cache.get(key)
+    if ids is None:
+        ids = tuple(sorted(_loaned_ids(user_id)))
+        cache.set(key, ids)
+    state = states[user_id] = frozenset(ids)
+    return state
+
+
+def _loaned_ids(user_id):
+    if loan_shards.enabled:
+        return loan_shards.movie_ids(user_id)
+    return [row.movie_id for row in db.session.query(Record.movie_id)
+            .filter(Record.customer_id == user_id)]
+
+
+def loan_state_key(user_id):
+    """
+    用户借阅状态的版本号名称
+    """
+    return 'loans:%d' % user_id
+
+
+def loan_state_changed(session, user_id):
+    """
+    用户的借阅发生变化, 在写入借阅记录之前调用, 使借阅状态失效
+    """
+    model_cache.mark_keys(session, loan_state_key(user_id))
+    if has_app_context():
+        g.get('loan_states', {}).pop(user_id, None)
+
 
 @login_manager.user_loader
 def load_user(user_id):
@@ -468,8 +1004,10 @@ def load_user(user_id):
         加载用户的回调函数接收以 Unicode 字符串形式表示的用户标识符。
         如果能找到用户,这个函数必须返回用户对象,否则应该返回 None 。
 
+        返回的是 ``Identity`` 身份快照, 通常无需查询数据库。
+
     """
-    return User.query.get(int(user_id))
+    return load_identity(int(user_id))
 
 class AnonymousUser(AnonymousUserMixin):
 
@@ -0,0 +1,220 @@
+# -*- coding:utf-8 -*-
+import os
+import sys
+import time
+import random
+import pstats
+import cProfile
+import threading
+from itsdangerous import TimedJSONWebSignatureSerializer as Serializer
+from flask import current_app, g, request
+
+PROFILE_EXT = '.prof'
+STACKS_EXT = '.stacks'
+
+
+class StackSampler(object):
+    """
+    ..  note:: 低开销的栈采样器
+
+        后台线程每隔 ``interval`` 秒读取一次 ``sys._current_frames()``,
+        只记录正在被采样的请求线程, 按折叠栈 (``a;b;c``) 计数。
+        没有请求被采样时线程只是休眠。
+
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.threads = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self, ident):
+        with self._lock:
+            self.threads[ident] = {}
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+
+    def stop(self, ident):
+        with self._lock:
+            return self.threads.pop(ident, {})
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            if not self.threads:
+                continue
+            frames = sys._current_frames()
+            with self._lock:
+                for ident, stacks in self.threads.items():
+                    frame = frames.get(ident)
+                    if frame is not None:
+                        stack = collapse_frame(frame)
+                        stacks[stack] = stacks.get(stack, 0) + 1
+
+
+def collapse_frame(frame):
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append('%s (%s:%d)' % (code.co_name,
+                                     os.path.basename(code.co_filename),
+                                     code.co_firstlineno))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class Profiler(object):
+    """
+    ..  note:: 按请求采样的性能分析
+
+        ``PROFILER_SAMPLE_RATE`` 为采样比例, 例如 ``0.01`` 表示分析 1% 的请求。
+        ``PROFILER_ALLOW_HEADER`` 打开后, 带有 ``PROFILER_HEADER`` 请求头且
+        签名有效的请求总会被分析, 签名由 ``manage.py profile_token`` 生成。
+
+        ``PROFILER_MODE`` 为 ``cprofile`` 时使用 ``cProfile``, 每个请求写入一个
+        ``.prof`` 文件; 为 ``sample`` 时每隔 ``PROFILER_INTERVAL`` 秒采样一次调用栈,
+        写入 ``.stacks`` 折叠栈文件, 开销更低。
+
+        文件位于 ``PROFILER_DIR``, 命名为 ``<endpoint>+<毫秒时间戳>+<pid>``,
+        由 ``manage.py profile_report`` 汇总。
+
+        采样比例为 0 且不允许请求头时不注册任何钩子, 没有额外开销。
+
+    """
+
+    def __init__(self, app=None):
+        self.sampler = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('PROFILER_SAMPLE_RATE', 0)
+        app.config.setdefault('PROFILER_ALLOW_HEADER', False)
+        app.config.setdefault('PROFILER_HEADER', 'X-Profile')
+        app.config.setdefault('PROFILER_MODE', 'cprofile')
+        app.config.setdefault('PROFILER_INTERVAL', 0.005)
+        app.config.setdefault('PROFILER_DIR', 'profiles')
+        app.extensions['profiler'] = self
+        if not app.config['PROFILER_SAMPLE_RATE'] and \
+                not app.config['PROFILER_ALLOW_HEADER']:
+            return
+        if app.config['PROFILER_MODE'] == 'sample' and self.sampler is None:
+            self.sampler = StackSampler(app.config['PROFILER_INTERVAL'])
+        app.before_request(self._before_request)
+        app.teardown_request(self._teardown_request)
+
+    @staticmethod
+    def token(expires_in=3600):
+        """
+        生成 ``PROFILER_HEADER`` 请求头的值
+
+        :rtype: str
+        """
+        s = Serializer(current_app.config['SECRET_KEY'], expires_in=expires_in,
+                       salt='profiler')
+        return s.dumps({'profile': True}).decode('ascii')
+
+    @staticmethod
+    def verify_token(token):
+        s = Serializer(current_app.config['SECRET_KEY'], salt='profiler')
+        try:
+            return s.loads(token).get('profile') is True
+        except Exception:
+            return False
+
+    def _wanted(self):
+        config = current_app.config
+        if config['PROFILER_ALLOW_HEADER']:
+            token = request.headers.get(config['PROFILER_HEADER'])
+            if token:
+                return self.verify_token(token)
+        return random.random() < config['PROFILER_SAMPLE_RATE']
+
+    def _before_request(self):
+        if not self._wanted():
+            return
+        if self.sampler is not None:
+            g._profile = threading.current_thread().ident
+            self.sampler.start(g._profile)
+        else:
+            g._profile = cProfile.Profile()
+            g._profile.enable()
+
+    def _teardown_request(self, exception):
+        profile = g.pop('_profile', None)
+        if profile is None:
+            return
+        directory = current_app.config['PROFILER_DIR']
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        path = os.path.join(directory, '%s+%d+%d' % (
+            request.endpoint or 'unknown', int(time.time() * 1000), os.getpid()))
+        if self.sampler is not None:
+            stacks = self.sampler.stop(profile)
+            with open(path + STACKS_EXT, 'w') as f:
+                for stack, count in stacks.items():
+                    f.write('%s %d\n' % (stack, count))
+        else:
+            profile.disable()
+            profile.dump_stats(path + PROFILE_EXT)
+
+
+def _profile_files(directory, ext, endpoint=None):
+    if not os.path.isdir(directory):
+        return []
+    return sorted(os.path.join(directory, name) for name in os.listdir(directory)
+                  if name.endswith(ext) and
+                  (endpoint is None or name.split('+')[0] == endpoint))
+
+
+def endpoints(directory):
+    """
+    各端点的分析文件数量
+
+    :rtype: dict
+    """
+    counts = {}
+    for ext in (PROFILE_EXT, STACKS_EXT):
+        for path in _profile_files(directory, ext):
+            endpoint = os.path.basename(path).split('+')[0]
+            counts[endpoint] = counts.get(endpoint, 0) + 1
+    return counts
+
+
+def report(directory, endpoint=None, sort='cumulative', limit=30,
+           stream=sys.stdout):
+    """
+    ..  note:: 合并 ``.prof`` 文件, 输出耗时最多的函数
+
+    :rtype: int
+    """
+    files = _profile_files(directory, PROFILE_EXT, endpoint)
+    if not files:
+        return 0
+    stats = pstats.Stats(files[0], stream=stream)
+    for path in files[1:]:
+        stats.add(path)
+    stats.strip_dirs().sort_stats(sort).print_stats(limit)
+    return len(files)
+
+
+def collapsed(directory, endpoint=None):
+    """
+    ..  note:: 合并 ``.stacks`` 文件
+
+        返回的每一行为 ``栈 次数``, 可以直接交给 ``flamegraph.pl`` 生成火焰图。
+
+    :rtype: list
+    """
+    counts = {}
+    for path in _profile_files(directory, STACKS_EXT, endpoint):
+        with open(path) as f:
+            for line in f:
+                stack, _, count = line.rstrip('\n').rpartition(' ')
+                if stack:
+                    counts[stack] = counts.get(stack, 0) + int(count)
+    return ['%s %d' % (stack, count)
+            for stack, count in sorted(counts.items())]
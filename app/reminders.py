@@ -0,0 +1,185 @@
+# -*- coding:utf-8 -*-
+import json
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import and_, literal, select, tuple_
+from . import db, loan_shards
+from .email import send_email
+from .models import Checkpoint, Movie, User
+
+CHECKPOINT = 'overdue_reminders'
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+
+def overdue_chunks(engine, table, cutoff, chunk, after=None):
+    """
+    ..  note:: 分块读取逾期借阅
+
+        在 ``(timestamp, customer_id, movie_id)`` 覆盖索引上做范围扫描,
+        每次取 ``chunk`` 行, 下一块从上一块的最后一行之后开始 (行值比较),
+        每块只读取索引中的一段, 不需要排序。``after`` 为开始位置。
+
+    :rtype: generator
+    """
+    c = table.c
+    key = tuple_(c.timestamp, c.customer_id, c.movie_id)
+    while True:
+        query = select([c.timestamp, c.customer_id, c.movie_id]) \
+            .where(c.timestamp < cutoff)
+        if after is not None:
+            query = query.where(key > tuple_(*[literal(value)
+                                               for value in after]))
+        rows = engine.execute(query.order_by(c.timestamp, c.customer_id,
+                                             c.movie_id).limit(chunk)).fetchall()
+        if not rows:
+            return
+        yield rows
+        after = tuple(rows[-1])
+
+
+def overdue_rows(customer_ids, cutoff):
+    """
+    ..  note:: 用户的逾期借阅记录
+
+        按用户所在的分片查询。迁移期间同一借阅可能同时在分片和主库,
+        只保留先查到的 (分片中的) 一条。
+
+    :return: ``(customer_id, movie_id)`` 到 ``(engine, row)`` 的映射
+    :rtype: dict
+    """
+    rows = {}
+    for engine, table, ids in loan_shards.sources_for(customer_ids):
+        c = table.c
+        for row in engine.execute(
+                select([c.customer_id, c.timestamp, c.movie_id])
+                .where(and_(c.customer_id.in_(ids), c.timestamp < cutoff))):
+            rows.setdefault((row.customer_id, row.movie_id), (engine, row))
+    return rows
+
+
+def overdue_loans(rows):
+    """
+    ..  note:: 按用户分组逾期借阅
+
+        ``rows`` 为 ``overdue_rows`` 的结果, 从主库取出影片。
+
+    :return: 用户 id 到 ``[(movie, timestamp)]`` 的映射, 按借阅时间排序
+    :rtype: dict
+    """
+    rows = [row for _, row in rows.values()]
+    movie_ids = set(row.movie_id for row in rows)
+    movies = dict((movie.id, movie) for movie in
+                  Movie.query.filter(Movie.id.in_(movie_ids))) \
+        if movie_ids else {}
+    loans = {}
+    for row in sorted(rows, key=lambda row: (row.customer_id, row.timestamp)):
+        if row.movie_id in movies:
+            loans.setdefault(row.customer_id, []).append(
+                (movies[row.movie_id], row.timestamp))
+    return loans
+
+
+def owners(engine, chunk, rows):
+    """
+    ..  note:: 这一块中负责提醒的用户
+
+        一个用户可能有多条逾期借阅, 分布在不同的块中。只在用户最早的一条逾期借阅
+        (按 ``(timestamp, movie_id)``) 所在的块里提醒, 每个用户只提醒一次,
+        不需要在内存或断点中保存已经处理过的用户。
+
+    :rtype: list
+    """
+    first = {}
+    for (customer_id, _), (source, row) in rows.items():
+        key = (row.timestamp, row.movie_id)
+        if customer_id not in first or key < first[customer_id][0]:
+            first[customer_id] = (key, source)
+    return sorted(set(row.customer_id for row in chunk
+                      if first.get(row.customer_id) ==
+                      ((row.timestamp, row.movie_id), engine)))
+
+
+def _load_checkpoint():
+    checkpoint = Checkpoint.query.get(CHECKPOINT)
+    if checkpoint is None or not checkpoint.value:
+        return None
+    state = json.loads(checkpoint.value)
+    state['cutoff'] = datetime.strptime(state['cutoff'], '%Y-%m-%d %H:%M:%S')
+    after = state.get('after')
+    if after is not None:
+        state['after'] = (datetime.strptime(after[0], TIMESTAMP_FORMAT),
+                          after[1], after[2])
+    state.setdefault('source', 0)
+    return state
+
+
+def _save_checkpoint(state):
+    checkpoint = Checkpoint.query.get(CHECKPOINT) or Checkpoint(name=CHECKPOINT)
+    after = state['after']
+    checkpoint.value = json.dumps({
+        'cutoff': state['cutoff'].strftime('%Y-%m-%d %H:%M:%S'),
+        'days': state['days'],
+        'source': state['source'],
+        'after': None if after is None else
+        [after[0].strftime(TIMESTAMP_FORMAT), after[1], after[2]],
+    })
+    db.session.add(checkpoint)
+
+
+def remind_overdue(days=None):
+    """
+    ..  note:: 发送逾期借阅提醒
+
+        1. 依次在每个保存借阅的位置, 用 ``overdue_chunks`` 分块扫描借阅时间早于
+           ``days`` 天前的借阅, 每块 ``OVERDUE_CHUNK`` 行;
+        2. 对块中的用户, 用主键 ``(customer_id, movie_id)`` 在各自的分片取出
+           全部逾期借阅, 由 ``owners`` 选出最早一条逾期借阅在这一块中的用户;
+        3. 每个用户只发送一封汇总邮件, 写入 ``outbox`` 时按 ``OVERDUE_RATE``
+           (每分钟封数) 错开 ``next_attempt_at``, 由 ``MailPool`` 按时发送;
+        4. 每块提交时把扫描位置保存到断点, 中断后再次执行从该位置继续,
+           不会重新扫描, 完成后删除断点。中断期间归还了最早一条逾期借阅的用户
+           可能再收到一封提醒。
+
+    :rtype: int
+    """
+    config = current_app.config
+    state = _load_checkpoint()
+    if state is None:
+        days = days or config['OVERDUE_DAYS']
+        state = {'cutoff': datetime.now().replace(microsecond=0) -
+                 timedelta(days=days), 'days': days, 'source': 0, 'after': None}
+    interval = timedelta(seconds=60.0 / config['OVERDUE_RATE'])
+    send_at = datetime.now()
+    sent = 0
+    sources = loan_shards.sources()
+    while state['source'] < len(sources):
+        engine, table = sources[state['source']]
+        for chunk in overdue_chunks(engine, table, state['cutoff'],
+                                    config['OVERDUE_CHUNK'], state['after']):
+            rows = overdue_rows(sorted(set(row.customer_id for row in chunk)),
+                                state['cutoff'])
+            ids = owners(engine, chunk, rows)
+            loans = overdue_loans(dict(
+                (key, value) for key, value in rows.items() if key[0] in ids))
+            users = User.query.filter(User.id.in_(ids)).order_by(User.id) \
+                if ids else []
+            for user in users:
+                if user.id not in loans:
+                    continue
+                message = send_email(user.email, '借阅到期提醒', 'mail/overdue',
+                                     user=user, loans=loans[user.id],
+                                     days=state['days'])
+                message.next_attempt_at = send_at
+                send_at += interval
+                sent += 1
+            state['after'] = tuple(chunk[-1])
+            _save_checkpoint(state)
+            db.session.commit()
+            db.session.expunge_all()
+        state['source'] += 1
+        state['after'] = None
+    checkpoint = Checkpoint.query.get(CHECKPOINT)
+    if checkpoint is not None:
+        db.session.delete(checkpoint)
+        db.session.commit()
+    return sent
@@ -0,0 +1,34 @@
+# -*- coding:utf-8 -*-
+from .models import Movie, movie_json
+
+MOVIE_COLUMNS = tuple(Movie.__table__.columns.keys())
+
+
+class MovieItem(object):
+    """
+    ..  note:: 列表使用的只读影片
+
+        属性与 ``Movie`` 的列同名, 由列值直接构造, 没有 ORM 的状态、
+        身份映射和关系。``to_json``、``can`` 与 ``Movie`` 相同,
+        模板和序列化可以直接使用; 需要修改或访问关系时加载 ``Movie``。
+
+    """
+    __slots__ = MOVIE_COLUMNS
+
+    def __init__(self, items):
+        for name, value in items:
+            setattr(self, name, value)
+
+    def can(self):
+        return self.amount > 0
+
+    def to_json(self):
+        """
+        与 ``Movie.to_json`` 相同
+
+        :rtype: dict
+        """
+        return movie_json(self)
+
+    def __repr__(self):
+        return '<MovieItem %r>' % self.title
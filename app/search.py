@@ -0,0 +1,512 @@
+# -*- coding:utf-8 -*-
+import os
+import time
+import shutil
+import logging
+import tempfile
+
+import jieba
+import flask_sqlalchemy
+import flask_whooshalchemyplus
+import whoosh.index
+from flask import current_app
+from flask_sqlalchemy import Pagination
+from sqlalchemy import event, inspect, or_, select, text
+from sqlalchemy.orm import Session, object_session
+from whoosh.qparser import AndGroup, MultifieldParser, OrGroup
+from .cache import make_region
+
+try:
+    unicode
+except NameError:
+    unicode = str
+
+
+def normalize_query(query):
+    """
+    规范化查询字符串: 去掉首尾空白、合并连续空白并转为小写
+    """
+    return u' '.join(unicode(query).lower().split())
+
+
+def primary_key_name(model):
+    """
+    模型主键的列名
+    """
+    return inspect(model).primary_key[0].name
+
+
+def searchable_document(target):
+    """
+    按 ``__searchable__`` 取出需要索引的字段, 主键以字符串形式保存
+
+    :rtype: dict
+    """
+    model = target.__class__
+    document = dict((name, unicode(getattr(target, name)))
+                    for name in model.__searchable__)
+    pk = primary_key_name(model)
+    document[pk] = unicode(getattr(target, pk))
+    return document
+
+
+class WhooshBackend(object):
+    """
+    ..  note:: Whoosh 搜索后端
+
+        每个模型一个索引目录, 位于 ``base`` 下, 使用模型的 ``__analyzer__`` 分词。
+        索引只能在数据库提交之后写入, 因此 ``transactional`` 为 ``False``。
+
+    """
+
+    name = 'whoosh'
+    transactional = False
+
+    def __init__(self, app, base):
+        self.app = app
+        self.base = base
+        self.indexes = {}
+
+    def index(self, model):
+        """
+        打开模型的索引, 不存在时创建
+        """
+        index = self.indexes.get(model.__name__)
+        if index is None:
+            analyzer = flask_whooshalchemyplus._get_analyzer(self.app, model)
+            schema, _ = flask_whooshalchemyplus \
+                ._get_whoosh_schema_and_primary_key(model, analyzer)
+            path = os.path.join(self.base, model.__name__)
+            if whoosh.index.exists_in(path):
+                index = whoosh.index.open_dir(path)
+            else:
+                if not os.path.exists(path):
+                    os.makedirs(path)
+                index = whoosh.index.create_in(path, schema)
+            self.indexes[model.__name__] = index
+        return index
+
+    def prepare(self, model):
+        self.index(model)
+
+    def generation(self, model):
+        return self.index(model).latest_generation()
+
+    def search_ids(self, model, query, page, per_page, or_=False):
+        """
+        使用 ``search_page`` 在索引中分页, 返回总数和当前页的主键
+
+        :rtype: tuple
+        """
+        index = self.index(model)
+        parser = MultifieldParser(model.__searchable__, index.schema,
+                                  group=OrGroup if or_ else AndGroup)
+        pk = primary_key_name(model)
+        with index.searcher() as searcher:
+            hits = searcher.search_page(parser.parse(unicode(query)), page,
+                                        pagelen=per_page)
+            if hits.pagenum != page:
+                return hits.total, []
+            return hits.total, [hit[pk] for hit in hits]
+
+    def apply(self, model, documents, connection=None):
+        """
+        写入变更, ``documents`` 中值为 ``None`` 的主键表示删除
+        """
+        pk = primary_key_name(model)
+        with self.index(model).writer() as writer:
+            for key, document in documents.items():
+                if document is None:
+                    writer.delete_by_term(pk, key)
+                else:
+                    writer.update_document(**document)
+
+    def rebuild(self, model):
+        """
+        清空并重建模型的索引
+        """
+        self.drop(model)
+        with self.index(model).writer() as writer:
+            for row in model.query.enable_eagerloads(False).yield_per(1000):
+                writer.add_document(**searchable_document(row))
+
+    def size(self, model):
+        path = os.path.join(self.base, model.__name__)
+        return sum(os.path.getsize(os.path.join(path, name))
+                   for name in os.listdir(path))
+
+    def drop(self, model):
+        self.indexes.pop(model.__name__, None)
+        shutil.rmtree(os.path.join(self.base, model.__name__), True)
+
+
+class FTS5Backend(object):
+    """
+    ..  note:: SQLite FTS5 搜索后端
+
+        索引保存在同一个数据库的 FTS5 虚拟表中 (默认表名 ``<表名>_fts``),
+        ``rowid`` 即模型主键。写入前先用 ``jieba`` 切分并以空格连接,
+        FTS5 的 ``unicode61`` 分词器只需按空格拆分即可。
+
+        索引与数据在同一个事务中写入 (``transactional`` 为 ``True``),
+        不再需要独立的索引目录和写锁。每次写入同时递增
+        ``search_generations`` 表 (``SearchGeneration``) 中的版本号,
+        供结果缓存失效使用。虚拟表与版本表由迁移创建,
+        ``prepare`` 只为迁移之外注册的模型补建虚拟表。
+
+    """
+
+    name = 'fts5'
+    transactional = True
+
+    def __init__(self, app, table_format='%s_fts'):
+        self.app = app
+        self.table_format = table_format
+        self.engine = app.extensions['sqlalchemy'].db.get_engine(app)
+
+    def table(self, model):
+        return self.table_format % model.__tablename__
+
+    @staticmethod
+    def tokenize(value):
+        return u' '.join(token for token in jieba.cut_for_search(value)
+                         if token.strip())
+
+    def prepare(self, model):
+        with self.engine.begin() as connection:
+            connection.execute(
+                'CREATE VIRTUAL TABLE IF NOT EXISTS %s USING fts5(%s, '
+                "tokenize='unicode61')" % (self.table(model),
+                                           ', '.join(model.__searchable__)))
+
+    def generation(self, model):
+        return self.engine.execute(
+            text('SELECT generation FROM search_generations WHERE name = :name'),
+            name=self.table(model)).scalar() or 0
+
+    def match(self, query, or_=False):
+        """
+        把查询切分为 FTS5 的 ``MATCH`` 表达式, 每个词都加引号避免语法冲突
+        """
+        tokens = [u'"%s"' % token.replace(u'"', u'""')
+                  for token in self.tokenize(unicode(query).lower()).split()]
+        return (u' OR ' if or_ else u' AND ').join(tokens)
+
+    def search_ids(self, model, query, page, per_page, or_=False):
+        """
+        按 ``rank`` 排序分页, 返回总数和当前页的主键
+
+        :rtype: tuple
+        """
+        match = self.match(query, or_)
+        if not match:
+            return 0, []
+        table = self.table(model)
+        total = self.engine.execute(
+            text('SELECT count(*) FROM %s WHERE %s MATCH :match'
+                 % (table, table)), match=match).scalar()
+        rows = self.engine.execute(
+            text('SELECT rowid FROM %s WHERE %s MATCH :match ORDER BY rank '
+                 'LIMIT :limit OFFSET :offset' % (table, table)),
+            match=match, limit=per_page, offset=(page - 1) * per_page)
+        return total, [unicode(row[0]) for row in rows]
+
+    def apply(self, model, documents, connection=None):
+        """
+        在给定连接 (即当前 flush 所在的事务) 中写入变更
+        """
+        connection = connection or self.engine
+        table = self.table(model)
+        fields = model.__searchable__
+        delete = text('DELETE FROM %s WHERE rowid = :pk' % table)
+        insert = text('INSERT INTO %s (rowid, %s) VALUES (:pk, %s)'
+                      % (table, ', '.join(fields),
+                         ', '.join(':' + name for name in fields)))
+        for key, document in documents.items():
+            connection.execute(delete, pk=int(key))
+            if document is not None:
+                params = dict((name, self.tokenize(document[name].lower()))
+                              for name in fields)
+                params['pk'] = int(key)
+                connection.execute(insert, **params)
+        bumped = connection.execute(
+            text('UPDATE search_generations SET generation = generation + 1 '
+                 'WHERE name = :name'), name=table)
+        if not bumped.rowcount:
+            connection.execute(
+                text('INSERT INTO search_generations (name, generation) '
+                     'VALUES (:name, 1)'), name=table)
+
+    def rebuild(self, model):
+        """
+        清空并重建模型的索引
+        """
+        self.prepare(model)
+        pk = primary_key_name(model)
+        columns = [model.__table__.c[pk]] + \
+            [model.__table__.c[name] for name in model.__searchable__]
+        with self.engine.begin() as connection:
+            connection.execute('DELETE FROM %s' % self.table(model))
+            batch = {}
+            for row in connection.execute(select(columns)):
+                batch[unicode(row[pk])] = dict(
+                    (name, unicode(row[name])) for name in model.__searchable__)
+                if len(batch) >= 1000:
+                    self.apply(model, batch, connection)
+                    batch = {}
+            self.apply(model, batch, connection)
+
+    def size(self, model):
+        table = self.table(model)
+        try:
+            return self.engine.execute(
+                text('SELECT sum(pgsize) FROM dbstat WHERE name LIKE :name'),
+                name=table + '%').scalar() or 0
+        except Exception:
+            return self.engine.execute(
+                'SELECT sum(length(block)) FROM %s_data' % table).scalar() or 0
+
+    def drop(self, model):
+        with self.engine.begin() as connection:
+            connection.execute('DROP TABLE IF EXISTS %s' % self.table(model))
+            connection.execute(
+                text('DELETE FROM search_generations WHERE name = :name'),
+                name=self.table(model))
+
+
+def make_backend(app, name):
+    """
+    按名称创建搜索后端
+    """
+    if name == 'whoosh':
+        return WhooshBackend(app, app.config['WHOOSH_BASE'])
+    if name == 'fts5':
+        return FTS5Backend(app)
+    raise ValueError('unknown search backend %r' % name)
+
+
+class Search(object):
+    """
+    ..  note:: 全文搜索
+
+        ``Flask-WhooshAlchemyPlus`` 默认在每次提交时检查所有模型, 只要模型带有
+        ``__searchable__`` 就会打开索引写入器。这里改为按配置 ``SEARCHABLE_MODELS``
+        显式注册需要索引的模型, 其余模型不挂任何索引钩子。
+
+        对已注册的模型, 只有 ``__searchable__`` 中的列真正发生变化时才会更新索引,
+        因此借阅、归还只修改库存时不会产生任何索引读写。
+
+        索引的存储由 ``SEARCH_BACKEND`` 选择的后端负责 (``whoosh`` 或 ``fts5``)。
+        非事务型后端在提交之后写入, 事务型后端在 flush 的同一连接上写入。
+
+        搜索结果 (排序后的 id 列表与总数) 缓存在 ``search`` 缓存区域中,
+        键包含索引的 generation, 索引一旦提交新版本旧条目就不会再被读取。
+
+    """
+
+    def __init__(self, app=None):
+        self.models = {}
+        self.backend = None
+        self.cache = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('WHOOSH_BASE',
+                              flask_whooshalchemyplus.DEFAULT_WHOOSH_INDEX_NAME)
+        app.config.setdefault('WHOOSH_DISABLED', False)
+        app.config.setdefault('SEARCH_BACKEND', 'whoosh')
+        app.config.setdefault('SEARCHABLE_MODELS', [])
+        app.config.setdefault('SEARCH_CACHE_SIZE', 1024)
+        app.config.setdefault('SEARCH_CACHE_TTL', 600)
+        flask_sqlalchemy.models_committed.disconnect(
+            flask_whooshalchemyplus._after_flush)
+        app.extensions['search'] = self
+        self.cache = make_region(app, 'search',
+                                 app.config['SEARCH_CACHE_SIZE'],
+                                 app.config['SEARCH_CACHE_TTL'])
+        if app.config['WHOOSH_DISABLED']:
+            return
+        self.backend = make_backend(app, app.config['SEARCH_BACKEND'])
+        registry = app.extensions['sqlalchemy'].db.Model._decl_class_registry
+        for name in app.config['SEARCHABLE_MODELS']:
+            self.register(registry[name])
+            self.backend.prepare(registry[name])
+
+    def register(self, model):
+        """
+        注册需要索引的模型, 每个模型只挂一次映射事件
+        """
+        if model.__name__ in self.models:
+            return
+        self.models[model.__name__] = model
+        event.listen(model, 'after_insert', self._after_insert)
+        event.listen(model, 'after_update', self._after_update)
+        event.listen(model, 'after_delete', self._after_delete)
+        if not event.contains(Session, 'after_commit', self._after_commit):
+            event.listen(Session, 'after_commit', self._after_commit)
+            event.listen(Session, 'after_rollback', self._after_rollback)
+
+    def search_page(self, model, query, page, per_page, or_=False, load=None):
+        """
+        ..  note:: 在索引中完成分页
+
+            ``whoosh_search().paginate()`` 会把全部命中的 id 拼成 SQL ``IN`` 条件,
+            再执行一次 ``COUNT`` 和一次 ``OFFSET`` 查询, 开销随命中数增长。
+
+            这里由搜索后端直接分页, 总数取自结果集,
+            只按主键批量加载当前页的记录, 并保持相关度排序。
+            给出 ``load`` 时由它按 id 列表加载记录, 例如只读的行。
+            ``WHOOSH_DISABLED`` 时没有搜索后端, 总是返回空页。
+
+        :rtype: Pagination
+        """
+        page = max(page, 1)
+        if not query or self.backend is None:
+            return Pagination(None, page, per_page, 0, [])
+        key = '%s:%s:%d:%d:%d:%d:%s' % (
+            self.backend.name, model.__name__, self.backend.generation(model),
+            page, per_page, or_, normalize_query(query))
+        start = time.time()
+        cached = self.cache.get(key)
+        hit = cached is not None
+        if not hit:
+            cached = self.backend.search_ids(model, query, page, per_page, or_)
+            self.cache.set(key, cached)
+        metrics = current_app.extensions.get('metrics')
+        if metrics is not None:
+            metrics.observe_search(self.backend.name, time.time() - start,
+                                   hit)
+        total, ids = cached
+        if not ids:
+            return Pagination(None, page, per_page, total, [])
+        if load is not None:
+            return Pagination(None, page, per_page, total, load(ids))
+        pk = primary_key_name(model)
+        rows = dict((unicode(getattr(row, pk)), row)
+                    for row in model.query.filter(getattr(model, pk).in_(ids)))
+        items = [rows[key] for key in ids if key in rows]
+        return Pagination(None, page, per_page, total, items)
+
+    def reindex(self):
+        """
+        重建所有已注册模型的索引
+        """
+        for model in self.models.values():
+            self.backend.rebuild(model)
+
+    def stale_indexes(self, app):
+        """
+        ``WHOOSH_BASE`` 下不再使用的索引目录, 使用 ``fts5`` 后端时整个目录都不再需要
+
+        :rtype: list
+        """
+        base = app.config['WHOOSH_BASE']
+        if not os.path.isdir(base):
+            return []
+        keep = self.models if isinstance(self.backend, WhooshBackend) else {}
+        return [os.path.join(base, name) for name in sorted(os.listdir(base))
+                if name not in keep and
+                os.path.isdir(os.path.join(base, name))]
+
+    def clean(self, app):
+        """
+        删除过期的索引目录
+
+        :rtype: list
+        """
+        stale = self.stale_indexes(app)
+        for path in stale:
+            shutil.rmtree(path)
+        return stale
+
+    def _stage(self, target, connection, key, document):
+        model = target.__class__
+        if self.backend.transactional:
+            self.backend.apply(model, {key: document}, connection)
+        else:
+            object_session(target).info.setdefault('search_pending', {}) \
+                .setdefault(model.__name__, {})[key] = document
+
+    def _after_insert(self, mapper, connection, target):
+        document = searchable_document(target)
+        self._stage(target, connection,
+                    document[primary_key_name(target.__class__)], document)
+
+    def _after_update(self, mapper, connection, target):
+        state = inspect(target)
+        if any(state.attrs[name].history.has_changes()
+               for name in target.__searchable__):
+            self._after_insert(mapper, connection, target)
+
+    def _after_delete(self, mapper, connection, target):
+        key = unicode(getattr(target, primary_key_name(target.__class__)))
+        self._stage(target, connection, key, None)
+
+    def _after_commit(self, session):
+        pending = session.info.pop('search_pending', None)
+        if not pending:
+            return
+        for name, documents in pending.items():
+            try:
+                self.backend.apply(self.models[name], documents)
+            except Exception as ex:
+                logging.error('FAIL updating index of %s msg: %s' % (name, ex))
+
+    def _after_rollback(self, session):
+        session.info.pop('search_pending', None)
+
+
+def benchmark(app, model, queries, rounds=5, k=10):
+    """
+    ..  note:: 比较各搜索后端
+
+        在临时位置分别用 ``whoosh`` 与 ``fts5`` 重建 ``model`` 的索引,
+        对 ``queries`` 中的每条查询执行 ``rounds`` 次, 统计索引大小、
+        构建时间、p50/p99 延迟以及 recall@k。
+
+        recall@k 以 ``__searchable__`` 列的 ``LIKE`` 子串匹配作为参照集。
+
+    :rtype: list
+    """
+    columns = [getattr(model, name) for name in model.__searchable__]
+    pk = getattr(model, primary_key_name(model))
+    relevant = {}
+    for query in queries:
+        rows = model.query.with_entities(pk).filter(
+            or_(*[column.like(u'%' + query + u'%') for column in columns]))
+        relevant[query] = set(unicode(row[0]) for row in rows)
+
+    base = tempfile.mkdtemp()
+    backends = [WhooshBackend(app, base), FTS5Backend(app, '%s_fts_bench')]
+    report = []
+    try:
+        for backend in backends:
+            start = time.time()
+            backend.rebuild(model)
+            build = time.time() - start
+            latencies = []
+            recalls = []
+            for query in queries:
+                for _ in range(rounds):
+                    start = time.time()
+                    _, ids = backend.search_ids(model, query, 1, k)
+                    latencies.append(time.time() - start)
+                if relevant[query]:
+                    recalls.append(len(relevant[query] & set(ids)) /
+                                   float(min(k, len(relevant[query]))))
+            latencies.sort()
+            report.append({
+                'backend': backend.name,
+                'size': backend.size(model),
+                'build': build,
+                'p50': latencies[int(len(latencies) * 0.50)],
+                'p99': latencies[min(len(latencies) - 1,
+                                     int(len(latencies) * 0.99))],
+                'recall': sum(recalls) / len(recalls) if recalls else 0.0,
+            })
+    finally:
+        for backend in backends:
+            backend.drop(model)
+        shutil.rmtree(base, True)
+    return report
@@ -0,0 +1,249 @@
+# -*- coding:utf-8 -*-
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+from flask import current_app
+from werkzeug.security import generate_password_hash
+from . import db, loan_shards
+from .models import Movie, Record, Role, User
+
+GENRES = [u'剧情', u'喜剧', u'动作', u'爱情', u'科幻', u'动画', u'悬疑', u'惊悚',
+          u'犯罪', u'冒险', u'家庭', u'战争', u'奇幻', u'传记', u'音乐', u'历史',
+          u'纪录片', u'恐怖', u'歌舞', u'武侠']
+WORDS = [u'城市', u'夜晚', u'少年', u'记忆', u'远方', u'故事', u'秘密', u'河流',
+         u'英雄', u'旅程', u'风暴', u'月光', u'时间', u'沉默', u'天空', u'归来',
+         u'海洋', u'花园', u'战士', u'梦想', u'冬天', u'列车', u'灯塔', u'森林',
+         u'迷雾', u'黎明', u'边境', u'回声', u'火焰', u'镜子', u'星辰', u'山谷']
+SURNAMES = u'王李张刘陈杨黄赵吴周徐孙马朱胡郭何高林罗'
+PASSWORD = 'seed'
+
+
+def zipf_weights(n, s):
+    """
+    排名 ``1..n`` 的 Zipf 概率, 第 ``r`` 名正比于 ``1 / r ** s``
+
+    :rtype: numpy.ndarray
+    """
+    weights = 1.0 / np.arange(1, n + 1) ** s
+    return weights / weights.sum()
+
+
+def _popularity(rng, n, s):
+    # 打乱排名, 热度与 id 无关
+    weights = np.empty(n)
+    weights[rng.permutation(n)] = zipf_weights(n, s)
+    return weights
+
+
+def _print(message):
+    print(message)
+
+
+def _insert(table, rows, batch):
+    for start in range(0, len(rows), batch):
+        db.session.execute(table.insert(), rows[start:start + batch])
+
+
+class Progress(object):
+
+    def __init__(self, name, total, log):
+        self.name = name
+        self.total = total
+        self.log = log
+        self.done = 0
+        self.start = time.time()
+
+    def update(self, count):
+        self.done += count
+        elapsed = max(time.time() - self.start, 1e-6)
+        self.log('%-7s %10d / %-10d %8.0f rows/s' % (
+            self.name, self.done, self.total, self.done / elapsed))
+
+
+def seed_movies(rng, count, start_id, popularity, chunk, batch, log):
+    """
+    ..  note:: 生成影片
+
+        类型按热度不均的分布组合 1-3 个, 年份偏向近年, 评分近似正态分布。
+        历史借阅次数 ``counts`` 与热度成正比。
+
+    :return: 每部影片的库存
+    :rtype: numpy.ndarray
+    """
+    table = Movie.__table__
+    genre_weights = zipf_weights(len(GENRES), 0.8)
+    stock = rng.randint(50, 300, size=count)
+    history = rng.poisson(popularity * count * 20)
+    progress = Progress('movies', count, log)
+    for offset in range(0, count, chunk):
+        size = min(chunk, count - offset)
+        words = rng.randint(0, len(WORDS), size=(size, 2))
+        genre_counts = rng.randint(1, 4, size=size)
+        genres = rng.choice(len(GENRES), size=(size, 3), p=genre_weights)
+        years = np.clip(2017 - rng.exponential(15, size=size), 1920, 2016)
+        ratings = np.clip(rng.normal(7.0, 1.2, size=size), 2.0, 9.8)
+        people = rng.randint(0, 10 * count, size=(size, 4))
+        rows = []
+        for i in range(size):
+            n = offset + i
+            rows.append({
+                'id': start_id + n,
+                'title': u'%s%s%d' % (WORDS[words[i, 0]], WORDS[words[i, 1]],
+                                      start_id + n),
+                'original_title': u'Movie %d' % (start_id + n),
+                'directors': u'%s导演%d' % (SURNAMES[people[i, 0] % len(SURNAMES)],
+                                           people[i, 0]),
+                'casts': u' / '.join(u'%s演员%d' % (SURNAMES[p % len(SURNAMES)], p)
+                                     for p in people[i, 1:]),
+                'genres': u' / '.join(GENRES[g] for g in
+                                      _unique(genres[i, :genre_counts[i]])),
+                'year': int(years[i]),
+                'rating': round(float(ratings[i]), 1),
+                'amount': int(stock[n]),
+                'counts': int(history[n]),
+            })
+        _insert(table, rows, batch)
+        db.session.commit()
+        progress.update(size)
+    return stock
+
+
+def _unique(values):
+    seen = []
+    for value in values:
+        if value not in seen:
+            seen.append(value)
+    return seen
+
+
+def _user_rows(start_id, loans, role_id, password_hash, limit):
+    return [{
+        'id': start_id + i,
+        'email': 'user%d@seed.example.com' % (start_id + i),
+        'username': 'user%d' % (start_id + i),
+        'role_id': role_id,
+        'password_hash': password_hash,
+        'confirmed': True,
+        'amount': max(limit - int(loans[i]), 0),
+    } for i in range(loans.shape[0])]
+
+
+def sample_loans(rng, user_ids, counts, cdf, movie_start_id, tries=20):
+    """
+    ..  note:: 为一批用户按影片热度抽取借阅
+
+        同一用户抽到重复影片时重新抽取, ``tries`` 次后仍重复的丢弃。
+
+    :return: ``(customer_ids, movie_ids)``, 按用户排序
+    :rtype: tuple
+    """
+    customers = np.repeat(user_ids, counts)
+    movies = np.searchsorted(cdf, rng.random_sample(customers.shape[0]))
+    width = cdf.shape[0]
+    for _ in range(tries):
+        keys = customers * width + movies
+        order = np.argsort(keys, kind='mergesort')
+        duplicate = np.zeros(keys.shape[0], dtype=bool)
+        duplicate[order[1:]] = keys[order[1:]] == keys[order[:-1]]
+        if not duplicate.any():
+            break
+        movies[duplicate] = np.searchsorted(
+            cdf, rng.random_sample(int(duplicate.sum())))
+    keys = np.unique(customers * width + movies)
+    return keys // width, keys % width + movie_start_id
+
+
+def seed(movies, users, loans, seed=0, chunk=100000, batch=10000,
+         movie_skew=1.0, user_skew=0.7, mean_age=45, index=False, log=None):
+    """
+    ..  note:: 生成大规模的测试数据
+
+        1. 影片的借阅热度服从 Zipf 分布 (指数 ``movie_skew``),
+           用户的活跃度服从 Zipf 分布 (指数 ``user_skew``);
+        2. 每个用户的借阅数按活跃度取泊松分布, 总数约为 ``loans``;
+        3. 借阅时间按平均 ``mean_age`` 天的指数分布向前推,
+           一部分借阅会超过 ``OVERDUE_DAYS`` 成为逾期;
+        4. 借出的影片从库存 ``amount`` 中扣除, 计入借阅次数 ``counts``。
+
+        使用 SQLAlchemy Core 的批量插入, 每 ``batch`` 行执行一次,
+        每 ``chunk`` 行提交一次。相同的参数和 ``seed`` 生成相同的数据。
+        借阅分片时写入各自的分片。
+        数据追加在现有记录之后; 不触发搜索索引的映射事件,
+        ``index`` 为 ``True`` 时最后重建搜索索引。最后校正目录计数。
+
+    :return: 实际生成的影片、用户和借阅数量
+    :rtype: tuple
+    """
+    log = log or _print
+    rng = np.random.RandomState(seed)
+    Role.insert_roles()
+    db.session.commit()
+    movie_start = (db.session.query(db.func.max(Movie.id)).scalar() or 0) + 1
+    user_start = (db.session.query(db.func.max(User.id)).scalar() or 0) + 1
+
+    popularity = _popularity(rng, movies, movie_skew)
+    stock = seed_movies(rng, movies, movie_start, popularity, chunk, batch, log)
+
+    activity = _popularity(rng, users, user_skew)
+    counts = np.minimum(rng.poisson(activity * loans), movies)
+    cdf = np.cumsum(popularity)
+    cdf[-1] = 1.0
+    borrowed = np.zeros(movies, dtype=np.int64)
+    now = datetime.now().replace(microsecond=0)
+    # 所有用户使用同一个密码的哈希, 避免为每个用户计算哈希
+    role_id = Role.query.filter_by(default=True).first().id
+    password_hash = generate_password_hash(PASSWORD)
+    limit = current_app.config['MAX_BORROWED_NUMBER']
+    user_progress = Progress('users', users, log)
+    loan_progress = Progress('loans', int(counts.sum()), log)
+    total = 0
+    for offset in range(0, users, chunk):
+        size = min(chunk, users - offset)
+        first = user_start + offset
+        customers, movie_ids = sample_loans(
+            rng, np.arange(first, first + size), counts[offset:offset + size],
+            cdf, movie_start)
+        # 剩余可借数量为 MAX_BORROWED_NUMBER 减去已生成的借阅数, 最少为 0
+        per_user = np.bincount(customers - first, minlength=size)
+        _insert(User.__table__, _user_rows(first, per_user, role_id,
+                                           password_hash, limit), batch)
+        db.session.commit()
+        user_progress.update(size)
+
+        borrowed += np.bincount(movie_ids - movie_start, minlength=movies)
+        ages = rng.exponential(mean_age * 86400, size=customers.shape[0])
+        for start in range(0, customers.shape[0], chunk):
+            rows = [{'customer_id': int(customers[i]),
+                     'movie_id': int(movie_ids[i]),
+                     'timestamp': now - timedelta(seconds=int(ages[i]))}
+                    for i in range(start, min(start + chunk, customers.shape[0]))]
+            if loan_shards.enabled:
+                loan_shards.insert(rows, batch)
+            else:
+                _insert(Record.__table__, rows, batch)
+                db.session.commit()
+            total += len(rows)
+            loan_progress.update(len(rows))
+
+    # 借出的影片扣减库存
+    changed = np.nonzero(borrowed)[0]
+    for start in range(0, changed.shape[0], chunk):
+        db.session.execute(
+            Movie.__table__.update().where(Movie.id == db.bindparam('movie_id'))
+            .values(amount=db.bindparam('new_amount'),
+                    counts=Movie.counts + db.bindparam('borrowed')),
+            [{'movie_id': int(movie_start + i),
+              'new_amount': int(max(stock[i] - borrowed[i], 0)),
+              'borrowed': int(borrowed[i])}
+             for i in changed[start:start + chunk]])
+        db.session.commit()
+
+    from .counts import reconcile
+    reconcile()
+
+    if index:
+        from . import search
+        log('Rebuilding search index')
+        search.reindex()
+    return movies, users, total
@@ -0,0 +1,399 @@
+# -*- coding:utf-8 -*-
+import threading
+from datetime import datetime
+from flask import current_app, has_app_context
+from sqlalchemy import (Column, DateTime, Index, Integer, MetaData, Table,
+                        and_, event, inspect, select)
+from sqlalchemy.orm import Session
+
+SHARD_BIND = 'loans-%d'
+
+metadata = MetaData()
+
+#: 分片中的借阅表, 与 ``records`` 的列相同, 没有跨库的外键
+loans = Table(
+    'records', metadata,
+    Column('customer_id', Integer, primary_key=True, autoincrement=False),
+    Column('movie_id', Integer, primary_key=True, autoincrement=False),
+    Column('timestamp', DateTime, default=datetime.now),
+    Index('ix_records_timestamp_customer_id_movie_id',
+          'timestamp', 'customer_id', 'movie_id'),
+    Index('ix_records_movie_id', 'movie_id'),
+)
+
+
+class LoanConflict(Exception):
+    """
+    分片中的借阅与提交时的预期不一致, 例如同一借阅被并发归还
+    """
+    pass
+
+
+class LoanShards(object):
+    """
+    ..  note:: 按用户分片的借阅记录
+
+        ``LOAN_SHARDS`` 为分片数据库的地址列表, 每个分片注册为
+        ``loans-<序号>`` 绑定, 与主库一样执行 ``SQLITE_PRAGMAS``。
+        为空时借阅仍然保存在主库的 ``records`` 表, 行为不变。
+
+        分片映射: 用户 id 先对 ``LOAN_SHARD_BUCKETS`` 取模得到桶,
+        ``LOAN_SHARD_MAP[桶]`` 为分片序号, 默认按桶轮流分配。
+        一个用户的全部借阅在同一个分片, 借阅、归还和个人页面只访问一个分片。
+
+        影片库存和用户的剩余数量仍在主库。借阅与归还先记入会话,
+        主库事务提交前 (``before_commit``) 在分片上执行各自的短事务;
+        主库随后提交失败时撤销分片上的修改, 两边保持一致。
+
+        从单表迁移时先配置分片并打开 ``LOAN_SHARDS_FALLBACK``,
+        读取同时查询主库的 ``records``; 执行 ``manage.py split_loans``
+        把旧记录分批移入分片, 完成后关闭 ``LOAN_SHARDS_FALLBACK``。
+
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('LOAN_SHARDS', [])
+        app.config.setdefault('LOAN_SHARD_BUCKETS', 64)
+        app.config.setdefault('LOAN_SHARD_MAP', None)
+        app.config.setdefault('LOAN_SHARDS_FALLBACK', False)
+        app.config.setdefault('LOAN_SHARDS_BATCH', 1000)
+        shards = app.config['LOAN_SHARDS']
+        if shards:
+            if not app.config['LOAN_SHARD_MAP']:
+                app.config['LOAN_SHARD_MAP'] = [
+                    bucket % len(shards)
+                    for bucket in range(app.config['LOAN_SHARD_BUCKETS'])]
+            if len(app.config['LOAN_SHARD_MAP']) != \
+                    app.config['LOAN_SHARD_BUCKETS']:
+                raise ValueError('LOAN_SHARD_MAP must have '
+                                 'LOAN_SHARD_BUCKETS entries')
+            binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+            for index, url in enumerate(shards):
+                binds[SHARD_BIND % index] = url
+            app.config['SQLALCHEMY_BINDS'] = binds
+        app.extensions['loan_shards'] = self
+
+    @property
+    def enabled(self):
+        return bool(current_app.config['LOAN_SHARDS'])
+
+    def shard_of(self, customer_id):
+        """
+        用户所在的分片序号
+
+        :rtype: int
+        """
+        config = current_app.config
+        return config['LOAN_SHARD_MAP'][customer_id % config['LOAN_SHARD_BUCKETS']]
+
+    def engine(self, index):
+        from . import db
+        return db.get_engine(current_app, bind=SHARD_BIND % index)
+
+    def create_all(self):
+        """
+        在每个分片上建表, 已有的表补建缺少的索引
+        """
+        for index in range(len(current_app.config['LOAN_SHARDS'])):
+            engine = self.engine(index)
+            metadata.create_all(engine)
+            existing = set(item['name'] for item in
+                           inspect(engine).get_indexes(loans.name))
+            for item in loans.indexes:
+                if item.name not in existing:
+                    item.create(engine)
+
+    def _main(self):
+        from . import db
+        from .models import Record
+        return db.engine, Record.__table__
+
+    def sources(self):
+        """
+        ..  note:: 保存借阅的所有位置
+
+            每项为 ``(engine, table)``; 未分片或迁移期间包括主库。
+
+        :rtype: list
+        """
+        if not self.enabled:
+            return [self._main()]
+        sources = [(self.engine(index), loans)
+                   for index in range(len(current_app.config['LOAN_SHARDS']))]
+        if current_app.config['LOAN_SHARDS_FALLBACK']:
+            sources.append(self._main())
+        return sources
+
+    def sources_for(self, customer_ids):
+        """
+        ..  note:: 按位置分组用户
+
+        :return: ``(engine, table, customer_ids)`` 列表
+        :rtype: list
+        """
+        if not self.enabled:
+            return [self._main() + (list(customer_ids),)]
+        groups = {}
+        for customer_id in customer_ids:
+            groups.setdefault(self.shard_of(customer_id), []).append(customer_id)
+        sources = [(self.engine(index), loans, ids)
+                   for index, ids in sorted(groups.items())]
+        if current_app.config['LOAN_SHARDS_FALLBACK'] and customer_ids:
+            sources.append(self._main() + (list(customer_ids),))
+        return sources
+
+    def scatter(self, f):
+        """
+        ..  note:: 在所有位置上并行执行查询
+
+            每个位置一个线程调用 ``f(engine, table)``, 按 ``sources()``
+            的顺序返回结果, 由调用者合并。任一线程出错时抛出该异常。
+            ``f`` 只应使用 SQLAlchemy Core, 线程中没有程序上下文。
+
+        :rtype: list
+        """
+        sources = self.sources()
+        if len(sources) == 1:
+            return [f(*sources[0])]
+        results = [None] * len(sources)
+        errors = []
+
+        def run(i, engine, table):
+            try:
+                results[i] = f(engine, table)
+            except Exception as ex:
+                errors.append(ex)
+        threads = [threading.Thread(target=run, args=(i,) + source)
+                   for i, source in enumerate(sources)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+        return results
+
+    def is_borrowing(self, customer_id, movie_id):
+        """
+        用户是否正在借阅影片
+
+        :rtype: bool
+        """
+        for engine, table, _ in self.sources_for([customer_id]):
+            c = table.c
+            row = engine.execute(select([c.movie_id]).where(and_(
+                c.customer_id == customer_id, c.movie_id == movie_id))).first()
+            if row is not None:
+                return True
+        return False
+
+    def movie_ids(self, customer_id):
+        """
+        用户借阅中的影片 id, 按借阅时间排序
+
+        :rtype: list
+        """
+        rows = {}
+        for engine, table, _ in self.sources_for([customer_id]):
+            c = table.c
+            for row in engine.execute(select([c.timestamp, c.movie_id])
+                                      .where(c.customer_id == customer_id)):
+                # 迁移期间同一借阅可能同时在主库和分片
+                rows[row.movie_id] = row.timestamp
+        return sorted(rows, key=lambda movie_id: (rows[movie_id], movie_id))
+
+    def movie_borrowed(self, movie_id):
+        """
+        影片是否有人借阅
+
+        :rtype: bool
+        """
+        def first(engine, table):
+            return engine.execute(select([table.c.customer_id]).where(
+                table.c.movie_id == movie_id).limit(1)).first()
+        return any(row is not None for row in self.scatter(first))
+
+    def add(self, session, customer_id, movie_id):
+        """
+        记录借阅, 在会话提交时写入分片
+        """
+        session.info.setdefault('loan_ops', []).append(
+            ('add', customer_id, movie_id, datetime.now()))
+
+    def remove(self, session, customer_id, movie_id):
+        """
+        记录归还, 在会话提交时从分片删除
+        """
+        session.info.setdefault('loan_ops', []).append(
+            ('remove', customer_id, movie_id, None))
+
+    def apply(self, session, ops):
+        """
+        ..  note:: 在分片上执行借阅与归还
+
+            每个分片一个事务; 失败时撤销已提交的分片后抛出异常。
+            迁移期间只在主库的借阅通过 ``session`` 删除, 随主库事务提交或回滚。
+
+        :return: 撤销这些修改的操作
+        :rtype: list
+        """
+        groups = {}
+        for op in ops:
+            groups.setdefault(self.shard_of(op[1]), []).append(op)
+        undo = []
+        try:
+            for index, group in sorted(groups.items()):
+                undo.extend(self._apply(session, index, group))
+        except Exception:
+            self.undo(undo)
+            raise
+        return undo
+
+    def _apply(self, session, index, ops):
+        undo = []
+        c = loans.c
+        fallback = current_app.config['LOAN_SHARDS_FALLBACK']
+        with self.engine(index).begin() as connection:
+            for action, customer_id, movie_id, timestamp in ops:
+                key = and_(c.customer_id == customer_id, c.movie_id == movie_id)
+                if action == 'add':
+                    connection.execute(loans.insert().values(
+                        customer_id=customer_id, movie_id=movie_id,
+                        timestamp=timestamp))
+                    undo.append(('remove', customer_id, movie_id, None))
+                    continue
+                row = connection.execute(select([c.timestamp]).where(key)).first()
+                if row is not None:
+                    connection.execute(loans.delete().where(key))
+                    undo.append(('add', customer_id, movie_id, row.timestamp))
+                elif not (fallback and self._remove_main(session, customer_id,
+                                                         movie_id)):
+                    raise LoanConflict('loan (%d, %d) is not borrowed'
+                                       % (customer_id, movie_id))
+        return undo
+
+    def _remove_main(self, session, customer_id, movie_id):
+        _, table = self._main()
+        c = table.c
+        return session.execute(table.delete().where(and_(
+            c.customer_id == customer_id, c.movie_id == movie_id))).rowcount
+
+    def undo(self, ops):
+        """
+        撤销 ``apply`` 的修改, 失败时只记录日志
+        """
+        if not ops:
+            return
+        try:
+            groups = {}
+            for op in ops:
+                groups.setdefault(self.shard_of(op[1]), []).append(op)
+            for index, group in sorted(groups.items()):
+                c = loans.c
+                with self.engine(index).begin() as connection:
+                    for action, customer_id, movie_id, timestamp in group:
+                        key = and_(c.customer_id == customer_id,
+                                   c.movie_id == movie_id)
+                        if action == 'remove':
+                            connection.execute(loans.delete().where(key))
+                        else:
+                            connection.execute(loans.insert().values(
+                                customer_id=customer_id, movie_id=movie_id,
+                                timestamp=timestamp))
+        except Exception:
+            current_app.logger.exception('Failed to undo loan changes: %r', ops)
+
+    def insert(self, rows, batch=10000):
+        """
+        批量写入借阅, ``rows`` 为 ``records`` 的列字典
+        """
+        groups = {}
+        for row in rows:
+            groups.setdefault(self.shard_of(row['customer_id']), []).append(row)
+        for index, group in sorted(groups.items()):
+            with self.engine(index).begin() as connection:
+                for start in range(0, len(group), batch):
+                    connection.execute(loans.insert(), group[start:start + batch])
+
+    def split(self, batch=None, log=None):
+        """
+        ..  note:: 把主库 ``records`` 中的借阅移入分片
+
+            按主键顺序每次取 ``batch`` 行, 写入各自的分片后从主库删除,
+            每批是一组短事务, 程序可以照常运行 (需打开 ``LOAN_SHARDS_FALLBACK``)。
+            分片中已有的行跳过, 中断后再次执行即可继续。
+
+            从主库删除时行已不存在, 说明迁移期间被归还, 同时删除分片中的副本。
+
+        :return: 移动的行数
+        :rtype: int
+        """
+        batch = batch or current_app.config['LOAN_SHARDS_BATCH']
+        engine, table = self._main()
+        c = table.c
+        moved = 0
+        while True:
+            rows = engine.execute(
+                select([c.customer_id, c.movie_id, c.timestamp])
+                .order_by(c.customer_id, c.movie_id).limit(batch)).fetchall()
+            if not rows:
+                break
+            groups = {}
+            for row in rows:
+                groups.setdefault(self.shard_of(row.customer_id), []).append(row)
+            for index, group in sorted(groups.items()):
+                self._copy(index, group)
+            returned = []
+            with engine.begin() as connection:
+                for row in rows:
+                    result = connection.execute(table.delete().where(and_(
+                        c.customer_id == row.customer_id,
+                        c.movie_id == row.movie_id)))
+                    if not result.rowcount:
+                        returned.append(('remove', row.customer_id,
+                                         row.movie_id, None))
+            self.undo(returned)
+            moved += len(rows) - len(returned)
+            if log is not None:
+                log('Moved %d loans' % moved)
+        return moved
+
+    def _copy(self, index, rows):
+        c = loans.c
+        with self.engine(index).begin() as connection:
+            customers = set(row.customer_id for row in rows)
+            existing = set(
+                (row.customer_id, row.movie_id) for row in connection.execute(
+                    select([c.customer_id, c.movie_id])
+                    .where(c.customer_id.in_(customers))))
+            missing = [{'customer_id': row.customer_id, 'movie_id': row.movie_id,
+                        'timestamp': row.timestamp} for row in rows
+                       if (row.customer_id, row.movie_id) not in existing]
+            if missing:
+                connection.execute(loans.insert(), missing)
+
+
+@event.listens_for(Session, 'before_commit')
+def _apply_loans(session):
+    ops = session.info.pop('loan_ops', None)
+    if not ops or not has_app_context():
+        return
+    shards = current_app.extensions['loan_shards']
+    session.info.setdefault('loan_applied', []).extend(shards.apply(session, ops))
+
+
+@event.listens_for(Session, 'after_commit')
+def _forget_loans(session):
+    session.info.pop('loan_applied', None)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _undo_loans(session):
+    session.info.pop('loan_ops', None)
+    applied = session.info.pop('loan_applied', None)
+    if applied and has_app_context():
+        current_app.extensions['loan_shards'].undo(applied)
@@ -0,0 +1,231 @@
+# -*- coding:utf-8 -*-
+import os
+import zlib
+
+import jieba
+import numpy as np
+from flask import current_app
+from . import db
+from .models import Movie, Similarity
+
+
+def movie_features(title, genres, directors, casts):
+    """
+    ..  note:: 影片的内容特征
+
+        类型、导演、主演按 `` / `` 拆分, 片名用 ``jieba`` 分词,
+        各类特征加上前缀以免互相混淆。
+
+    :rtype: list
+    """
+    features = []
+    for prefix, value in (('g', genres), ('d', directors), ('c', casts)):
+        features.extend(u'%s:%s' % (prefix, item.strip())
+                        for item in (value or u'').split(' / ') if item.strip())
+    features.extend(u't:%s' % token for token in jieba.cut(title or u'')
+                    if token.strip())
+    return features
+
+
+def _bucket(feature, dims):
+    return (zlib.crc32(feature.encode('utf-8')) & 0xffffffff) % dims
+
+
+def _buckets(features, dims):
+    """
+    特征映射到的维度与次数, 维度升序
+
+    :rtype: tuple
+    """
+    buckets = np.array([_bucket(feature, dims) for feature in features],
+                       dtype=np.int32)
+    return np.unique(buckets, return_counts=True)
+
+
+def _row_sums(values, indptr):
+    """
+    按 CSR 的行求和, 没有元素的行为 0
+    """
+    sums = np.zeros((indptr.shape[0] - 1,) + values.shape[1:],
+                    dtype=values.dtype)
+    nonempty = np.flatnonzero(np.diff(indptr))
+    if nonempty.shape[0]:
+        sums[nonempty] = np.add.reduceat(values, indptr[nonempty] - indptr[0],
+                                         axis=0)
+    return sums
+
+
+def _normalize(matrix):
+    norms = np.sqrt((matrix * matrix).sum(axis=-1, keepdims=True))
+    norms[norms == 0] = 1
+    return matrix / norms
+
+
+def _paths():
+    directory = current_app.config['SIMILAR_DIR']
+    return dict((name, os.path.join(directory, name + '.npy'))
+                for name in ('ids', 'indptr', 'indices', 'weights', 'idf'))
+
+
+def _scores(queries, ids, indptr, indices, weights, segment):
+    """
+    ..  note:: ``queries`` 中每个向量与所有影片的余弦相似度
+
+        ``queries`` 为 ``维度 × 查询数`` 的稠密矩阵, 影片向量以 CSR 保存。
+        每次取 ``segment`` 个非零元素所在的行, 逐元素乘以对应维度的查询值后按行求和,
+        临时数组只有 ``segment × 查询数`` 个元素。
+
+    :return: ``查询数 × 影片数``
+    :rtype: numpy.ndarray
+    """
+    n = ids.shape[0]
+    scores = np.empty((queries.shape[1], n), dtype=np.float32)
+    start = 0
+    while start < n:
+        # 至少一行, 非零元素不超过 segment
+        end = max(start + 1, int(np.searchsorted(
+            indptr, indptr[start] + segment, side='right')) - 1)
+        end = min(end, n)
+        lo, hi = indptr[start], indptr[end]
+        contributions = np.asarray(weights[lo:hi])[:, None] * \
+            queries[np.asarray(indices[lo:hi])]
+        scores[:, start:end] = _row_sums(contributions, indptr[start:end + 1]).T
+        start = end
+    return scores
+
+
+def _top_k(scores, k):
+    k = min(k, scores.shape[-1])
+    if k <= 0:
+        return np.zeros(scores.shape[:-1] + (0,), dtype=np.int64)
+    top = np.argpartition(-scores, k - 1, axis=-1)[..., :k]
+    order = np.argsort(-np.take_along_axis(scores, top, axis=-1), axis=-1)
+    return np.take_along_axis(top, order, axis=-1)
+
+
+def build(k=None, memory=None):
+    """
+    ..  note:: 计算所有影片的相似影片
+
+        1. 特征经哈希映射到 ``SIMILAR_DIMENSIONS`` 维, 按 TF-IDF 加权后归一化;
+           每部影片只有十几个非零维度, 向量以 CSR (``indptr``/``indices``/``weights``)
+           保存, 不构造 ``影片数 × 维度`` 的稠密矩阵;
+        2. 每次取一块影片, 与全部向量计算余弦相似度 (``_scores``),
+           块的大小和每次处理的非零元素数量由 ``SIMILAR_MEMORY`` (字节) 决定,
+           内存占用与影片数成正比的只有 CSR 本身和一块的得分;
+        3. 取前 ``k`` 个 (排除自身) 写入 ``similarities`` 表;
+        4. CSR、``idf`` 与 id 保存在 ``SIMILAR_DIR``, 供单部影片增量更新。
+
+        计算量与 ``影片数² × 平均非零维度数`` 成正比, 应在 Web 进程之外执行。
+
+    """
+    config = current_app.config
+    k = k or config['SIMILAR_TOP_K']
+    memory = memory or config['SIMILAR_MEMORY']
+    dims = config['SIMILAR_DIMENSIONS']
+
+    ids = []
+    lengths = []
+    indices = []
+    counts = []
+    rows = db.session.query(Movie.id, Movie.title, Movie.genres,
+                            Movie.directors, Movie.casts) \
+        .order_by(Movie.id).yield_per(1000)
+    for row in rows:
+        buckets, times = _buckets(movie_features(
+            row.title, row.genres, row.directors, row.casts), dims)
+        ids.append(row.id)
+        lengths.append(buckets.shape[0])
+        indices.append(buckets)
+        counts.append(times)
+    n = len(ids)
+    ids = np.array(ids, dtype=np.int64)
+    indptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(lengths, out=indptr[1:])
+    indices = np.concatenate(indices) if n else np.zeros(0, dtype=np.int32)
+    weights = np.concatenate(counts).astype(np.float32) if n \
+        else np.zeros(0, dtype=np.float32)
+    df = np.bincount(indices, minlength=dims)
+    idf = (np.log((1.0 + n) / (1.0 + df)) + 1).astype(np.float32)
+    weights *= idf[indices]
+    norms = np.sqrt(_row_sums(weights * weights, indptr))
+    norms[norms == 0] = 1
+    weights /= np.repeat(norms, np.diff(indptr))
+
+    # 一半内存给一块的得分 (块 × 影片数), 一半给计算时的临时数组 (非零元素 × 块)
+    chunk = int(max(1, min(n, memory // 2 // (4 * max(n, 1)))))
+    segment = int(max(1, memory // 2 // (4 * chunk)))
+    table = Similarity.__table__
+    db.session.execute(table.delete())
+    for start in range(0, n, chunk):
+        end = min(start + chunk, n)
+        queries = np.zeros((dims, end - start), dtype=np.float32)
+        lo, hi = indptr[start], indptr[end]
+        queries[indices[lo:hi],
+                np.repeat(np.arange(end - start), np.diff(indptr[start:end + 1]))] = \
+            weights[lo:hi]
+        scores = _scores(queries, ids, indptr, indices, weights, segment)
+        diagonal = np.arange(end - start)
+        scores[diagonal, start + diagonal] = -1
+        top = _top_k(scores, k)
+        db.session.execute(table.insert(), [
+            {'movie_id': int(ids[start + i]),
+             'similar_ids': ','.join(str(ids[j]) for j in top[i]
+                                     if scores[i, j] > 0)}
+            for i in range(end - start)])
+    db.session.commit()
+
+    paths = _paths()
+    directory = os.path.dirname(paths['ids'])
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    for path in ('vectors.npy',):
+        # 早期版本保存的稠密矩阵
+        path = os.path.join(directory, path)
+        if os.path.exists(path):
+            os.remove(path)
+    np.save(paths['ids'], ids)
+    np.save(paths['indptr'], indptr)
+    np.save(paths['indices'], indices)
+    np.save(paths['weights'], weights)
+    np.save(paths['idf'], idf)
+
+
+def update_movie(movie):
+    """
+    ..  note:: 增量更新单部影片的相似影片
+
+        使用上次 ``build`` 保存的 ``idf`` 计算该影片的向量,
+        与已保存的 CSR 向量比较, 只更新这一部影片的记录。
+        尚未执行过 ``build`` 时不做任何事。
+
+        在修改和新增影片的请求中执行, 耗时与全部影片的非零元素数量成正比:
+        文件以 ``mmap`` 读取, 每次处理 ``SIMILAR_MEMORY`` 以内的一段,
+        100 万部影片约需读取 100 MB、耗时数百毫秒。目录更大时应改为
+        定期执行 ``manage.py similar``。
+
+    """
+    paths = _paths()
+    if not all(os.path.exists(path) for path in paths.values()):
+        return
+    config = current_app.config
+    arrays = dict((name, np.load(path, mmap_mode='r'))
+                  for name, path in paths.items())
+    idf = np.asarray(arrays['idf'])
+    ids = np.asarray(arrays['ids'])
+    buckets, times = _buckets(movie_features(
+        movie.title, movie.genres, movie.directors, movie.casts), idf.shape[0])
+    query = np.zeros((idf.shape[0], 1), dtype=np.float32)
+    query[buckets, 0] = times * idf[buckets]
+    query = _normalize(query.T).T
+    scores = _scores(query, ids, np.asarray(arrays['indptr']),
+                     arrays['indices'], arrays['weights'],
+                     max(1, config['SIMILAR_MEMORY'] // 8))[0]
+    scores[ids == movie.id] = -1
+    top = _top_k(scores, config['SIMILAR_TOP_K'])
+    similar_ids = ','.join(str(ids[j]) for j in top if scores[j] > 0)
+    if movie.similarity is None:
+        movie.similarity = Similarity(similar_ids=similar_ids)
+    else:
+        movie.similarity.similar_ids = similar_ids
+    db.session.add(movie)
@@ -0,0 +1,466 @@
+# -*- coding:utf-8 -*-
+import os
+import json
+import time
+import shutil
+import logging
+import threading
+
+import numpy as np
+from flask import current_app, has_app_context, url_for
+from flask_sqlalchemy import Pagination
+from sqlalchemy import event, inspect, select
+from sqlalchemy.orm import Session
+
+CURRENT = 'CURRENT'
+TEXT_FIELDS = ('title', 'original_title', 'directors', 'casts', 'genres',
+               'images', 'alt')
+ORDERS = ('id', 'rating', 'year', 'counts')
+CATALOG_COLUMNS = TEXT_FIELDS + ('year', 'rating', 'counts')
+# 编辑影片时修改的列; counts 随借阅按增量变化, 只影响排序, 在下次重建时更新
+EDITED_COLUMNS = TEXT_FIELDS + ('year', 'rating')
+# 不会与当前版本号相同的值, 见 build
+UNKNOWN_VERSION = 0xffffffffffffffff
+# 任一影片新增、删除或编辑后递增, 列表与整页缓存据此判断快照是否过期
+CATALOG_KEY = 'catalog'
+# 批量更新目录列后递增, 无法知道修改了哪些影片, 所有详情都不再读取快照
+CATALOG_BULK_KEY = 'catalog:bulk'
+
+
+def _load(path):
+    try:
+        return np.load(path, mmap_mode='r')
+    except ValueError:
+        # 长度为 0 的数组无法映射
+        return np.load(path)
+
+
+def catalog_key(movie_id):
+    """
+    影片目录字段的版本号名称
+    """
+    return 'catalog:%d' % movie_id
+
+
+class MovieRow(object):
+    """
+    ..  note:: 快照中的一部影片
+
+        只读, 属性与 ``Movie`` 的目录字段同名, 模板可以直接使用。
+
+    """
+    __slots__ = ('id', 'year', 'rating', 'counts', 'version', '_snapshot',
+                 '_position') + TEXT_FIELDS
+
+    def __init__(self, snapshot, position):
+        self._snapshot = snapshot
+        self._position = position
+        self.id = int(snapshot.ids[position])
+        year = int(snapshot.year[position])
+        self.year = year if year >= 0 else None
+        self.rating = float(snapshot.rating[position])
+        self.counts = int(snapshot.counts[position])
+        self.version = int(snapshot.version[position]) \
+            if snapshot.version is not None else None
+        for i, name in enumerate(TEXT_FIELDS):
+            setattr(self, name, snapshot.field(position, i))
+
+    def to_json(self):
+        """
+        与 ``Movie.to_json`` 相同
+
+        :rtype: dict
+        """
+        return json.loads(self.json_fragment())
+
+    def json_fragment(self):
+        """
+        预先生成的 JSON 加上链接
+
+        :rtype: str
+        """
+        return self._snapshot.fragment(self._position, self.id)
+
+    def __repr__(self):
+        return '<MovieRow %r>' % self.title
+
+
+class CatalogSnapshot(object):
+    """
+    ..  note:: 一代目录快照
+
+        目录中每个数组都是一个 ``.npy`` 文件, 以 ``mmap`` 只读打开,
+        数据由操作系统的页缓存在进程之间共享, 只有访问到的页才会读入。
+
+        * ``ids``: 影片 id, 升序;
+        * ``rating``/``year``/``counts``/``version``: 按 ``ids`` 的位置排列;
+        * ``key_version``: 生成时每部影片的 ``catalog_key`` 版本号 (``ModelCache``),
+          与当前版本号不同说明之后修改或删除过;
+        * ``catalog_version``: 生成时 ``CATALOG_KEY`` 与 ``CATALOG_BULK_KEY``
+          的版本号, 与当前版本号不同说明之后目录有修改;
+        * ``order_<字段>``: 按该字段降序 (相同时按 id 升序) 的位置;
+        * ``text``/``text_offsets``: 文本字段的 UTF-8 数据与偏移;
+        * ``json``/``json_offsets``: 每部影片 ``to_json`` 中除链接以外的部分。
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.generation = os.path.basename(path)
+        self.ids = _load(os.path.join(path, 'ids.npy'))
+        self.rating = _load(os.path.join(path, 'rating.npy'))
+        self.year = _load(os.path.join(path, 'year.npy'))
+        self.counts = _load(os.path.join(path, 'counts.npy'))
+        # 早期的快照没有版本号
+        version = os.path.join(path, 'version.npy')
+        self.version = _load(version) if os.path.exists(version) else None
+        key_version = os.path.join(path, 'key_version.npy')
+        self.key_version = _load(key_version) \
+            if os.path.exists(key_version) else None
+        catalog_version = os.path.join(path, 'catalog_version.npy')
+        self.catalog_version = _load(catalog_version) \
+            if os.path.exists(catalog_version) else None
+        self._text = _load(os.path.join(path, 'text.npy'))
+        self._text_offsets = _load(os.path.join(path, 'text_offsets.npy'))
+        self._json = _load(os.path.join(path, 'json.npy'))
+        self._json_offsets = _load(os.path.join(path, 'json_offsets.npy'))
+        self.orders = dict((order, _load(os.path.join(path, 'order_%s.npy' % order)))
+                           for order in ORDERS if order != 'id')
+
+    def __len__(self):
+        return self.ids.shape[0]
+
+    def position(self, id):
+        """
+        影片在快照中的位置, 不存在时为 ``None``
+        """
+        i = int(np.searchsorted(self.ids, id))
+        if i < len(self) and self.ids[i] == id:
+            return i
+        return None
+
+    def _unchanged(self, index, name):
+        from . import model_cache
+        return int(self.catalog_version[index]) == model_cache.key_version(name)
+
+    def outdated(self):
+        """
+        生成快照之后目录有修改, 列表应当从数据库读取
+
+        :rtype: bool
+        """
+        return self.catalog_version is None or \
+            not self._unchanged(0, CATALOG_KEY)
+
+    def fresh(self, position):
+        """
+        影片在生成快照之后没有被修改或删除
+
+        :rtype: bool
+        """
+        from . import model_cache
+        if self.key_version is None or self.catalog_version is None or \
+                not self._unchanged(1, CATALOG_BULK_KEY):
+            return False
+        id = int(self.ids[position])
+        return int(self.key_version[position]) == \
+            model_cache.key_version(catalog_key(id))
+
+    def field(self, position, field):
+        i = position * len(TEXT_FIELDS) + field
+        start, end = int(self._text_offsets[i]), int(self._text_offsets[i + 1])
+        return self._text[start:end].tobytes().decode('utf-8')
+
+    def fragment(self, position, id):
+        start = int(self._json_offsets[position])
+        end = int(self._json_offsets[position + 1])
+        return '{%s, "api": %s, "alt": %s}' % (
+            self._json[start:end].tobytes().decode('ascii'),
+            json.dumps(url_for('api.get_movie', id=id, _external=True)),
+            json.dumps(url_for('main.movie', id=id, _external=True)))
+
+    def get(self, id):
+        """
+        按 id 取出影片, 不存在或者生成之后修改过时为 ``None``,
+        调用者回退到数据库
+
+        :rtype: MovieRow
+        """
+        position = self.position(id)
+        if position is None or not self.fresh(position):
+            return None
+        return MovieRow(self, position)
+
+    def paginate(self, order, page, per_page):
+        """
+        ..  note:: 分页
+
+            ``order`` 为 ``id`` (升序) 或 ``rating``/``year``/``counts`` (降序)。
+            与 ``error_out=False`` 的 ``paginate`` 一样, 超出范围的页为空。
+
+            生成之后目录有修改时 (``outdated``) 返回 ``None``, 调用者从数据库分页:
+            新增、删除的影片和修改过的排序字段会改变每一页的内容与总数,
+            不能只替换这一页中修改过的行。
+
+        :rtype: flask_sqlalchemy.Pagination
+        """
+        if self.outdated():
+            return None
+        page = max(page, 1)
+        start = (page - 1) * per_page
+        end = min(start + per_page, len(self))
+        if order == 'id':
+            positions = range(start, end)
+        else:
+            positions = self.orders[order][start:end]
+        items = [MovieRow(self, int(i)) for i in positions]
+        return Pagination(None, page, per_page, len(self), items)
+
+
+def build(directory=None, keep=2):
+    """
+    ..  note:: 导出目录快照并发布为新的一代
+
+        在 ``directory`` 下的临时目录写入所有数组, 完成后重命名为
+        ``<毫秒时间戳>-<pid>``, 再原子地替换 ``CURRENT`` 文件。
+        进程在下次检查时切换到新的一代; 只保留最新的 ``keep`` 代,
+        已经映射旧文件的进程不受删除影响。
+
+    ``key_version`` 与 ``catalog_version`` 在查询影片之前读取,
+    之后提交的修改会使对应的影片不再新鲜、快照的列表过期;
+    查询期间新增的影片没有读取到版本号, 记为 ``UNKNOWN_VERSION``。
+
+    :return: 新的一代的名称与影片数量
+    :rtype: tuple
+    """
+    from . import db, model_cache
+    from .models import Movie, movie_json
+    directory = directory or current_app.config['CATALOG_SNAPSHOT_DIR']
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    generation = '%d-%d' % (int(time.time() * 1000), os.getpid())
+
+    table = Movie.__table__
+    catalog_version = np.array([model_cache.key_version(CATALOG_KEY),
+                                model_cache.key_version(CATALOG_BULK_KEY)],
+                               dtype=np.uint64)
+    key_versions = dict(
+        (id, model_cache.key_version(catalog_key(id))) for id, in
+        db.session.execute(select([table.c.id])).fetchall())
+    rows = db.session.execute(
+        select([table.c.id, table.c.version] +
+               [table.c[name] for name in CATALOG_COLUMNS])
+        .order_by(table.c.id)).fetchall()
+    n = len(rows)
+    ids = np.array([row.id for row in rows], dtype=np.int64)
+    rating = np.array([row.rating or 0 for row in rows], dtype=np.float64)
+    year = np.array([row.year if row.year is not None else -1 for row in rows],
+                    dtype=np.int32)
+    counts = np.array([row.counts or 0 for row in rows], dtype=np.int64)
+    version = np.array([row.version for row in rows], dtype=np.int64)
+    key_version = np.array([key_versions.get(row.id, UNKNOWN_VERSION)
+                            for row in rows], dtype=np.uint64)
+
+    text = bytearray()
+    text_offsets = [0]
+    fragments = bytearray()
+    json_offsets = [0]
+    for row in rows:
+        for name in TEXT_FIELDS:
+            text.extend((row[name] or u'').encode('utf-8'))
+            text_offsets.append(len(text))
+        fragment = json.dumps(movie_json(row, links=False), sort_keys=True)
+        fragments.extend(fragment[1:-1].encode('ascii'))
+        json_offsets.append(len(fragments))
+
+    arrays = {
+        'ids': ids,
+        'rating': rating,
+        'year': year,
+        'counts': counts,
+        'version': version,
+        'key_version': key_version,
+        'catalog_version': catalog_version,
+        'text': np.frombuffer(bytes(text), dtype=np.uint8),
+        'text_offsets': np.array(text_offsets, dtype=np.int64),
+        'json': np.frombuffer(bytes(fragments), dtype=np.uint8),
+        'json_offsets': np.array(json_offsets, dtype=np.int64),
+    }
+    positions = np.arange(n)
+    for name, values in (('rating', rating), ('year', year), ('counts', counts)):
+        # 降序, 相同时按 id 升序; ids 已经升序, 位置即 id 的次序
+        arrays['order_' + name] = np.lexsort((positions, -values)).astype(np.int32)
+
+    staging = os.path.join(directory, '.' + generation)
+    os.makedirs(staging)
+    for name, array in arrays.items():
+        np.save(os.path.join(staging, name + '.npy'), array)
+    os.rename(staging, os.path.join(directory, generation))
+    _publish(directory, generation)
+    _prune(directory, keep)
+    return generation, n
+
+
+def _publish(directory, generation):
+    path = os.path.join(directory, CURRENT)
+    staging = '%s.%d' % (path, os.getpid())
+    with open(staging, 'w') as f:
+        f.write(generation)
+    os.rename(staging, path)
+
+
+def _generations(directory):
+    return sorted((name for name in os.listdir(directory)
+                   if not name.startswith('.') and name != CURRENT and
+                   os.path.isdir(os.path.join(directory, name))),
+                  key=lambda name: [int(part) for part in name.split('-')])
+
+
+def _prune(directory, keep):
+    for name in _generations(directory)[:-keep]:
+        shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
+
+
+class Catalog(object):
+    """
+    ..  note:: 只读的目录快照
+
+        ``CATALOG_SNAPSHOT_DIR`` 中发布了快照后, 首页和 API 的影片列表、
+        详情直接读取快照, 不使用数据库连接。
+        每隔 ``CATALOG_SNAPSHOT_CHECK`` 秒检查一次 ``CURRENT``,
+        发布了新的一代时切换; 没有快照时 ``current()`` 返回 ``None``,
+        调用者回退到数据库。
+
+        快照由 ``manage.py catalog_snapshot`` 生成, 生成一次需要扫描整个
+        ``movies`` 表, 应由 cron 等在 Web 进程之外定期执行, 例如每 10 分钟::
+
+            */10 * * * * cd /srv/movie && python manage.py catalog_snapshot
+
+        提交了影片的新增、删除或编辑后, 在下一次生成之前:
+
+        * 列表不读取快照 (``CatalogSnapshot.paginate`` 返回 ``None``),
+          首页的整页缓存也改用 ``movies`` 表的版本号;
+        * 修改或删除过的影片的详情不读取快照, ``CatalogSnapshot.get``
+          返回 ``None``, 调用者从数据库读取当前的内容和 ``ETag``;
+          其他影片的详情照常读取快照。
+
+        借阅和归还只按增量修改库存与借阅次数 (``increment``), 快照不过期,
+        借阅次数的排序在下次生成时更新。
+
+        ``CATALOG_SNAPSHOT_REBUILD`` 打开时 (默认关闭), 已经发布了快照的情况下,
+        提交了目录的修改后还会在本进程的后台线程中重新生成, 只适合小型目录和开发环境:
+        同一进程中同时只有一个重建任务, 期间的修改合并到下一次, 进程退出时丢失。
+
+    """
+
+    def __init__(self, app=None):
+        self._snapshot = None
+        self._checked = 0
+        self._lock = threading.Lock()
+        self._rebuilding = False
+        self._pending = False
+        self._listening = False
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('CATALOG_SNAPSHOT_DIR', 'catalog')
+        app.config.setdefault('CATALOG_SNAPSHOT_CHECK', 5)
+        app.config.setdefault('CATALOG_SNAPSHOT_REBUILD', False)
+        app.extensions['catalog'] = self
+        if not self._listening:
+            from .models import Movie
+            self._listening = True
+            event.listen(Movie, 'after_insert', self._changed)
+            event.listen(Movie, 'after_update', self._updated)
+            event.listen(Movie, 'after_delete', self._changed)
+            event.listen(Session, 'after_bulk_update', self._bulk_changed)
+            event.listen(Session, 'after_commit', self._after_commit)
+            event.listen(Session, 'after_rollback', self._after_rollback)
+
+    def current(self):
+        """
+        当前的快照, 没有发布时为 ``None``
+
+        :rtype: CatalogSnapshot
+        """
+        now = time.time()
+        if now - self._checked < current_app.config['CATALOG_SNAPSHOT_CHECK']:
+            return self._snapshot
+        with self._lock:
+            if now - self._checked >= current_app.config['CATALOG_SNAPSHOT_CHECK']:
+                self._snapshot = self._open(current_app.config['CATALOG_SNAPSHOT_DIR'])
+                self._checked = now
+        return self._snapshot
+
+    def _open(self, directory):
+        try:
+            with open(os.path.join(directory, CURRENT)) as f:
+                generation = f.read().strip()
+        except IOError:
+            return None
+        if self._snapshot is not None and self._snapshot.generation == generation:
+            return self._snapshot
+        try:
+            return CatalogSnapshot(os.path.join(directory, generation))
+        except (IOError, OSError, ValueError) as ex:
+            logging.error('FAIL opening catalog snapshot %s msg: %s'
+                          % (generation, ex))
+            return self._snapshot
+
+    def _changed(self, mapper, connection, target):
+        from . import model_cache
+        session = Session.object_session(target)
+        if session is not None:
+            model_cache.mark_keys(session, catalog_key(target.id), CATALOG_KEY)
+            session.info['catalog_changed'] = True
+
+    def _updated(self, mapper, connection, target):
+        state = inspect(target)
+        if any(state.attrs[name].history.has_changes()
+               for name in EDITED_COLUMNS):
+            self._changed(mapper, connection, target)
+
+    def _bulk_changed(self, update_context):
+        if update_context.mapper.local_table.name != 'movies':
+            return
+        names = set(getattr(key, 'key', key) for key in update_context.values)
+        if names.intersection(EDITED_COLUMNS):
+            from . import model_cache
+            model_cache.mark_keys(update_context.session,
+                                  CATALOG_KEY, CATALOG_BULK_KEY)
+            update_context.session.info['catalog_changed'] = True
+
+    def _after_commit(self, session):
+        if not session.info.pop('catalog_changed', False) or \
+                not has_app_context() or \
+                not current_app.config['CATALOG_SNAPSHOT_REBUILD'] or \
+                self.current() is None:
+            return
+        with self._lock:
+            if self._rebuilding:
+                self._pending = True
+                return
+            self._rebuilding = True
+        thread = threading.Thread(target=self._rebuild,
+                                  args=[current_app._get_current_object()])
+        thread.daemon = True
+        thread.start()
+
+    def _after_rollback(self, session):
+        session.info.pop('catalog_changed', None)
+
+    def _rebuild(self, app):
+        from . import db
+        while True:
+            try:
+                with app.app_context():
+                    build()
+                    db.session.remove()
+            except Exception as ex:
+                logging.error('FAIL rebuilding catalog snapshot msg: %s' % ex)
+            with self._lock:
+                if not self._pending:
+                    self._rebuilding = False
+                    return
+                self._pending = False
@@ -0,0 +1,311 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+"""
+..  note:: 主要用户路径的负载基准
+
+    使用 ``create_app('testing')`` 启动程序, 在独立的数据库中生成数据,
+    按权重混合以下场景, 由 ``--concurrency`` 个线程各自持有一个测试客户端并发执行:
+
+    * ``index``: 首页分页
+    * ``movie``: 影片详情
+    * ``search``: 搜索, 关键词取自 ``benchmarks/search_queries.txt``
+    * ``borrow`` / ``return``: 登录用户借阅后归还
+    * ``api_list`` / ``api_detail``: 使用令牌认证的 API 列表与详情
+
+    输出每个场景的吞吐量、p50/p95/p99 延迟 (毫秒) 以及每个请求的查询数,
+    结果写入 JSON, ``--compare`` 可以与上一次的结果对比::
+
+        python benchmarks/load.py -c 8 -d 30 -o before.json
+        python benchmarks/load.py -c 8 -d 30 -o after.json --compare before.json
+
+    请求在进程内执行, 不经过网络与 WSGI 服务器, 测得的是程序本身的开销。
+
+"""
+import os
+import sys
+import json
+import math
+import time
+import random
+import argparse
+import platform
+import threading
+import subprocess
+from base64 import b64encode
+
+basedir = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+sys.path.insert(0, basedir)
+os.environ.setdefault('TEST_DATABASE_URL', 'sqlite:///' + os.path.join(
+    basedir, 'tmp', 'bench.sqlite'))
+
+from flask_sqlalchemy import get_debug_queries
+from app import create_app, db, search
+from app.models import Movie, Role, User
+from app.counts import reconcile
+
+PASSWORD = 'benchmark'
+GENRES = [u'剧情', u'喜剧', u'动作', u'爱情', u'科幻', u'动画', u'悬疑', u'惊悚',
+          u'犯罪', u'冒险', u'家庭', u'战争', u'奇幻', u'传记', u'音乐']
+WORDS = [u'城市', u'夜晚', u'少年', u'记忆', u'远方', u'故事', u'秘密', u'河流',
+         u'英雄', u'旅程', u'风暴', u'月光', u'时间', u'沉默', u'天空', u'归来']
+
+
+def load_queries():
+    with open(os.path.join(basedir, 'benchmarks', 'search_queries.txt')) as f:
+        return [line.strip().decode('utf-8') if isinstance(line, bytes)
+                else line.strip() for line in f if line.strip()]
+
+
+def seed(movies, users, queries, rng):
+    """
+    ..  note:: 生成基准数据
+
+        片名由关键词和随机词语组成, 保证搜索场景有命中。
+        写入后重建搜索索引。
+
+    """
+    db.drop_all()
+    db.create_all()
+    Role.insert_roles()
+    rows = []
+    for i in range(movies):
+        title = u'%s%s%d' % (queries[i % len(queries)], rng.choice(WORDS), i)
+        rows.append({
+            'title': title,
+            'original_title': u'Movie %d' % i,
+            'directors': u'导演%d' % rng.randint(1, movies // 5 + 1),
+            'casts': u' / '.join(u'演员%d' % rng.randint(1, movies // 2 + 1)
+                                 for _ in range(3)),
+            'genres': u' / '.join(rng.sample(GENRES, 2)),
+            'year': rng.randint(1950, 2016),
+            'rating': round(rng.uniform(2, 10), 1),
+            'amount': 200,
+            'counts': 0,
+        })
+    db.session.execute(Movie.__table__.insert(), rows)
+    for i in range(users):
+        db.session.add(User(email='bench%d@example.com' % i,
+                            username='bench%d' % i,
+                            password=PASSWORD, confirmed=True))
+    db.session.commit()
+    reconcile()
+    search.reindex()
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[max(0, int(math.ceil(p / 100.0 * len(values))) - 1)]
+
+
+class Worker(object):
+    """
+    每个线程一个测试客户端, 登录一个用户并持有一个 API 令牌
+    """
+
+    def __init__(self, app, index, movies, queries, seed):
+        self.client = app.test_client()
+        self.rng = random.Random(seed + index)
+        self.movies = movies
+        self.queries = queries
+        self.pages = max(1, movies // app.config['FLASKY_POSTS_PER_PAGE'])
+        self.api_pages = max(1, movies // app.config['FLASKY_JSONS_PER_PAGE'])
+        email = 'bench%d@example.com' % index
+        self.client.post('/login', data={'email': email,
+                                              'password': PASSWORD})
+        response = self.client.get('/api/v1/token', headers=self._basic(
+            email, PASSWORD))
+        self.token = json.loads(response.data.decode('utf-8'))['token']
+        self.samples = []
+
+    @staticmethod
+    def _basic(username, password):
+        credentials = ('%s:%s' % (username, password)).encode('utf-8')
+        return {'Authorization': 'Basic ' + b64encode(credentials).decode('ascii')}
+
+    def request(self, name, url, **kwargs):
+        start = time.time()
+        response = self.client.get(url, **kwargs)
+        self.samples.append((name, time.time() - start, response.status_code,
+                             int(response.headers.get('X-Bench-Queries', 0))))
+
+    def index(self):
+        self.request('index', '/?page=%d' % self.rng.randint(1, self.pages))
+
+    def movie(self):
+        self.request('movie', '/movie/%d' % self.rng.randint(1, self.movies))
+
+    def search(self):
+        self.request('search', '/search',
+                     query_string={'q': self.rng.choice(self.queries)})
+
+    def borrow_return(self):
+        id = self.rng.randint(1, self.movies)
+        self.request('borrow', '/borrow/%d' % id)
+        self.request('return', '/return/%d' % id)
+
+    def api_list(self):
+        self.request('api_list', '/api/v1/movies/?page=%d' %
+                     self.rng.randint(1, self.api_pages),
+                     headers=self._basic(self.token, ''))
+
+    def api_detail(self):
+        self.request('api_detail', '/api/v1/movies/%d' %
+                     self.rng.randint(1, self.movies),
+                     headers=self._basic(self.token, ''))
+
+
+SCENARIOS = [
+    ('index', 30),
+    ('movie', 25),
+    ('search', 15),
+    ('borrow_return', 10),
+    ('api_list', 10),
+    ('api_detail', 10),
+]
+
+
+def run(app, args, queries):
+    workers = [Worker(app, i, args.movies, queries, args.seed)
+               for i in range(args.concurrency)]
+    names = [name for name, _ in SCENARIOS]
+    weights = [weight for _, weight in SCENARIOS]
+    deadline = [0]
+    per_worker = args.requests // args.concurrency if args.requests else None
+
+    def loop(worker):
+        done = 0
+        while (per_worker is None and time.time() < deadline[0]) or \
+                (per_worker is not None and done < per_worker):
+            getattr(worker, _weighted(worker.rng, names, weights))()
+            done += 1
+
+    for worker in workers:
+        for _ in range(args.warmup):
+            getattr(worker, _weighted(worker.rng, names, weights))()
+        worker.samples = []
+    threads = [threading.Thread(target=loop, args=[worker]) for worker in workers]
+    start = time.time()
+    deadline[0] = start + args.duration
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+    return elapsed, [sample for worker in workers for sample in worker.samples]
+
+
+def _weighted(rng, names, weights):
+    point = rng.uniform(0, sum(weights))
+    for name, weight in zip(names, weights):
+        point -= weight
+        if point <= 0:
+            return name
+    return names[-1]
+
+
+def summarize(elapsed, samples):
+    groups = {'all': samples}
+    for sample in samples:
+        groups.setdefault(sample[0], []).append(sample)
+    result = {}
+    for name, group in groups.items():
+        latencies = [sample[1] * 1000 for sample in group]
+        result[name] = {
+            'requests': len(group),
+            'errors': sum(1 for sample in group if sample[2] >= 400),
+            'throughput': len(group) / elapsed,
+            'p50': percentile(latencies, 50),
+            'p95': percentile(latencies, 95),
+            'p99': percentile(latencies, 99),
+            'queries': sum(sample[3] for sample in group) / float(len(group) or 1),
+        }
+    return result
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=basedir).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_report(result, baseline=None):
+    print('%-12s %8s %6s %9s %9s %9s %9s %7s' % (
+        'scenario', 'requests', 'errors', 'req/s', 'p50(ms)', 'p95(ms)',
+        'p99(ms)', 'q/req'))
+    for name in sorted(result, key=lambda name: (name == 'all', name)):
+        row = result[name]
+        print('%-12s %8d %6d %9.1f %9.2f %9.2f %9.2f %7.1f' % (
+            name, row['requests'], row['errors'], row['throughput'],
+            row['p50'], row['p95'], row['p99'], row['queries']))
+        old = (baseline or {}).get(name)
+        if old:
+            print('%-12s %8s %6s %+8.1f%% %+8.1f%% %+8.1f%% %+8.1f%% %+7.1f' % (
+                '', '', '', _change(old['throughput'], row['throughput']),
+                _change(old['p50'], row['p50']), _change(old['p95'], row['p95']),
+                _change(old['p99'], row['p99']), row['queries'] - old['queries']))
+
+
+def _change(old, new):
+    return (new - old) * 100.0 / old if old else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load benchmark')
+    parser.add_argument('-c', '--concurrency', type=int, default=4)
+    parser.add_argument('-d', '--duration', type=float, default=10,
+                        help='seconds to run, ignored with --requests')
+    parser.add_argument('-n', '--requests', type=int, default=0,
+                        help='total scenario runs instead of a duration')
+    parser.add_argument('-w', '--warmup', type=int, default=20,
+                        help='scenario runs per worker before measuring')
+    parser.add_argument('--movies', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--no-seed', dest='reseed', action='store_false',
+                        help='reuse the database from the previous run')
+    parser.add_argument('-o', '--output', default=None)
+    parser.add_argument('--compare', default=None,
+                        help='previous JSON result to compare against')
+    args = parser.parse_args()
+
+    app = create_app('testing')
+
+    @app.after_request
+    def count_queries(response):
+        response.headers['X-Bench-Queries'] = str(len(get_debug_queries()))
+        return response
+
+    queries = load_queries()
+    with app.app_context():
+        if args.reseed:
+            directory = os.path.join(basedir, 'tmp')
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+            seed(args.movies, args.concurrency, queries, random.Random(args.seed))
+        args.movies = db.session.query(db.func.count(Movie.id)).scalar()
+
+    elapsed, samples = run(app, args, queries)
+    result = summarize(elapsed, samples)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+    print_report(result, baseline)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'revision': git_revision(),
+                'python': platform.python_version(),
+                'database': app.config['SQLALCHEMY_DATABASE_URI'],
+                'search_backend': app.config['SEARCH_BACKEND'],
+                'args': vars(args),
+                'elapsed': elapsed,
+                'results': result,
+            }, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
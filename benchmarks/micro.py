@@ -0,0 +1,216 @@
+# -*- coding:utf-8 -*-
+"""
+..  note:: 热点函数的微基准
+
+    每个基准由 ``@benchmark`` 注册, 接收 ``Fixture`` 并返回一个无参函数,
+    测量该函数单次调用的耗时 (微秒)。每项自动确定调用次数,
+    使每轮至少运行 ``MIN_TIME`` 秒, 取多轮中的最小值以减少噪声。
+
+    基线保存在 ``benchmarks/baseline.json``。与基线相比慢了超过
+    ``tolerance`` 的项会被标记为回归, ``manage.py bench`` 以非零状态退出::
+
+        python manage.py bench            # 与基线比较
+        python manage.py bench --save     # 更新基线
+
+    基线与机器有关, 不纳入版本库: 在新机器上先在未修改的代码上执行一次
+    ``--save``, 没有基线时只给出提示, 不会失败。
+
+    数据写入 ``tmp/micro.sqlite`` (可由 ``MICRO_DATABASE_URL`` 指定),
+    不修改测试数据库。
+
+"""
+import os
+import re
+import json
+import time
+
+from flask import render_template_string
+
+basedir = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+BASELINE = os.path.join(basedir, 'benchmarks', 'baseline.json')
+DATABASE_URL = os.environ.get('MICRO_DATABASE_URL') or \
+    'sqlite:///' + os.path.join(basedir, 'tmp', 'micro.sqlite')
+MIN_TIME = 0.1
+REPEAT = 5
+
+BENCHMARKS = []
+
+
+def benchmark(f):
+    BENCHMARKS.append((f.__name__, f))
+    return f
+
+
+class Fixture(object):
+    """
+    基准使用的数据: 一个已确认的用户、一部影片和一个认证令牌
+    """
+
+    def __init__(self, app):
+        from app import db
+        from app.models import Movie, Role, User
+        db.create_all()
+        Role.insert_roles()
+        user = User.query.filter_by(email='micro@example.com').first()
+        if user is None:
+            user = User(email='micro@example.com', username='micro',
+                        password='micro', confirmed=True)
+            db.session.add(user)
+        movie = Movie.query.filter_by(original_title='Micro Benchmark').first()
+        if movie is None:
+            movie = Movie(title=u'微基准', original_title='Micro Benchmark',
+                          directors=u'导演甲 / 导演乙', casts=u'演员甲 / 演员乙',
+                          genres=u'剧情 / 爱情', year=2000, rating=8.5)
+            db.session.add(movie)
+        db.session.commit()
+        self.app = app
+        self.user = user
+        self.movie = movie
+        self.token = user.generate_auth_token(expiration=3600)
+
+
+@benchmark
+def movie_to_json(fixture):
+    return fixture.movie.to_json
+
+
+@benchmark
+def user_can(fixture):
+    from app.models import Permission
+    return lambda: fixture.user.can(Permission.BORROW)
+
+
+@benchmark
+def identity_can(fixture):
+    from app.models import Permission, load_identity
+    identity = load_identity(fixture.user.id)
+    return lambda: identity.can(Permission.BORROW)
+
+
+@benchmark
+def user_is_borrowing(fixture):
+    return lambda: fixture.user.is_borrowing(fixture.movie)
+
+
+@benchmark
+def borrow_return(fixture):
+    from app import db
+
+    def run():
+        fixture.user.borrow(fixture.movie, fixture.user)
+        db.session.flush()
+        fixture.user.return_movie(fixture.movie)
+        db.session.flush()
+    return run
+
+
+@benchmark
+def verify_auth_token(fixture):
+    from app.models import User
+    return lambda: User.verify_auth_token(fixture.token)
+
+
+@benchmark
+def load_user(fixture):
+    from app.models import load_user
+    user_id = str(fixture.user.id)
+    return lambda: load_user(user_id)
+
+
+@benchmark
+def pagination_widget(fixture):
+    from flask_sqlalchemy import Pagination
+    pagination = Pagination(None, 50, 10, 1000, [])
+    source = '{% import "_macros.html" as macros %}' \
+             '{{ macros.pagination_widget(pagination, "main.index") }}'
+    return lambda: render_template_string(source, pagination=pagination)
+
+
+def create_bench_app():
+    """
+    使用 ``testing`` 配置和独立数据库的程序
+    """
+    from app import create_app
+    from config import config, TestingConfig
+    if not os.path.exists(os.path.join(basedir, 'tmp')):
+        os.makedirs(os.path.join(basedir, 'tmp'))
+    config['micro'] = type('MicroConfig', (TestingConfig,),
+                           {'SQLALCHEMY_DATABASE_URI': DATABASE_URL})
+    return create_app('micro')
+
+
+def measure(f, repeat=REPEAT, min_time=MIN_TIME):
+    """
+    单次调用的耗时 (微秒)
+
+    :rtype: float
+    """
+    number = 1
+    while True:
+        start = time.time()
+        for _ in range(number):
+            f()
+        elapsed = time.time() - start
+        if elapsed >= min_time:
+            break
+        number *= 2
+    best = elapsed
+    for _ in range(repeat - 1):
+        start = time.time()
+        for _ in range(number):
+            f()
+        best = min(best, time.time() - start)
+    return best * 1e6 / number
+
+
+def load_baseline(path=BASELINE):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def run(app, pattern=None, tolerance=0.2, save=False, path=BASELINE):
+    """
+    ..  note:: 执行微基准并与基线比较
+
+        ``borrow_return`` 等修改数据的基准只 flush 不提交, 结束后回滚。
+
+    :return: 回归的基准名称
+    :rtype: list
+    """
+    from app import db
+    baseline = load_baseline(path)
+    if not baseline and not save:
+        print('No baseline at %s, run with --save first to compare' % path)
+    results = {}
+    regressions = []
+    with app.test_request_context():
+        fixture = Fixture(app)
+        print('%-20s %12s %12s %8s' % ('benchmark', 'usec/call', 'baseline',
+                                       'change'))
+        for name, setup in BENCHMARKS:
+            if pattern and not re.search(pattern, name):
+                continue
+            try:
+                results[name] = measure(setup(fixture))
+            finally:
+                db.session.rollback()
+            old = baseline.get(name)
+            if old is None:
+                print('%-20s %12.2f %12s %8s' % (name, results[name], '-', '-'))
+                continue
+            change = (results[name] - old) / old
+            flag = ''
+            if change > tolerance:
+                regressions.append(name)
+                flag = '  REGRESSION'
+            print('%-20s %12.2f %12.2f %+7.1f%%%s' % (
+                name, results[name], old, change * 100, flag))
+    if save:
+        baseline.update(results)
+        with open(path, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print('Saved baseline to %s' % path)
+    return regressions
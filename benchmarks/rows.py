@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+"""
+..  note:: 列表读取路径的基准
+
+    比较读取一页影片的三种方式, 分别测量只读取和读取后序列化 (``to_json``):
+
+    * ``orm``: ``Movie.query`` 构造 ORM 对象, 加入身份映射;
+    * ``rows``: Core 只选择需要的列, 构造 ``MovieItem``;
+    * ``cached``: ``model_cache.rows`` 命中缓存, 不查询数据库。
+
+    输出每种方式在每个页大小下的耗时 (毫秒, 多轮中的最小值)、
+    每秒处理的行数, 以及结果占用的内存峰值 (需要 ``tracemalloc``)::
+
+        python benchmarks/rows.py --sizes 1000 10000
+
+"""
+import os
+import sys
+import gc
+import time
+import argparse
+
+basedir = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+sys.path.insert(0, basedir)
+os.environ.setdefault('TEST_DATABASE_URL', 'sqlite:///' + os.path.join(
+    basedir, 'tmp', 'rows.sqlite'))
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+from sqlalchemy import select
+from app import create_app, db, model_cache
+from app.models import Movie
+from app.rows import MovieItem
+
+
+def seed(count):
+    """
+    保证至少有 ``count`` 部影片
+    """
+    db.create_all()
+    start = db.session.query(db.func.count(Movie.id)).scalar()
+    rows = [{
+        'title': u'影片%d' % i,
+        'original_title': u'Movie %d' % i,
+        'directors': u'导演%d' % (i % 997),
+        'casts': u'演员%d / 演员%d / 演员%d' % (i % 101, i % 103, i % 107),
+        'genres': u'剧情 / 爱情',
+        'year': 1950 + i % 67,
+        'rating': round(2 + (i % 80) / 10.0, 1),
+        'images': u'https://img.example.com/%d.jpg' % i,
+        'alt': u'https://movie.example.com/%d' % i,
+        'amount': 200,
+        'counts': i % 50,
+    } for i in range(start, count)]
+    if rows:
+        db.session.execute(Movie.__table__.insert(), rows)
+        db.session.commit()
+
+
+def read_orm(size):
+    return Movie.query.order_by(Movie.id).limit(size).all()
+
+
+def read_rows(size):
+    table = Movie.__table__
+    names = table.columns.keys()
+    result = db.session.execute(
+        select(list(table.columns)).order_by(table.c.id).limit(size))
+    return [MovieItem(zip(names, row)) for row in result]
+
+
+def read_cached(ids):
+    return model_cache.rows(Movie, ids, MovieItem)
+
+
+def serialized(read):
+    return lambda *args: [item.to_json() for item in read(*args)]
+
+
+def measure(f, rounds):
+    best = None
+    for _ in range(rounds):
+        db.session.remove()
+        gc.collect()
+        start = time.time()
+        f()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    db.session.remove()
+    return best
+
+
+def peak_memory(f):
+    if tracemalloc is None:
+        return None
+    db.session.remove()
+    gc.collect()
+    tracemalloc.start()
+    try:
+        result = f()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    del result
+    db.session.remove()
+    return peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description='List read path benchmark')
+    parser.add_argument('-s', '--sizes', type=int, nargs='+',
+                        default=[1000, 10000])
+    parser.add_argument('-r', '--rounds', type=int, default=5)
+    args = parser.parse_args()
+
+    app = create_app('testing')
+    print('%-12s %7s %10s %12s %12s' % ('path', 'rows', 'time(ms)', 'rows/s',
+                                        'peak(KiB)'))
+    with app.app_context():
+        seed(max(args.sizes))
+        for size in args.sizes:
+            ids = [row[0] for row in db.session.execute(
+                select([Movie.id]).order_by(Movie.id).limit(size))]
+            with app.test_request_context():
+                read_cached(ids)
+                paths = []
+                for suffix, wrap in (('', lambda read: read),
+                                     ('+json', serialized)):
+                    paths.extend([
+                        ('orm' + suffix, lambda f=wrap(read_orm): f(size)),
+                        ('rows' + suffix, lambda f=wrap(read_rows): f(size)),
+                        ('cached' + suffix,
+                         lambda f=wrap(read_cached): f(ids)),
+                    ])
+                for name, f in paths:
+                    elapsed = measure(f, args.rounds)
+                    peak = peak_memory(f)
+                    print('%-12s %7d %10.2f %12.0f %12s' % (
+                        name, size, elapsed * 1000, size / elapsed,
+                        '-' if peak is None else '%.0f' % (peak / 1024.0)))
+
+
+if __name__ == '__main__':
+    main()
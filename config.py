@@ -5,8 +5,8 @@ basedir = os.path.abspath(os.path.dirname(__file__))
 class Config:
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'Stay away from me'
     SQLALCHEMY_COMMIT_ON_TEARDOWN = True
-    MAIL_SERVER = 'smtp.163.com'
-    MAIL_PORT = '994'
+    MAIL_SERVER = os.environ.get('MAIL_SERVER') or 'smtp.163.com'
+    MAIL_PORT = int(os.environ.get('MAIL_PORT') or 994)
     MAIL_USE_TLS = False
     MAIL_USE_SSL = True
     MAIL_USERNAME = os.environ.get('MAIL_USERNAME')
@@ -14,31 +14,108 @@ class Config:
     FLASKY_MAIL_SUBJECT_PREFIX = '[影碟租借管理系统]'
     FLASKY_MAIL_SENDER = '影碟租借管理系统'
     FLASKY_ADMIN = os.environ.get('FLASKY_ADMIN')
-    SQLALCHEMY_TRACK_MODIFICATIONS = True
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
     FLASKY_POSTS_PER_PAGE = 10
     FLASKY_FOLLOWERS_PER_PAGE = 10
     FLASKY_COMMENTS_PER_PAGE = 10
     FLASKY_POSTS_PER_PAGE = 10
+    FLASKY_JSONS_PER_PAGE = 20
     SQLALCHEMY_RECORD_QUERIES = True
+    SQLITE_PRAGMAS = [
+        ('journal_mode', 'WAL'),
+        ('synchronous', 'NORMAL'),
+        ('foreign_keys', 'ON'),
+        ('busy_timeout', 5000),
+        ('cache_size', -64000),
+        ('mmap_size', 268435456),
+        ('temp_store', 'MEMORY'),
+    ]
+    SQLITE_BUSY_RETRIES = 5
+    DATABASE_READ_URL = os.environ.get('DATABASE_READ_URL')
+    DATABASE_READ_PIN = 10
+    DATABASE_PRIMARY_ENDPOINTS = []
+    SQLITE_BUSY_BACKOFF = 0.05
     FLASKY_DB_QUERY_TIMEOUT = 0.5
     FLASKY_SLOW_DB_QUERY_TIME = 0.5
     MAX_BORROWED_NUMBER = 7
+    DB_STATS_WINDOW = 15
+    DB_STATS_DIR = os.environ.get('DB_STATS_DIR') or \
+        os.path.join(basedir, 'tmp/db_stats')
+    METRICS_DIR = os.environ.get('METRICS_DIR')
+    METRICS_ALLOWED_ADDRS = ['127.0.0.1', '::1']
+    PROFILER_SAMPLE_RATE = float(os.environ.get('PROFILER_SAMPLE_RATE') or 0)
+    PROFILER_ALLOW_HEADER = bool(os.environ.get('PROFILER_ALLOW_HEADER'))
+    PROFILER_MODE = os.environ.get('PROFILER_MODE') or 'cprofile'
+    PROFILER_DIR = os.environ.get('PROFILER_DIR') or \
+        os.path.join(basedir, 'tmp/profiles')
+    WHOOSH_BASE = os.path.join(basedir, 'whoosh_index')
+    SEARCH_BACKEND = os.environ.get('SEARCH_BACKEND') or 'whoosh'
+    SEARCHABLE_MODELS = ['Movie']
+    SEARCH_CACHE_SIZE = 1024
+    SEARCH_CACHE_TTL = 600
+    CACHE_SHARED_DIR = os.environ.get('CACHE_SHARED_DIR')
+    CACHE_VERSIONS_PATH = os.environ.get('CACHE_VERSIONS_PATH') or \
+        os.path.join(CACHE_SHARED_DIR or os.path.join(basedir, 'tmp/cache'),
+                     'versions.bin')
+    MAIL_POOL_SIZE = 2
+    MAIL_POOL_AUTOSTART = False
+    MAIL_MAX_ATTEMPTS = 5
+    MAIL_RETRY_BACKOFF = 30
+    OVERDUE_DAYS = 30
+    OVERDUE_CHUNK = 1000
+    OVERDUE_RATE = 60
+    API_AUTH_CACHE_SIZE = 10000
+    API_AUTH_CACHE_TTL = 300
+    IDENTITY_CACHE_SIZE = 10000
+    IDENTITY_CACHE_TTL = 60
+    LOAN_STATE_CACHE_SIZE = 10000
+    LOAN_STATE_CACHE_TTL = 300
+    MODEL_CACHE_SIZE = 10000
+    MODEL_CACHE_TTL = 300
+    CACHE_KEY_VERSION_SLOTS = 65536
+    FRAGMENT_CACHE_SIZE = 10000
+    FRAGMENT_CACHE_TTL = 3600
+    PAGE_CACHE_SIZE = 1000
+    PAGE_CACHE_TTL = 300
+    LOAN_SHARDS = [url for url in
+                   (os.environ.get('LOAN_SHARDS') or '').split(',') if url]
+    LOAN_SHARD_BUCKETS = 64
+    LOAN_SHARDS_FALLBACK = bool(os.environ.get('LOAN_SHARDS_FALLBACK'))
+    LOAN_SHARDS_BATCH = 1000
+    CATALOG_SNAPSHOT_DIR = os.environ.get('CATALOG_SNAPSHOT_DIR') or \
+        os.path.join(basedir, 'catalog')
+    CATALOG_SNAPSHOT_CHECK = 5
+    CATALOG_SNAPSHOT_REBUILD = bool(os.environ.get('CATALOG_SNAPSHOT_REBUILD'))
+    SIMILAR_DIR = os.path.join(basedir, 'similar')
+    SIMILAR_DIMENSIONS = 2048
+    SIMILAR_TOP_K = 10
+    SIMILAR_MEMORY = 256 * 1024 * 1024
     @staticmethod
     def init_app(app):
         pass
 
 class DevelopmentConfig(Config):
     DEBUG = True
+    SQLALCHEMY_POOL_SIZE = 5
     SQLALCHEMY_DATABASE_URI = os.environ.get('DEV_DATABASE_URL') or \
                 'sqlite:///' + os.path.join(basedir, 'data-dev.sqlite')
 
 class TestingConfig(Config):
     TESTING = True
+    MAIL_SERVER = 'localhost'
+    MAIL_PORT = 1025
+    MAIL_USE_SSL = False
+    # TESTING 默认不发送邮件, 发往本地的调试 SMTP 服务器
+    MAIL_SUPPRESS_SEND = False
+    WTF_CSRF_ENABLED = False
+    WHOOSH_BASE = os.path.join(basedir, 'tmp/whoosh_test')
     SQLALCHEMY_DATABASE_URI = os.environ.get('TEST_DATABASE_URL') or \
     'sqlite:///' + os.path.join(basedir, 'data-test.sqlite')
 
 
 class ProductionConfig(Config):
+    SQLALCHEMY_POOL_SIZE = 10
+    SQLALCHEMY_MAX_OVERFLOW = 10
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or \
                 'sqlite:///' + os.path.join(basedir, 'data.sqlite')
 
@@ -8,8 +8,8 @@ if os.environ.get('FLASK_COVERAGE'):
     COV = coverage.coverage(branch=True, include='app/*')
     COV.start()
 
-from app import create_app, db
-from app.models import User, Role, Movie, Record, Permission
+from app import create_app, db, search, loan_shards, template_cache
+from app.models import User, Role, Movie, Record, Permission, Similarity, Outbox
 from flask_script import Manager, Shell
 from flask_migrate import Migrate, MigrateCommand
 
@@ -25,7 +25,8 @@ def make_shell_context():
 
     """
     return dict(app=app, db=db, User=User,Permission=Permission,
-            Role=Role, Movie=Movie, Record=Record)
+            Role=Role, Movie=Movie, Record=Record, Similarity=Similarity,
+            Outbox=Outbox)
 manager.add_command("shell", Shell(make_context=make_shell_context))
 manager.add_command('db', MigrateCommand)
 
@@ -67,5 +68,227 @@ def deploy():
     # create user roles
     Role.insert_roles()
 
+    # create loan shard tables
+    loan_shards.create_all()
+
+    # rebuild catalog counts
+    from app.counts import reconcile
+    reconcile()
+
+@manager.command
+def clean_index():
+    """
+    删除不属于 ``SEARCHABLE_MODELS`` 的过期索引目录
+    """
+    for path in search.clean(app):
+        print('Removed %s' % path)
+
+@manager.command
+def reindex():
+    """
+    使用当前搜索后端重建所有已注册模型的索引
+    """
+    search.reindex()
+
+@manager.option('-q', '--queries', dest='queries',
+                default='benchmarks/search_queries.txt', help='查询集文件, 每行一条')
+@manager.option('-r', '--rounds', dest='rounds', type=int, default=5)
+def search_bench(queries, rounds):
+    """
+    比较 whoosh 与 fts5 搜索后端的索引大小、构建时间、延迟与召回率
+    """
+    import io
+    from app.search import benchmark
+    with io.open(queries, encoding='utf-8') as f:
+        lines = [line.strip() for line in f if line.strip()]
+    print('%-8s %12s %10s %10s %10s %10s' % (
+        'backend', 'size(KB)', 'build(s)', 'p50(ms)', 'p99(ms)', 'recall@10'))
+    for row in benchmark(app, Movie, lines, rounds):
+        print('%-8s %12.1f %10.2f %10.2f %10.2f %10.3f' % (
+            row['backend'], row['size'] / 1024.0, row['build'],
+            row['p50'] * 1000, row['p99'] * 1000, row['recall']))
+
+@manager.command
+def similar():
+    """
+    计算所有影片基于内容的相似影片
+    """
+    from app.similar import build
+    build()
+
+@manager.option('-k', '--keep', dest='keep', type=int, default=2,
+                help='generations to keep')
+def catalog_snapshot(keep):
+    """
+    导出只读的目录快照并发布为新的一代
+
+    由 cron 定期执行, 目录修改后在下一次发布之前, 列表与修改过的影片从数据库读取
+    """
+    from app.snapshot import build
+    generation, count = build(keep=keep)
+    print('Published %s with %d movies' % (generation, count))
+
+@manager.option('-f', '--fragments', dest='fragments', action='store_true',
+                default=False, help='only movie fragments')
+@manager.option('-p', '--pages', dest='pages', action='store_true',
+                default=False, help='only full pages')
+def clear_template_cache(fragments, pages):
+    """
+    使模板片段与整页缓存失效, 修改模板后部署时执行
+
+    计数保存在 ``CACHE_VERSIONS_PATH`` 中, 同一台机器上正在运行的进程立即生效。
+    """
+    both = not fragments and not pages
+    template_cache.invalidate(fragments=fragments or both, pages=pages or both)
+
+@manager.option('-o', '--once', dest='once', action='store_true', default=False,
+                help='发送完到期的邮件后退出')
+def mail_worker(once):
+    """
+    发送 outbox 中的邮件
+    """
+    import time
+    from app.email import mail_pool
+    if once:
+        print('Sent %d' % mail_pool.drain(app))
+        return
+    mail_pool.start(app)
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        mail_pool.stop()
+
+@manager.option('-d', '--days', dest='days', type=int, default=None,
+                help='借阅超过多少天视为逾期, 默认使用 OVERDUE_DAYS')
+def remind_overdue(days):
+    """
+    向逾期未还的用户发送汇总提醒邮件, 可由 cron 定时执行
+    """
+    from app.reminders import remind_overdue
+    print('Queued %d reminders' % remind_overdue(days))
+
+@manager.option('-m', '--movies', dest='movies', type=int, default=10000)
+@manager.option('-u', '--users', dest='users', type=int, default=5000)
+@manager.option('-l', '--loans', dest='loans', type=int, default=20000)
+@manager.option('-s', '--seed', dest='seed', type=int, default=0,
+                help='random seed, the same seed generates the same data')
+@manager.option('-c', '--chunk', dest='chunk', type=int, default=100000,
+                help='rows per transaction')
+@manager.option('-b', '--batch', dest='batch', type=int, default=10000,
+                help='rows per INSERT executemany')
+@manager.option('-i', '--index', dest='index', action='store_true',
+                help='rebuild the search index afterwards')
+def seed(movies, users, loans, seed, chunk, batch, index):
+    """
+    生成大规模的测试数据, 例如 ``seed -m 1000000 -u 500000 -l 10000000``
+    """
+    from app.seed import seed as generate
+    movies, users, loans = generate(movies, users, loans, seed=seed,
+                                    chunk=chunk, batch=batch, index=index)
+    print('Created %d movies, %d users, %d loans' % (movies, users, loans))
+
+@manager.command
+def reconcile_counts():
+    """
+    从 movies 表重新统计目录计数并修正 catalog_counts, 可由 cron 定时执行
+    """
+    from app.counts import reconcile
+    changes = reconcile()
+    for name in sorted(changes):
+        print('%-40s %s -> %s' % ((name,) + changes[name]))
+    print('Corrected %d counts' % len(changes))
+
+@manager.option('-b', '--batch', dest='batch', type=int, default=None,
+                help='rows per batch, defaults to LOAN_SHARDS_BATCH')
+def split_loans(batch):
+    """
+    把主库 records 表中的借阅分批移入 LOAN_SHARDS 分片, 可以在线执行
+    """
+    if not loan_shards.enabled:
+        print('LOAN_SHARDS is not configured')
+        return
+    def log(message):
+        print(message)
+    loan_shards.create_all()
+    moved = loan_shards.split(batch, log=log)
+    print('Moved %d loans, LOAN_SHARDS_FALLBACK can be turned off' % moved)
+
+@manager.command
+def loan_counts():
+    """
+    各分片中的借阅数量
+    """
+    from sqlalchemy import func, select
+    counts = loan_shards.scatter(lambda engine, table: engine.execute(
+        select([func.count()]).select_from(table)).scalar())
+    for (engine, table), count in zip(loan_shards.sources(), counts):
+        print('%-48s %10d' % (engine.url, count))
+
+@manager.command
+def db_stats():
+    """
+    输出各端点的数据库查询统计, 按数据库总耗时降序
+    """
+    from app import db_stats as stats
+    print('%-28s %8s %8s %10s %10s %10s' % (
+        'endpoint', 'requests', 'queries', 'q/req', 'db(s)', 'slowest(s)'))
+    rows = sorted(stats.merged().items(),
+                  key=lambda item: item[1]['total_time'], reverse=True)
+    for endpoint, row in rows:
+        print('%-28s %8d %8d %10.1f %10.3f %10.3f' % (
+            endpoint, row['requests'], row['queries'],
+            row['queries'] / float(row['requests']), row['total_time'],
+            row['slowest_time']))
+        if row['slowest_statement']:
+            print('    %s' % ' '.join(row['slowest_statement'].split()))
+
+@manager.option('-e', '--endpoint', dest='endpoint', default=None,
+                help='only profiles of this endpoint, e.g. main.search')
+@manager.option('-s', '--sort', dest='sort', default='cumulative')
+@manager.option('-n', '--limit', dest='limit', type=int, default=30)
+@manager.option('-c', '--collapsed', dest='collapsed', default=None,
+                help='write collapsed stacks for flamegraph.pl to this file')
+def profile_report(endpoint, sort, limit, collapsed):
+    """
+    汇总 ``PROFILER_DIR`` 中的分析文件
+    """
+    from app.profiler import endpoints, report, collapsed as collapse
+    directory = app.config['PROFILER_DIR']
+    for name, count in sorted(endpoints(directory).items()):
+        print('%-28s %d' % (name, count))
+    if collapsed:
+        lines = collapse(directory, endpoint)
+        with open(collapsed, 'w') as f:
+            f.writelines(line + '\n' for line in lines)
+        print('Wrote %d stacks to %s' % (len(lines), collapsed))
+    else:
+        report(directory, endpoint, sort, limit)
+
+@manager.option('-x', '--expires', dest='expires', type=int, default=3600)
+def profile_token(expires):
+    """
+    生成强制分析单个请求的请求头
+    """
+    from app import profiler
+    print('%s: %s' % (app.config['PROFILER_HEADER'],
+                      profiler.token(expires_in=expires)))
+
+@manager.option('-k', '--filter', dest='pattern', default=None,
+                help='only benchmarks whose name matches this regex')
+@manager.option('-t', '--tolerance', dest='tolerance', type=float, default=0.2)
+@manager.option('-s', '--save', dest='save', action='store_true',
+                help='store the results as the new baseline')
+def bench(pattern, tolerance, save):
+    """
+    执行微基准, 比基线慢超过 ``tolerance`` 时以非零状态退出
+    """
+    import sys
+    from benchmarks.micro import create_bench_app, run
+    regressions = run(create_bench_app(), pattern, tolerance, save)
+    if regressions and not save:
+        print('Regressions: %s' % ', '.join(regressions))
+        sys.exit(1)
+
 if __name__ == '__main__':
     manager.run()
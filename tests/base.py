@@ -0,0 +1,59 @@
+# -*- coding:utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+from app import create_app, db
+from app.models import Role
+from config import config, TestingConfig
+
+
+class AppTestCase(unittest.TestCase):
+    """
+    ..  note:: 测试的公共部分
+
+        每个测试使用临时目录中的 SQLite 数据库、目录快照、相似影片和缓存版本号文件,
+        不修改仓库中的 ``data-test.sqlite``。子类在 ``settings`` 中覆盖配置,
+        在 ``seed`` 中写入初始数据。
+
+        测试客户端的每个请求推入自己的程序上下文, 与线上一样在请求结束时提交会话;
+        测试代码读写数据库时使用 ``with self.app.app_context()``。
+
+    """
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        settings = {
+            'SQLALCHEMY_DATABASE_URI':
+                'sqlite:///' + os.path.join(self.tmp, 'test.sqlite'),
+            'CATALOG_SNAPSHOT_DIR': os.path.join(self.tmp, 'catalog'),
+            'SIMILAR_DIR': os.path.join(self.tmp, 'similar'),
+            'WHOOSH_BASE': os.path.join(self.tmp, 'whoosh'),
+            'CACHE_VERSIONS_PATH': os.path.join(self.tmp, 'cache',
+                                                'versions.bin'),
+        }
+        settings.update(self.settings())
+        config['unittest'] = type('UnitTestConfig', (TestingConfig,), settings)
+        self.app = create_app('unittest')
+        with self.app.app_context():
+            db.create_all()
+            Role.insert_roles()
+            self.seed()
+            db.session.commit()
+
+    def tearDown(self):
+        with self.app.app_context():
+            db.session.remove()
+        config.pop('unittest', None)
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def settings(self):
+        """
+        覆盖的配置
+        """
+        return {}
+
+    def seed(self):
+        """
+        写入初始数据, 由 ``setUp`` 提交
+        """
@@ -0,0 +1,109 @@
+# -*- coding:utf-8 -*-
+import json
+from base64 import b64encode
+from app import db
+from app.models import Movie, Role, User
+from tests.base import AppTestCase
+
+
+class MovieAPITestCase(AppTestCase):
+    """
+    ..  note:: ``/api/v1/movies/<id>`` 的条件请求与修改
+    """
+
+    def seed(self):
+        admin = User(email='admin@example.com', username='admin',
+                     password='cat', confirmed=True,
+                     role=Role.query.filter_by(name='Administrator').first())
+        db.session.add(admin)
+        for title in (u'千与千寻', u'龙猫'):
+            db.session.add(Movie(title=title, original_title=title + ' (1)',
+                                 directors=u'宫崎骏', casts=u'演员甲 / 演员乙',
+                                 genres=u'动画', year=2001, rating=9.0,
+                                 amount=1, counts=0))
+        db.session.flush()
+        self.movie_id = Movie.query.filter_by(title=u'千与千寻').first().id
+        self.client = self.app.test_client()
+
+    def get_api_headers(self, **headers):
+        headers.update({
+            'Authorization': 'Basic ' + b64encode(
+                b'admin@example.com:cat').decode('utf-8'),
+            'Accept': 'application/json',
+            'Content-Type': 'application/json'
+        })
+        return headers
+
+    def url(self):
+        return '/api/v1/movies/%d' % self.movie_id
+
+    def put(self, data, **headers):
+        return self.client.put(self.url(), data=json.dumps(data),
+                               headers=self.get_api_headers(**headers))
+
+    def etag(self):
+        response = self.client.get(self.url(), headers=self.get_api_headers())
+        self.assertEqual(response.status_code, 200)
+        return response.headers['ETag'].strip('"')
+
+    def movie(self):
+        with self.app.app_context():
+            movie = Movie.query.get(self.movie_id)
+            return movie.title, movie.rating, movie.amount
+
+    def assertUnchanged(self, etag):
+        self.assertEqual(self.movie(), (u'千与千寻', 9.0, 1))
+        self.assertEqual(self.etag(), etag)
+
+    def test_if_none_match(self):
+        etag = self.etag()
+        response = self.client.get(
+            self.url(), headers=self.get_api_headers(**{'If-None-Match': '"%s"' % etag}))
+        self.assertEqual(response.status_code, 304)
+        self.put({'rating': 8.0}, **{'If-Match': '"%s"' % etag})
+        response = self.client.get(
+            self.url(), headers=self.get_api_headers(**{'If-None-Match': '"%s"' % etag}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data.decode('utf-8'))['rating'], 8.0)
+
+    def test_put_without_if_match(self):
+        etag = self.etag()
+        response = self.put({'rating': 8.0})
+        self.assertEqual(response.status_code, 428)
+        self.assertUnchanged(etag)
+
+    def test_put_with_stale_etag(self):
+        etag = self.etag()
+        response = self.put({'rating': 8.0}, **{'If-Match': '"%s"' % etag})
+        self.assertEqual(response.status_code, 200)
+        current = response.headers['ETag']
+        self.assertNotEqual(current.strip('"'), etag)
+        response = self.put({'rating': 1.0}, **{'If-Match': '"%s"' % etag})
+        self.assertEqual(response.status_code, 412)
+        self.assertEqual(response.headers['ETag'], current)
+        self.assertEqual(json.loads(response.data.decode('utf-8'))['rating'], 8.0)
+        self.assertEqual(self.movie()[1], 8.0)
+
+    def test_put_duplicate_title(self):
+        etag = self.etag()
+        response = self.put({'title': u'龙猫', 'rating': 1.0},
+                            **{'If-Match': '"%s"' % etag})
+        self.assertEqual(response.status_code, 409)
+        self.assertUnchanged(etag)
+
+    def test_put_invalid_field(self):
+        etag = self.etag()
+        response = self.put({'title': u'神隐', 'rating': 1.0, 'year': 'abc'},
+                            **{'If-Match': '"%s"' % etag})
+        self.assertEqual(response.status_code, 400)
+        self.assertUnchanged(etag)
+
+    def test_put_negative_stock(self):
+        etag = self.etag()
+        response = self.put({'title': u'神隐', 'amount_delta': -2},
+                            **{'If-Match': '"%s"' % etag})
+        self.assertEqual(response.status_code, 400)
+        self.assertUnchanged(etag)
+        response = self.put({'amount_delta': -1}, **{'If-Match': '"%s"' % etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.movie()[2], 0)
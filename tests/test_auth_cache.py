@@ -0,0 +1,133 @@
+# -*- coding:utf-8 -*-
+import os
+import sys
+import subprocess
+from base64 import b64encode
+from app import db
+from app.models import Movie, Role, User
+from tests.base import AppTestCase
+
+basedir = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+
+# 在另一个进程中修改用户, 版本号通过 keys.bin 传到测试进程
+OTHER_PROCESS = '''
+import sys
+from config import config, TestingConfig
+config['unittest'] = type('UnitTestConfig', (TestingConfig,), {
+    'SQLALCHEMY_DATABASE_URI': sys.argv[1], 'CACHE_VERSIONS_PATH': sys.argv[2]})
+from app import create_app, db
+from app.models import Role, User
+app = create_app('unittest')
+with app.app_context():
+    user = User.query.filter_by(username='admin').first()
+    exec(sys.argv[3])
+    db.session.commit()
+'''
+DEMOTE = "user.role_id = Role.query.filter_by(name='User').first().id"
+
+
+class AuthCacheTestCase(AppTestCase):
+    """
+    ..  note:: 用户修改后缓存的凭据和身份快照不再有效
+
+        先请求两次使凭据和身份进入缓存, 再修改用户 (本进程或另一个进程),
+        之后的请求使用修改后的用户。角色直接修改 ``role_id``,
+        不经过 ``Role.users``, ``roles`` 表的版本号不变。
+
+    """
+
+    def seed(self):
+        db.session.add(User(email='admin@example.com', username='admin',
+                            password='cat', confirmed=True,
+                            role=Role.query.filter_by(
+                                name='Administrator').first()))
+        movie = Movie(title=u'千与千寻', genres=u'动画', rating=9.0, amount=1)
+        db.session.add(movie)
+        db.session.flush()
+        self.movie_id = movie.id
+
+    def change(self, code):
+        with self.app.app_context():
+            user = User.query.filter_by(username='admin').first()
+            exec(code)
+            db.session.commit()
+
+    def change_in_other_process(self, code):
+        subprocess.check_call(
+            [sys.executable, '-W', 'ignore', '-c', OTHER_PROCESS,
+             self.app.config['SQLALCHEMY_DATABASE_URI'],
+             self.app.config['CACHE_VERSIONS_PATH'], code],
+            cwd=basedir, stderr=open(os.devnull, 'w'))
+
+    def api(self, method='get', password='cat'):
+        headers = {
+            'Authorization': 'Basic ' + b64encode(
+                ('admin@example.com:' + password).encode('utf-8')).decode('utf-8'),
+            'Accept': 'application/json', 'Content-Type': 'application/json'}
+        client = self.app.test_client()
+        url = '/api/v1/movies/%d' % self.movie_id
+        if method == 'get':
+            request = client.get
+        else:
+            # 没有 If-Match 时有权限为 428, 没有权限为 403
+            request = lambda url, headers: client.put(url, data='{}',
+                                                      headers=headers)
+        statuses = set(request(url, headers=headers).status_code
+                       for _ in range(2))
+        self.assertEqual(len(statuses), 1)
+        return statuses.pop()
+
+    def edit_form(self, client):
+        # 仓库中没有 403.html, 按 JSON 返回错误
+        return client.get('/edit-movie/%d' % self.movie_id,
+                          headers={'Accept': 'application/json'}).status_code
+
+    def login(self):
+        client = self.app.test_client(use_cookies=True)
+        self.assertEqual(client.post('/login', data={
+            'email': 'admin@example.com', 'password': 'cat'}).status_code, 302)
+        return client
+
+    def test_credential_after_password_change(self):
+        self.assertEqual(self.api(), 200)
+        self.change("user.password = 'dog'")
+        self.assertEqual(self.api(), 401)
+        self.assertEqual(self.api(password='dog'), 200)
+
+    def test_credential_after_confirmed_flip(self):
+        self.assertEqual(self.api(), 200)
+        self.change('user.confirmed = False')
+        self.assertEqual(self.api(), 403)
+
+    def test_credential_after_role_demotion(self):
+        self.assertEqual(self.api('put'), 428)
+        self.change(DEMOTE)
+        self.assertEqual(self.api('put'), 403)
+
+    def test_credential_changed_in_other_process(self):
+        self.assertEqual(self.api(), 200)
+        self.change_in_other_process("user.password = 'dog'")
+        self.assertEqual(self.api(), 401)
+
+    def test_identity_after_confirmed_flip(self):
+        client = self.login()
+        self.assertEqual(client.get('/').status_code, 200)
+        self.assertEqual(client.get('/').status_code, 200)
+        self.change('user.confirmed = False')
+        response = client.get('/')
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(response.headers['Location'].endswith('/unconfirmed'))
+
+    def test_identity_after_role_demotion(self):
+        client = self.login()
+        self.assertEqual(self.edit_form(client), 200)
+        self.assertEqual(self.edit_form(client), 200)
+        self.change(DEMOTE)
+        self.assertEqual(self.edit_form(client), 403)
+
+    def test_identity_changed_in_other_process(self):
+        client = self.login()
+        self.assertEqual(self.edit_form(client), 200)
+        self.assertEqual(self.edit_form(client), 200)
+        self.change_in_other_process(DEMOTE)
+        self.assertEqual(self.edit_form(client), 403)
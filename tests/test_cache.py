@@ -0,0 +1,71 @@
+# -*- coding:utf-8 -*-
+from sqlalchemy import event
+from app import db, model_cache
+from app.counts import reconcile, totals
+from app.models import Movie, Role, User, MOVIES_IN_STOCK
+from tests.base import AppTestCase
+
+
+class StockCacheTestCase(AppTestCase):
+    """
+    ..  note:: 借阅只使这部影片的缓存条目失效
+
+        其他影片的条目与首页列表仍然命中, 不执行 SQL。
+
+    """
+
+    def seed(self):
+        db.session.add(User(email='reader@example.com', username='reader',
+                            password='cat', confirmed=True,
+                            role=Role.query.filter_by(default=True).first()))
+        for i, amount in enumerate((1, 3)):
+            db.session.add(Movie(title=u'影片%d' % i, rating=9 - i,
+                                 amount=amount))
+        db.session.commit()
+        reconcile()
+
+    def login(self):
+        client = self.app.test_client(use_cookies=True)
+        response = client.post('/login', data={
+            'email': 'reader@example.com', 'password': 'cat'})
+        self.assertEqual(response.status_code, 302)
+        return client
+
+    def statements(self):
+        statements = []
+        engine = db.get_engine(self.app)
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+        event.listen(engine, 'before_cursor_execute', record)
+        self.addCleanup(event.remove, engine, 'before_cursor_execute', record)
+        return statements
+
+    def test_borrow_keeps_other_entries(self):
+        client = self.login()
+        with self.app.app_context():
+            model_cache.get_many(Movie, [1, 2])
+            self.assertEqual(totals()[MOVIES_IN_STOCK], 2)
+            version = model_cache.versions.get(Movie.__tablename__)
+        self.assertEqual(client.get('/borrow/1').status_code, 302)
+
+        with self.app.app_context():
+            self.assertEqual(model_cache.versions.get(Movie.__tablename__),
+                             version)
+            statements = self.statements()
+            other = model_cache.get(Movie, 2)
+            self.assertEqual((other.amount, statements), (3, []))
+            self.assertEqual(model_cache.get(Movie, 1).amount, 0)
+            self.assertEqual(len(statements), 1)
+            self.assertEqual(totals()[MOVIES_IN_STOCK], 1)
+
+    def test_rolled_back_stock_change(self):
+        with self.app.app_context():
+            model_cache.get(Movie, 1)
+            movie = Movie.query.get(1)
+            movie.adjust_stock(amount=2)
+            # 会话中未提交的修改不使用缓存
+            self.assertEqual(model_cache.get(Movie, 1).amount, 3)
+            db.session.rollback()
+        with self.app.app_context():
+            self.assertEqual(model_cache.get(Movie, 1).amount, 1)
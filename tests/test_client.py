@@ -0,0 +1,68 @@
+# -*- coding:utf-8 -*-
+import re
+from app import db
+from app.models import Movie, Role, User
+from tests.base import AppTestCase
+
+
+class EditMovieTestCase(AppTestCase):
+    """
+    ..  note:: 修改电影信息表单的冲突检查
+    """
+
+    def seed(self):
+        administrator = Role.query.filter_by(name='Administrator').first()
+        for name in ('admin', 'other'):
+            db.session.add(User(email='%s@example.com' % name, username=name,
+                                password='cat', confirmed=True,
+                                role=administrator))
+        movie = Movie(title=u'千与千寻', original_title='Spirited Away',
+                      directors=u'宫崎骏', casts=u'演员甲 / 演员乙',
+                      genres=u'动画', year=2001, rating=9.0,
+                      amount=3, counts=0)
+        db.session.add(movie)
+        db.session.flush()
+        self.movie_id = movie.id
+
+    def movie(self):
+        with self.app.app_context():
+            movie = Movie.query.get(self.movie_id)
+            return movie.rating, movie.amount
+
+    def login(self, name):
+        client = self.app.test_client(use_cookies=True)
+        response = client.post('/login', data={
+            'email': '%s@example.com' % name, 'password': 'cat'})
+        self.assertEqual(response.status_code, 302)
+        return client
+
+    def open_form(self, client):
+        response = client.get('/edit-movie/%d' % self.movie_id)
+        self.assertEqual(response.status_code, 200)
+        page = response.get_data(as_text=True)
+        return dict(re.findall(r'name="(\w+)"[^>]*value="([^"]*)"', page))
+
+    def test_conflicting_edit(self):
+        admin = self.login('admin')
+        other = self.login('other')
+        form = self.open_form(admin)
+        theirs = self.open_form(other)
+        theirs['rating'] = '8.5'
+        self.assertEqual(
+            other.post('/edit-movie/%d' % self.movie_id, data=theirs).status_code, 302)
+
+        form['rating'] = '5.0'
+        form['amount'] = str(int(form['amount']) + 2)
+        response = admin.post('/edit-movie/%d' % self.movie_id, data=form)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(u'其他管理员在您编辑期间修改了该影片' in
+                        response.get_data(as_text=True))
+        self.assertEqual(self.movie(), (8.5, 3))
+
+        # 重新提交表单中已更新的版本号后保存, 库存按增量修改
+        form = dict(re.findall(r'name="(\w+)"[^>]*value="([^"]*)"',
+                               response.get_data(as_text=True)))
+        self.assertEqual(form['amount'], '5')
+        response = admin.post('/edit-movie/%d' % self.movie_id, data=form)
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(self.movie(), (5.0, 5))
@@ -0,0 +1,87 @@
+# -*- coding:utf-8 -*-
+from sqlalchemy import func, select
+from app import db
+from app.counts import reconcile, totals
+from app.models import Movie, MOVIES_IN_STOCK, TOTAL_MOVIES
+from tests.base import AppTestCase
+
+GENRES = [u'剧情', u'喜剧', u'动作']
+
+
+class CatalogCountsTestCase(AppTestCase):
+    """
+    ..  note:: 维护的计数与 ``COUNT(*)`` 一致
+
+        每次修改提交后在新的程序上下文中读取 ``totals``,
+        同时检查计数表和缓存的列表。
+
+    """
+
+    def seed(self):
+        for i in range(6):
+            db.session.add(Movie(title=u'影片%d' % i, amount=i % 3,
+                                 genres=u' / '.join(GENRES[:i % 3 + 1])))
+
+    def setUp(self):
+        super(CatalogCountsTestCase, self).setUp()
+        with self.app.app_context():
+            reconcile()
+
+    def counted(self):
+        table = Movie.__table__
+        expected = {TOTAL_MOVIES: select([func.count()]).select_from(table),
+                    MOVIES_IN_STOCK: select([func.count()])
+                    .where(table.c.amount > 0)}
+        for genre in GENRES:
+            expected[u'genre:' + genre] = select([func.count()]).where(
+                (u' / ' + table.c.genres + u' / ').like(
+                    u'%% / %s / %%' % genre))
+        return dict((name, db.session.execute(query).scalar())
+                    for name, query in expected.items())
+
+    def assertCounts(self):
+        with self.app.app_context():
+            expected = dict((name, value) for name, value in
+                            self.counted().items() if value)
+            actual = dict((name, value) for name, value in totals().items()
+                          if value)
+            self.assertEqual(actual, expected)
+
+    def change(self, f):
+        with self.app.app_context():
+            totals()
+            f()
+            db.session.commit()
+        self.assertCounts()
+
+    def test_insert_edit_delete(self):
+        self.assertCounts()
+        self.change(lambda: db.session.add(
+            Movie(title=u'新影片', amount=1, genres=u'喜剧 / 动作')))
+
+        def edit_genres():
+            Movie.query.get(1).genres = u'动作'
+        self.change(edit_genres)
+
+        def edit_amount():
+            Movie.query.get(2).amount = 0
+        self.change(edit_amount)
+
+        def adjust_stock():
+            Movie.query.get(1).adjust_stock(amount=2)
+        self.change(adjust_stock)
+        self.change(lambda: db.session.delete(Movie.query.get(3)))
+
+    def test_reconcile_after_bulk_insert(self):
+        with self.app.app_context():
+            totals()
+            db.session.execute(Movie.__table__.insert(), [
+                {'title': u'导入%d' % i, 'amount': i % 2, 'genres': u'剧情'}
+                for i in range(5)])
+            db.session.commit()
+            self.assertEqual(totals()[TOTAL_MOVIES], 6)
+            changes = reconcile()
+            self.assertEqual(changes[TOTAL_MOVIES], (6, 11))
+        self.assertCounts()
+        with self.app.app_context():
+            self.assertEqual(reconcile(), {})
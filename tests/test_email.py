@@ -0,0 +1,149 @@
+# -*- coding:utf-8 -*-
+import socket
+from datetime import datetime, timedelta
+from app import db, mail
+from app.email import mail_pool
+from app.models import Outbox, User
+from tests.base import AppTestCase
+
+
+class FakeConnection(object):
+    """
+    记录发送的邮件; 收件人为 ``down@`` 时网络错误, ``bad@`` 时无法构造
+    """
+
+    host = 'localhost'
+
+    def __init__(self, sent):
+        self.sent = sent
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def send(self, message):
+        recipient = message.recipients[0]
+        if recipient.startswith('down@'):
+            raise socket.error('connection refused')
+        if recipient.startswith('bad@'):
+            raise ValueError('bad message')
+        self.sent.append(recipient)
+
+
+class OutboxTestCase(AppTestCase):
+    """
+    ..  note:: ``outbox`` 的认领、重试与失败
+
+        ``mail.connect`` 换成 ``FakeConnection``, 不连接 SMTP 服务器。
+
+    """
+
+    def settings(self):
+        return {'MAIL_LEASE': 300, 'MAIL_RETRY_BACKOFF': 30,
+                'MAIL_MAX_ATTEMPTS': 3}
+
+    def setUp(self):
+        super(OutboxTestCase, self).setUp()
+        self.sent = []
+        mail.connect = lambda: FakeConnection(self.sent)
+        self.addCleanup(delattr, mail, 'connect')
+
+    def queue(self, *recipients):
+        with self.app.app_context():
+            for recipient in recipients:
+                db.session.add(Outbox(recipient=recipient, subject=u'测试',
+                                      body=u'正文', html=u'<p>正文</p>'))
+            db.session.commit()
+
+    def outbox(self):
+        with self.app.app_context():
+            return dict((row.recipient, (row.status, row.attempts,
+                                         row.next_attempt_at))
+                        for row in Outbox.query)
+
+    def expire(self):
+        with self.app.app_context():
+            Outbox.query.update({'next_attempt_at': datetime.now()})
+            db.session.commit()
+
+    def assertAbout(self, moment, seconds):
+        expected = datetime.now() + timedelta(seconds=seconds)
+        self.assertTrue(abs(moment - expected) < timedelta(seconds=5),
+                        '%s != %s' % (moment, expected))
+
+    def test_claim_leases_messages(self):
+        self.queue('a@example.com', 'b@example.com')
+        with self.app.app_context():
+            claimed = mail_pool.claim(self.app)
+            self.assertEqual(len(claimed), 2)
+            self.assertEqual(mail_pool.claim(self.app), [])
+        for status, attempts, next_attempt_at in self.outbox().values():
+            self.assertEqual((status, attempts), ('sending', 0))
+            self.assertAbout(next_attempt_at, 300)
+        # 租约到期后重新认领
+        self.expire()
+        self.assertEqual(mail_pool.drain(self.app), 2)
+        self.assertEqual(sorted(self.sent), ['a@example.com', 'b@example.com'])
+        self.assertEqual(set(row[0] for row in self.outbox().values()),
+                         set(['sent']))
+
+    def test_retry_with_backoff(self):
+        self.queue('down@example.com')
+        for attempt, delay in ((1, 30), (2, 60)):
+            self.assertEqual(mail_pool.drain(self.app), 0)
+            status, attempts, next_attempt_at = \
+                self.outbox()['down@example.com']
+            self.assertEqual((status, attempts), ('pending', attempt))
+            self.assertAbout(next_attempt_at, delay)
+            self.assertEqual(mail_pool.drain(self.app), 0)
+            self.expire()
+        self.assertEqual(mail_pool.drain(self.app), 0)
+        self.assertEqual(self.outbox()['down@example.com'][:2], ('failed', 3))
+
+    def test_bad_message_fails_alone(self):
+        self.queue('bad@example.com', 'good@example.com')
+        self.assertEqual(mail_pool.drain(self.app), 1)
+        self.assertEqual(self.sent, ['good@example.com'])
+        outbox = self.outbox()
+        self.assertEqual(outbox['bad@example.com'][:2], ('failed', 1))
+        self.assertEqual(outbox['good@example.com'][:2], ('sent', 1))
+        self.expire()
+        self.assertEqual(mail_pool.drain(self.app), 0)
+
+
+class SendEmailTestCase(AppTestCase):
+    """
+    ..  note:: 视图写入的邮件在请求结束时提交
+    """
+
+    def seed(self):
+        db.session.add(User(email='reader@example.com', username='reader',
+                            password='cat'))
+
+    def recipients(self):
+        with self.app.app_context():
+            return [(row.recipient, row.status) for row in
+                    Outbox.query.order_by(Outbox.id)]
+
+    def test_register(self):
+        client = self.app.test_client()
+        response = client.post('/register', data={
+            'email': 'new@example.com', 'username': 'new',
+            'password': 'cat', 'password2': 'cat'})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(self.recipients(), [('new@example.com', 'pending')])
+
+    def test_resend_confirmation(self):
+        client = self.app.test_client(use_cookies=True)
+        self.assertEqual(client.post('/login', data={
+            'email': 'reader@example.com', 'password': 'cat'}).status_code, 302)
+        self.assertEqual(client.get('/confirm').status_code, 302)
+        self.assertEqual(self.recipients(), [('reader@example.com', 'pending')])
+
+    def test_password_reset_request(self):
+        client = self.app.test_client()
+        response = client.post('/reset', data={'email': 'reader@example.com'})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(self.recipients(), [('reader@example.com', 'pending')])
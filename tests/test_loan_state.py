@@ -0,0 +1,59 @@
+# -*- coding:utf-8 -*-
+from app import db
+from app.models import Movie, Role, User, loan_state
+from tests.base import AppTestCase
+
+
+class LoanStateTestCase(AppTestCase):
+    """
+    ..  note:: 借阅与归还提交后缓存的借阅状态失效, 回滚后不变
+
+        每一步使用新的程序上下文, 借阅状态从缓存读取。
+
+    """
+
+    def seed(self):
+        db.session.add(User(email='reader@example.com', username='reader',
+                            password='cat', confirmed=True,
+                            role=Role.query.filter_by(default=True).first()))
+        for i in range(2):
+            db.session.add(Movie(title=u'影片%d' % i, amount=1))
+
+    def state(self):
+        with self.app.app_context():
+            return loan_state(1)
+
+    def borrow(self, movie_id):
+        with self.app.app_context():
+            user = User.query.get(1)
+            user.borrow(Movie.query.get(movie_id), user)
+            db.session.commit()
+
+    def test_borrow(self):
+        self.assertEqual(self.state(), frozenset())
+        self.borrow(1)
+        self.assertEqual(self.state(), frozenset([1]))
+        self.borrow(2)
+        self.assertEqual(self.state(), frozenset([1, 2]))
+
+    def test_return(self):
+        self.borrow(1)
+        self.borrow(2)
+        self.assertEqual(self.state(), frozenset([1, 2]))
+        with self.app.app_context():
+            User.query.get(1).return_movie(Movie.query.get(1))
+            db.session.commit()
+        self.assertEqual(self.state(), frozenset([2]))
+
+    def test_rolled_back_return(self):
+        self.borrow(1)
+        self.assertEqual(self.state(), frozenset([1]))
+        with self.app.app_context():
+            User.query.get(1).return_movie(Movie.query.get(1))
+            # 未提交的归还只在这个会话中可见, 不写入缓存
+            self.assertEqual(loan_state(1), frozenset())
+            db.session.rollback()
+            self.assertEqual(loan_state(1), frozenset([1]))
+        self.assertEqual(self.state(), frozenset([1]))
+        with self.app.app_context():
+            self.assertEqual(Movie.query.get(1).amount, 0)
@@ -0,0 +1,75 @@
+# -*- coding:utf-8 -*-
+from datetime import datetime, timedelta
+from app import db, reminders
+from app.models import Checkpoint, Movie, Outbox, Record, Role, User
+from tests.base import AppTestCase
+
+
+class Interrupted(Exception):
+    pass
+
+
+class RemindOverdueTestCase(AppTestCase):
+    """
+    ..  note:: 中断后从断点继续, 每个逾期用户只有一封提醒
+
+        每块 2 行; 用户 1-4 各有两条逾期借阅, 分散在不同的块中,
+        用户 5 的借阅没有逾期。
+
+    """
+
+    def settings(self):
+        # manage.py 的命令在 test_request_context 中执行, 这里用 SERVER_NAME 生成链接
+        return {'OVERDUE_DAYS': 30, 'OVERDUE_CHUNK': 2,
+                'SERVER_NAME': 'localhost'}
+
+    def seed(self):
+        role = Role.query.filter_by(default=True).first()
+        for i in range(1, 6):
+            db.session.add(User(email='u%d@example.com' % i, username='u%d' % i,
+                                password='cat', confirmed=True, role=role))
+        for i in range(1, 4):
+            db.session.add(Movie(title=u'影片%d' % i, amount=5))
+        db.session.flush()
+        start = datetime.now() - timedelta(days=60)
+        loans = [(1, 1), (2, 1), (3, 1), (1, 2), (4, 1), (2, 2), (3, 2), (4, 2)]
+        for n, (customer_id, movie_id) in enumerate(loans):
+            db.session.add(Record(customer_id=customer_id, movie_id=movie_id,
+                                  timestamp=start + timedelta(hours=n)))
+        db.session.add(Record(customer_id=5, movie_id=3,
+                              timestamp=datetime.now()))
+
+    def interrupt_after_first_chunk(self):
+        """
+        处理完第一块之后中断, 返回原来的 ``overdue_chunks``
+        """
+        chunks = reminders.overdue_chunks
+
+        def interrupted(*args, **kwargs):
+            for n, chunk in enumerate(chunks(*args, **kwargs)):
+                if n == 1:
+                    raise Interrupted()
+                yield chunk
+        reminders.overdue_chunks = interrupted
+        self.addCleanup(setattr, reminders, 'overdue_chunks', chunks)
+        return chunks
+
+    def recipients(self):
+        with self.app.app_context():
+            return sorted(row.recipient for row in Outbox.query)
+
+    def test_resume_after_interruption(self):
+        chunks = self.interrupt_after_first_chunk()
+        with self.app.app_context():
+            self.assertRaises(Interrupted, reminders.remind_overdue)
+            db.session.rollback()
+            self.assertTrue(Checkpoint.query.get(reminders.CHECKPOINT)
+                            is not None)
+        self.assertEqual(self.recipients(), ['u1@example.com', 'u2@example.com'])
+
+        reminders.overdue_chunks = chunks
+        with self.app.app_context():
+            self.assertEqual(reminders.remind_overdue(), 2)
+            self.assertTrue(Checkpoint.query.get(reminders.CHECKPOINT) is None)
+        self.assertEqual(self.recipients(),
+                         ['u%d@example.com' % i for i in range(1, 5)])
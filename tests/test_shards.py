@@ -0,0 +1,100 @@
+# -*- coding:utf-8 -*-
+import os
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+from app import db, loan_shards
+from app.models import Movie, Record, Role, User
+from app.shards import loans
+from tests.base import AppTestCase
+
+
+class Interrupted(Exception):
+    pass
+
+
+class LoanShardsTestCase(AppTestCase):
+    """
+    ..  note:: 两个 SQLite 分片上的借阅
+
+        默认映射下 id 为奇数的用户在分片 1, 偶数的在分片 0。
+
+    """
+
+    def settings(self):
+        return {'LOAN_SHARDS': ['sqlite:///' + os.path.join(self.tmp, name)
+                                for name in ('ls0.sqlite', 'ls1.sqlite')],
+                'LOAN_SHARDS_FALLBACK': True}
+
+    def seed(self):
+        role = Role.query.filter_by(default=True).first()
+        for name in ('odd', 'even'):
+            db.session.add(User(email='%s@example.com' % name, username=name,
+                                password='cat', confirmed=True, role=role))
+        for i in range(3):
+            db.session.add(Movie(title=u'影片%d' % i, amount=2))
+        db.session.flush()
+        loan_shards.create_all()
+
+    def shard_rows(self, index):
+        with self.app.app_context():
+            return sorted(tuple(row) for row in loan_shards.engine(index).execute(
+                select([loans.c.customer_id, loans.c.movie_id])))
+
+    def main_rows(self):
+        with self.app.app_context():
+            return sorted((row.customer_id, row.movie_id)
+                          for row in Record.query)
+
+    def amount(self, movie_id):
+        with self.app.app_context():
+            return Movie.query.get(movie_id).amount
+
+    def test_borrow_goes_to_user_shard(self):
+        for name, movie_id in (('odd', 1), ('even', 2)):
+            client = self.app.test_client(use_cookies=True)
+            self.assertEqual(client.post('/login', data={
+                'email': '%s@example.com' % name,
+                'password': 'cat'}).status_code, 302)
+            self.assertEqual(client.get('/borrow/%d' % movie_id).status_code,
+                             302)
+        self.assertEqual(self.shard_rows(0), [(2, 2)])
+        self.assertEqual(self.shard_rows(1), [(1, 1)])
+        self.assertEqual(self.main_rows(), [])
+        self.assertEqual((self.amount(1), self.amount(2)), (1, 1))
+
+    def test_failed_commit_undoes_shard_insert(self):
+        with self.app.app_context():
+            user = User.query.get(1)
+            user.borrow(Movie.query.get(1), user)
+            # 主库 flush 时违反唯一约束, 分片已在 before_commit 中写入
+            db.session.add(Movie(title=u'影片0'))
+            self.assertRaises(IntegrityError, db.session.commit)
+            db.session.rollback()
+        self.assertEqual(self.shard_rows(1), [])
+        self.assertEqual(self.amount(1), 2)
+        with self.app.app_context():
+            self.assertEqual(User.query.get(1).amount, 7)
+
+    def test_split_resumes_without_duplicates(self):
+        with self.app.app_context():
+            for customer_id in (1, 2):
+                for movie_id in (1, 2, 3):
+                    db.session.add(Record(customer_id=customer_id,
+                                          movie_id=movie_id))
+            db.session.commit()
+            # 复制到分片后、从主库删除前中断
+            rows = loan_shards._main()[0].execute(
+                select([Record.__table__])).fetchall()
+            loan_shards._copy(1, [row for row in rows if row.customer_id == 1])
+
+            def interrupt(message):
+                raise Interrupted(message)
+            self.assertRaises(Interrupted, loan_shards.split, 2, log=interrupt)
+        self.assertEqual(len(self.main_rows()), 4)
+        with self.app.app_context():
+            self.assertEqual(loan_shards.split(2), 4)
+        self.assertEqual(self.main_rows(), [])
+        self.assertEqual(self.shard_rows(0), [(2, 1), (2, 2), (2, 3)])
+        self.assertEqual(self.shard_rows(1), [(1, 1), (1, 2), (1, 3)])
+        with self.app.app_context():
+            self.assertEqual(loan_shards.split(2), 0)
@@ -0,0 +1,94 @@
+# -*- coding:utf-8 -*-
+import numpy as np
+from app import db
+from app.models import Movie, Similarity
+from app.similar import build, movie_features, update_movie, _bucket, _paths
+from tests.base import AppTestCase
+
+GENRES = [u'剧情', u'喜剧', u'动作', u'爱情', u'科幻']
+NAMES = [u'张三', u'李四', u'王五', u'赵六', u'钱七', u'孙八']
+
+
+class SimilarTestCase(AppTestCase):
+    """
+    ..  note:: CSR 分块计算的结果与稠密矩阵一致
+
+        内存预算很小, 每块只有几部影片, 每段只有几个非零元素。
+
+    """
+
+    def settings(self):
+        return {'SIMILAR_DIMENSIONS': 64, 'SIMILAR_TOP_K': 3,
+                'SIMILAR_MEMORY': 4 * 40 * 2 * 3}
+
+    def seed(self):
+        for i in range(40):
+            db.session.add(Movie(
+                title=u'电影 %d' % i,
+                genres=u' / '.join(GENRES[j % 5] for j in (i, i // 3)),
+                directors=NAMES[i % 6], casts=NAMES[i // 7 % 6],
+                amount=1))
+        # 没有任何特征的影片
+        db.session.add(Movie(title=u'', genres=u'', directors=u'', casts=u'',
+                             amount=1))
+
+    def expected(self, query=None):
+        """
+        用稠密矩阵计算的前 ``k`` 个相似影片
+        """
+        config = self.app.config
+        dims, k = config['SIMILAR_DIMENSIONS'], config['SIMILAR_TOP_K']
+        movies = Movie.query.order_by(Movie.id).all()
+        matrix = np.zeros((len(movies), dims))
+        for row, movie in enumerate(movies):
+            for feature in movie_features(movie.title, movie.genres,
+                                          movie.directors, movie.casts):
+                matrix[row, _bucket(feature, dims)] += 1
+        df = (matrix > 0).sum(axis=0)
+        idf = np.log((1.0 + len(movies)) / (1.0 + df)) + 1
+        matrix *= idf
+        norms = np.sqrt((matrix * matrix).sum(axis=1, keepdims=True))
+        norms[norms == 0] = 1
+        matrix /= norms
+        scores = matrix.dot(matrix.T)
+        np.fill_diagonal(scores, -1)
+        return dict((movie.id, [movies[j].id for j in np.argsort(-row)[:k]
+                                if row[j] > 1e-6])
+                    for movie, row in zip(movies, scores)), scores
+
+    def assertSimilar(self, movie_id, similar_ids, scores, expected):
+        # 得分相同的影片顺序不定, 只比较得分
+        ids = [movie.id for movie in Movie.query.order_by(Movie.id)]
+        row = ids.index(movie_id)
+        self.assertEqual(len(similar_ids), len(expected))
+        np.testing.assert_allclose(
+            sorted(scores[row, ids.index(i)] for i in similar_ids),
+            sorted(scores[row, ids.index(i)] for i in expected), atol=1e-5)
+
+    def test_build_matches_dense(self):
+        with self.app.app_context():
+            build()
+            expected, scores = self.expected()
+            for similarity in Similarity.query:
+                similar_ids = [int(i) for i in similarity.similar_ids.split(',')
+                               if i]
+                self.assertSimilar(similarity.movie_id, similar_ids, scores,
+                                   expected[similarity.movie_id])
+            self.assertEqual(Similarity.query.count(), len(expected))
+            self.assertEqual(
+                sorted(_paths()), ['idf', 'ids', 'indices', 'indptr', 'weights'])
+
+    def test_update_movie_matches_build(self):
+        with self.app.app_context():
+            build()
+            movie = Movie.query.get(5)
+            before = movie.similarity.similar_ids
+            movie.similarity.similar_ids = u''
+            update_movie(movie)
+            db.session.commit()
+            self.assertEqual(Similarity.query.filter_by(movie_id=5).one()
+                             .similar_ids.count(','),
+                             before.count(','))
+            expected, scores = self.expected()
+            self.assertSimilar(5, [int(i) for i in movie.similarity.similar_ids
+                                   .split(',')], scores, expected[5])
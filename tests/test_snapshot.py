@@ -0,0 +1,79 @@
+# -*- coding:utf-8 -*-
+import json
+from base64 import b64encode
+from app import catalog, db
+from app.models import Movie, User
+from app.snapshot import build
+from tests.base import AppTestCase
+
+
+class CatalogSnapshotTestCase(AppTestCase):
+    """
+    ..  note:: 发布目录快照之后的修改
+    """
+
+    def settings(self):
+        return {'CATALOG_SNAPSHOT_CHECK': 0}
+
+    def seed(self):
+        db.session.add(User(email='john@example.com', username='john',
+                            password='cat', confirmed=True))
+        for i in range(3):
+            db.session.add(Movie(title=u'影片%d' % i, original_title='Movie %d' % i,
+                                 directors=u'导演', casts=u'演员', genres=u'剧情',
+                                 year=2000 + i, rating=5.0 + i, amount=1, counts=0))
+        db.session.flush()
+        self.ids = [movie.id for movie in Movie.query.order_by(Movie.id)]
+        self.client = self.app.test_client()
+
+    def get(self, url):
+        response = self.client.get(url, headers={
+            'Authorization': 'Basic ' + b64encode(
+                b'john@example.com:cat').decode('utf-8'),
+            'Accept': 'application/json'})
+        return response.status_code, json.loads(response.data.decode('utf-8'))
+
+    def publish(self):
+        with self.app.app_context():
+            build()
+            snapshot = catalog.current()
+            self.assertFalse(snapshot.outdated())
+            return snapshot.generation
+
+    def titles(self):
+        return [movie['title'] for movie in self.get('/api/v1/movies/')[1]['movies']]
+
+    def test_edit(self):
+        self.publish()
+        with self.app.app_context():
+            Movie.query.get(self.ids[0]).title = u'新标题'
+            db.session.commit()
+            snapshot = catalog.current()
+            self.assertTrue(snapshot.outdated())
+            self.assertIsNone(snapshot.get(self.ids[0]))
+            self.assertIsNotNone(snapshot.get(self.ids[1]))
+        self.assertEqual(self.get('/api/v1/movies/%d' % self.ids[0])[1]['title'],
+                         u'新标题')
+        self.assertIn(u'新标题', self.titles())
+        self.assertIn(u'新标题', self.client.get('/').get_data(as_text=True))
+        self.publish()
+        self.assertIn(u'新标题', self.titles())
+
+    def test_delete(self):
+        self.publish()
+        with self.app.app_context():
+            db.session.delete(Movie.query.get(self.ids[0]))
+            db.session.commit()
+        self.assertEqual(self.get('/api/v1/movies/%d' % self.ids[0])[0], 404)
+        status, body = self.get('/api/v1/movies/')
+        self.assertEqual(body['total'], 2)
+        self.assertNotIn(u'影片0', self.titles())
+
+    def test_stock_change_keeps_snapshot(self):
+        self.publish()
+        with self.app.app_context():
+            Movie.query.get(self.ids[0]).adjust_stock(amount=-1, counts=1)
+            db.session.commit()
+            snapshot = catalog.current()
+            self.assertFalse(snapshot.outdated())
+            self.assertIsNotNone(snapshot.get(self.ids[0]))